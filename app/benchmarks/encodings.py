@@ -0,0 +1,103 @@
+"""
+Size and encode/decode cost of the response encodings on the recorded
+NextBus responses in tests/data/nextbus-xml: flask-restful's pretty printed
+JSON, the response cache's compact JSON, and MessagePack when installed.
+
+Usage: python benchmarks/encodings.py [--output results.json]
+           [--rounds 7] [--filter substring]
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import sys
+import time
+import xml.etree.ElementTree as ET
+from io import BytesIO
+
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + "/.."))
+from nextbus.common.nextbusapi import NextbusObjectSerializer, \
+                                      NextbusAgencyList, NextbusRouteList, \
+                                      NextbusRouteConfigList, \
+                                      NextbusRouteSchedule
+from nextbus.common.encoding import encode_json, encode_msgpack, msgpack
+from hotpaths import FIXTURES, ROUNDS, measure
+
+DOCUMENTS = [(NextbusAgencyList, 'agencyList'),
+             (NextbusRouteList, 'routeList'),
+             (NextbusRouteConfigList, 'routeConfig'),
+             (NextbusRouteConfigList, 'routeConfig_verbose'),
+             (NextbusRouteSchedule, 'schedule_r_E'),
+             (NextbusRouteSchedule, 'schedule_r_KT')]
+
+
+def encode_pretty_json(data):
+    return json.dumps(data, cls=NextbusObjectSerializer,
+                      separators=(', ', ': '), indent=2)
+
+
+def encodings():
+    """ (name, encode, decode) of the encodings available. """
+    yield 'json_pretty', encode_pretty_json, json.loads
+    yield 'json', encode_json, json.loads
+    if msgpack is not None:
+        yield ('msgpack', encode_msgpack,
+               lambda body: msgpack.unpackb(body, encoding='utf-8'))
+
+
+def gzip_compress(body):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(body)
+    return buf.getvalue()
+
+
+def load(cls, name):
+    with gzip.open(os.path.join(FIXTURES, name + '.xml.gz'), 'rb') as f:
+        return cls.from_etree(ET.fromstring(f.read()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--filter', default='',
+                        help="only run benchmarks with names containing this")
+    args = parser.parse_args()
+
+    results = {}
+    for cls, document in DOCUMENTS:
+        model = load(cls, document)
+        for encoding, encode, decode in encodings():
+            name = '{}:{}'.format(encoding, document)
+            if args.filter not in name:
+                continue
+            body = encode(model)
+            results[name] = {
+                'bytes': len(body),
+                'gzip_bytes': len(gzip_compress(body)),
+                'encode': measure(lambda: encode(model), args.rounds),
+                'decode': measure(lambda: decode(body), args.rounds)}
+            sys.stderr.write("{:<36} {:>9} B {:>8} B gz {:9.3f} ms enc "
+                             "{:9.3f} ms dec\n".format(
+                                 name, results[name]['bytes'],
+                                 results[name]['gzip_bytes'],
+                                 results[name]['encode']['min'] * 1000,
+                                 results[name]['decode']['min'] * 1000))
+
+    report = {'python': platform.python_version(),
+              'implementation': platform.python_implementation(),
+              'machine': platform.machine(),
+              'time': time.time(),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
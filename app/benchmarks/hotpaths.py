@@ -0,0 +1,245 @@
+"""
+Micro-benchmarks of the request hot paths, on the recorded NextBus
+responses in tests/data/nextbus-xml: XML parsing, building the model with
+the `from_etree` classmethods, JSON encoding and the not in service check.
+
+Results are written as JSON, and compared to a baseline file when one
+exists; the run fails if any benchmark got slower than `--threshold` times
+its baseline. Timings depend on the machine and Python build, so record
+the baseline on the machine that runs the comparison.
+
+Usage: python benchmarks/hotpaths.py [--output results.json]
+           [--baseline benchmarks/baselines/hotpaths.json] [--save-baseline]
+           [--threshold 1.3] [--confirm 2] [--filter substring]
+"""
+import argparse
+import gzip
+import json
+import os
+import platform
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + "/.."))
+from nextbus.common.nextbusapi import NextbusApiClient, \
+                                      NextbusObjectSerializer, \
+                                      NextbusAgencyList, NextbusAgency, \
+                                      NextbusRouteList, NextbusRoute, \
+                                      NextbusRouteConfigList, \
+                                      NextbusRouteConfig, NextbusRouteStop, \
+                                      NextbusDirection, NextbusDirectionStop, \
+                                      NextbusPath, NextbusPathTag, \
+                                      NextbusRouteSchedule
+from nextbus.common.responsecache import ResponseCache
+from nextbus.common.serviceindex import ServiceWindowIndex, build_windows
+
+HERE = os.path.realpath(os.path.dirname(__file__))
+FIXTURES = os.path.join(HERE, '../tests/data/nextbus-xml')
+BASELINE = os.path.join(HERE, 'baselines/hotpaths.json')
+THRESHOLD = 1.3
+ROUNDS = 7
+# regressions are measured again this many times before failing the run,
+# to rule out a noisy neighbour
+CONFIRM = 2
+# run each benchmark at least this long per round, for stable timings
+MIN_ROUND_TIME = 0.05
+
+DOCUMENTS = ['agencyList', 'routeList', 'routeConfig', 'routeConfig_terse',
+             'routeConfig_verbose', 'schedule_r_E', 'schedule_r_F',
+             'schedule_r_J', 'schedule_r_KT', 'schedule_r_L']
+SCHEDULES = [d for d in DOCUMENTS if d.startswith('schedule_')]
+
+# classes built from the elements matching the path in the document
+BUILDERS = [(NextbusAgencyList, 'agencyList', '.'),
+            (NextbusAgency, 'agencyList', 'agency'),
+            (NextbusRouteList, 'routeList', '.'),
+            (NextbusRoute, 'routeList', 'route'),
+            (NextbusRouteConfigList, 'routeConfig', '.'),
+            (NextbusRouteConfigList, 'routeConfig_verbose', '.'),
+            (NextbusRouteConfig, 'routeConfig', 'route'),
+            (NextbusRouteStop, 'routeConfig', 'route/stop'),
+            (NextbusDirection, 'routeConfig', 'route/direction'),
+            (NextbusDirectionStop, 'routeConfig', 'route/direction/stop'),
+            (NextbusPath, 'routeConfig', 'route/path'),
+            # route configs are fetched verbose, with the path tags
+            (NextbusPath, 'routeConfig_verbose', 'route/path'),
+            (NextbusPathTag, 'routeConfig_verbose', 'route/path/tag')] + \
+           [(NextbusRouteSchedule, name, '.') for name in SCHEDULES]
+
+
+def load(name):
+    with gzip.open(os.path.join(FIXTURES, name + '.xml.gz'), 'rb') as f:
+        return f.read()
+
+
+def parse_benchmarks(texts):
+    for name in DOCUMENTS:
+        text = texts[name]
+        yield ('parse_xml:{}'.format(name),
+               lambda text=text: NextbusApiClient._parse_xml(text))
+
+
+def build_benchmarks(etrees):
+    for cls, name, path in BUILDERS:
+        elements = etrees[name].findall(path)
+        build = cls.from_etree
+
+        def run(build=build, elements=elements):
+            for element in elements:
+                build(element)
+        yield 'from_etree:{}:{}'.format(cls.__name__, name), run
+
+
+def serialize_benchmarks(models):
+    # flask-restful's (pretty printed) and the response cache's encoding
+    for name in ['agencyList', 'routeList', 'routeConfig',
+                 'routeConfig_verbose'] + SCHEDULES:
+        model = models[name]
+        yield ('serialize:{}'.format(name),
+               lambda model=model: json.dumps(model,
+                                              cls=NextbusObjectSerializer,
+                                              separators=(', ', ': '),
+                                              indent=2))
+        yield ('encode:{}'.format(name),
+               lambda model=model: ResponseCache.encode(model))
+
+
+def notinservice_benchmarks(models):
+    schedules = [models[name] for name in SCHEDULES]
+    windows = [build_windows(schedule) for schedule in schedules]
+    checks = [(service_class, seconds)
+              for service_class in ('wkd', 'sat', 'sun')
+              for seconds in range(0, 86400, 300)]
+
+    def build():
+        for schedule in schedules:
+            build_windows(schedule)
+
+    def check():
+        for route_windows in windows:
+            for service_class, seconds in checks:
+                ServiceWindowIndex.in_service(route_windows, service_class,
+                                              seconds)
+    yield 'notinservice:build_windows', build
+    yield 'notinservice:in_service', check
+
+
+def benchmarks():
+    texts = {name: load(name) for name in DOCUMENTS}
+    etrees = {name: ET.fromstring(text) for name, text in texts.items()}
+    models = {}
+    for cls, name, path in BUILDERS:
+        if path == '.':
+            models[name] = cls.from_etree(etrees[name])
+    for group in (parse_benchmarks(texts), build_benchmarks(etrees),
+                  serialize_benchmarks(models),
+                  notinservice_benchmarks(models)):
+        for name, func in group:
+            yield name, func
+
+
+def calibrate(func):
+    """ Number of calls taking at least MIN_ROUND_TIME. """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            func()
+        if time.time() - start >= MIN_ROUND_TIME:
+            return number
+        number *= 2
+
+
+def measure(func, rounds=ROUNDS):
+    """ Seconds per call, best and median of `rounds` rounds. """
+    number = calibrate(func)
+    timings = []
+    for _ in range(rounds):
+        start = time.time()
+        for _ in range(number):
+            func()
+        timings.append((time.time() - start) / number)
+    timings.sort()
+    return {'min': timings[0], 'median': timings[len(timings) // 2],
+            'rounds': rounds, 'number': number}
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """ Benchmarks slower than `threshold` times their baseline, as a list
+    of (name, ratio). Best timings are compared, being the least noisy.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = result['min'] / base['min']
+        if ratio > threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="store the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--rounds', type=int, default=ROUNDS)
+    parser.add_argument('--confirm', type=int, default=CONFIRM,
+                        help="times to measure regressions again")
+    parser.add_argument('--filter', default='',
+                        help="only run benchmarks with names containing this")
+    args = parser.parse_args()
+
+    funcs = [(name, func) for name, func in benchmarks()
+             if args.filter in name]
+    results = {}
+    for name, func in funcs:
+        results[name] = measure(func, args.rounds)
+        sys.stderr.write("{:<55} {:10.3f} ms\n".format(
+            name, results[name]['min'] * 1000))
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        funcs = dict(funcs)
+        for _ in range(args.confirm):
+            for name, _ in compare(results, baseline, args.threshold):
+                result = measure(funcs[name], args.rounds)
+                if result['min'] < results[name]['min']:
+                    results[name] = result
+
+    report = {'python': platform.python_version(),
+              'implementation': platform.python_implementation(),
+              'machine': platform.machine(),
+              'time': time.time(),
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        return 0
+    if baseline is None:
+        sys.stderr.write("no baseline at {}, not comparing\n".format(
+            args.baseline))
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for name, ratio in regressions:
+        sys.stderr.write("REGRESSION {}: {:.2f}x slower than "
+                         "baseline\n".format(name, ratio))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
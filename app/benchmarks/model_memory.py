@@ -0,0 +1,128 @@
+"""
+Memory, build throughput and JSON encoding time of the NextbusObject model,
+compared to the previous design where every object carried its own `_data`
+dict, with a NextbusPoint like object per path point.
+
+Usage: python benchmarks/model_memory.py [path/to/routeConfig.xml.gz]
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import xml.etree.ElementTree as ET
+from array import array
+
+sys.path.insert(0, os.path.realpath(os.path.dirname(__file__) + "/.."))
+from nextbus.common.nextbusapi import NextbusRouteConfigList
+
+FIXTURE = os.path.join(os.path.realpath(os.path.dirname(__file__)),
+                       '../tests/data/nextbus-xml/routeConfig.xml.gz')
+ROUNDS = 5
+
+
+class DictObject(object):
+    """ Stand-in for the previous dict-per-object NextbusObject. """
+
+    def __init__(self, **params):
+        self._data = dict(params)
+
+
+def build_dict_model(etree):
+    routes = []
+    for rt in etree.findall('route'):
+        route = DictObject(**rt.attrib)
+        route._data['stop'] = [DictObject(**s.attrib)
+                               for s in rt.findall('stop')]
+        route._data['direction'] = []
+        for d in rt.findall('direction'):
+            direction = DictObject(**d.attrib)
+            direction._data['stop'] = [DictObject(tag=s.get('tag'))
+                                       for s in d.findall('stop')]
+            route._data['direction'].append(direction)
+        route._data['path'] = []
+        for p in rt.findall('path'):
+            path = DictObject()
+            path._data['tag'] = [DictObject(id=t.get('id'))
+                                 for t in p.iter('tag')]
+            path._data['point'] = [DictObject(lat=pt.get('lat'),
+                                              lon=pt.get('lon'))
+                                   for pt in p.iter('point')]
+            route._data['path'].append(path)
+        routes.append(route)
+    return DictObject(routeconfig=routes)
+
+
+def build_compact_model(etree):
+    return NextbusRouteConfigList.from_etree(etree)
+
+
+def deep_sizeof(obj, seen=None):
+    """ Approximate number of bytes held by `obj` and everything it
+    references, each object counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, array)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+        return size
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+        return size
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, '__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+    return size
+
+
+def encode(model):
+    return json.dumps(model, default=lambda o: o._data,
+                      separators=(',', ':'))
+
+
+def best_time(func):
+    best = None
+    for _ in range(ROUNDS):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(build, etree):
+    model = build(etree)
+    return (deep_sizeof(model), best_time(lambda: build(etree)),
+            best_time(lambda: encode(model)))
+
+
+def main():
+    fixture = sys.argv[1] if len(sys.argv) > 1 else FIXTURE
+    etree = ET.fromstring(gzip.open(fixture, 'rb').read())
+    points = len(list(etree.iter('point')))
+    print("{}: {} routes, {} path points".format(
+        os.path.basename(fixture), len(etree.findall('route')), points))
+    results = [('dict', measure(build_dict_model, etree)),
+               ('compact', measure(build_compact_model, etree))]
+    assert json.loads(encode(build_dict_model(etree))) == \
+        json.loads(encode(build_compact_model(etree)))
+    for name, (size, build_time, encode_time) in results:
+        print("{:>8}: {:>12,} bytes  build {:8.1f} ms  {:10,.0f} points/s  "
+              "encode {:8.1f} ms".format(name, size, build_time * 1000,
+                                         points / build_time,
+                                         encode_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
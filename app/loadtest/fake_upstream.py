@@ -0,0 +1,279 @@
+"""
+Local stand-in for the NextBus publicXMLFeed, serving the recorded
+responses in tests/data/nextbus-xml, for load testing without hitting (or
+being throttled by) the real service.
+
+Single route configs are cut out of the full routeConfig document.
+Routes without a recorded schedule get one of the recorded schedules, with
+the route tag rewritten, so every route has one. Predictions and vehicle
+locations are made up, for the stops of the recorded route configs.
+
+GET /stats returns the number of requests served per command as JSON.
+
+Usage: python loadtest/fake_upstream.py [--port 8090] [--latency 0.1]
+           [--jitter 0.05] [--error-rate 0.01] [--http-error-rate 0.0]
+           [--max-rps 50]
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+from werkzeug.serving import run_simple
+from werkzeug.wrappers import Request, Response
+
+__author__ = "ndenev@gmail.com"
+
+FIXTURES = os.path.join(os.path.realpath(os.path.dirname(__file__)),
+                        '../tests/data/nextbus-xml')
+FEED_PATH = '/service/publicXMLFeed'
+XML_MIMETYPE = 'text/xml'
+VEHICLES_PER_ROUTE = 5
+
+
+def load(name):
+    with gzip.open(os.path.join(FIXTURES, name + '.xml.gz'), 'rb') as f:
+        return f.read()
+
+
+def document(elements):
+    body = ET.Element('body', {'copyright': "All data copyright San "
+                                            "Francisco Muni 2016."})
+    body.extend(elements)
+    return ('<?xml version="1.0" encoding="utf-8" ?>\n' +
+            ET.tostring(body, encoding='utf-8').split('?>', 1)[-1].lstrip())
+
+
+class Fixtures(object):
+    """ The upstream documents, built on first use and kept in memory. """
+
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.Lock()
+        self.schedules = sorted(name[len('schedule_r_'):-len('.xml.gz')]
+                                for name in os.listdir(FIXTURES)
+                                if name.startswith('schedule_r_'))
+
+    def get(self, key, build):
+        with self._lock:
+            text = self._documents.get(key)
+        if text is None:
+            text = build()
+            with self._lock:
+                self._documents[key] = text
+        return text
+
+    def route_config(self, route_tag, variant):
+        name = 'routeConfig' + ('_' + variant if variant else '')
+        if route_tag is None:
+            return self.get(name, lambda: load(name))
+
+        def build():
+            routes = ET.fromstring(self.route_config(None, variant))
+            return document([r for r in routes.findall('route')
+                             if r.get('tag') == route_tag])
+        return self.get((name, route_tag), build)
+
+    def schedule(self, route_tag):
+        if route_tag in self.schedules:
+            return self.get(('schedule', route_tag),
+                            lambda: load('schedule_r_' + route_tag))
+
+        def build():
+            recorded = self.schedules[hash(route_tag) % len(self.schedules)]
+            routes = ET.fromstring(self.schedule(recorded)).findall('route')
+            for route in routes:
+                route.set('tag', route_tag)
+            return document(routes)
+        return self.get(('schedule', route_tag), build)
+
+    def stops(self):
+        """ Route and stop titles and stopIds, by (route_tag, stop_tag). """
+        def build():
+            stops = {}
+            for route in ET.fromstring(self.route_config(None, None)):
+                for stop in route.findall('stop'):
+                    stops[(route.get('tag'), stop.get('tag'))] = (
+                        route.get('title'), stop.get('title'),
+                        stop.get('stopId'))
+            return stops
+        return self.get('stops', build)
+
+    def stop_locations(self):
+        """ The (lat, lon) of the stops, by route tag. """
+        def build():
+            locations = {}
+            for route in ET.fromstring(self.route_config(None, None)):
+                locations[route.get('tag')] = [
+                    (stop.get('lat'), stop.get('lon'))
+                    for stop in route.findall('stop')]
+            return locations
+        return self.get('stop_locations', build)
+
+    def vehicle_locations(self, route_tag):
+        """ VEHICLES_PER_ROUTE vehicles on the given (or every) route, each
+        at one of its stops.
+        """
+        elements = []
+        locations = self.stop_locations()
+        for tag in sorted(locations) if route_tag is None else [route_tag]:
+            stops = locations.get(tag, [])
+            for i, (lat, lon) in enumerate(random.sample(
+                    stops, min(VEHICLES_PER_ROUTE, len(stops)))):
+                elements.append(ET.Element('vehicle', {
+                    'id': '{}-{}'.format(tag, i), 'routeTag': tag,
+                    'lat': lat, 'lon': lon,
+                    'secsSinceReport': str(random.randint(0, 60)),
+                    'predictable': 'true',
+                    'heading': str(random.randint(0, 359)),
+                    'speedKmHr': str(random.randint(0, 50))}))
+        elements.append(ET.Element('lastTime', {
+            'time': str(int(time.time() * 1000))}))
+        return document(elements)
+
+    def predictions(self, stops):
+        elements = []
+        now = int(time.time() * 1000)
+        for route_tag, stop_tag in stops:
+            route_title, stop_title, _ = self.stops()[(route_tag, stop_tag)]
+            predictions = ET.Element('predictions', {
+                'agencyTitle': 'San Francisco Muni',
+                'routeTag': route_tag, 'routeTitle': route_title,
+                'stopTag': stop_tag, 'stopTitle': stop_title})
+            direction = ET.SubElement(predictions, 'direction',
+                                      {'title': route_title})
+            seconds = 0
+            for _ in range(random.randint(0, 5)):
+                seconds += random.randint(60, 900)
+                ET.SubElement(direction, 'prediction', {
+                    'epochTime': str(now + seconds * 1000),
+                    'seconds': str(seconds),
+                    'minutes': str(seconds // 60),
+                    'isDeparture': 'false',
+                    'vehicle': str(random.randint(1000, 9999))})
+            elements.append(predictions)
+        return document(elements)
+
+    def error(self):
+        return self.get('error', lambda: load('Error_shouldRetry_true'))
+
+    def response(self, params):
+        command = params.get('command')
+        if command in ('agencyList', 'routeList'):
+            return self.get(command, lambda: load(command))
+        if command == 'routeConfig':
+            variant = ('verbose' if 'verbose' in params else
+                       'terse' if 'terse' in params else None)
+            return self.route_config(params.get('r'), variant)
+        if command == 'schedule' and 'r' in params:
+            return self.schedule(params['r'])
+        if command == 'predictionsForMultiStops':
+            stops = [tuple(stop.split('|', 1)) for stop in params['stops']]
+            return self.predictions([stop for stop in stops
+                                     if stop in self.stops()])
+        if command == 'predictions' and 'stopId' in params:
+            return self.predictions(
+                [stop for stop, (_, _, stop_id) in self.stops().items()
+                 if stop_id == params['stopId'] and
+                 params.get('routeTag', stop[0]) == stop[0]])
+        if command == 'vehicleLocations':
+            return self.vehicle_locations(params.get('r'))
+        return None
+
+
+class Throttle(object):
+    """ Delays requests to serve at most `rate` per second. """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+class FakeUpstream(object):
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0,
+                 http_error_rate=0.0, max_rps=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.throttle = Throttle(max_rps)
+        self.fixtures = Fixtures()
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def feed(self, request):
+        params = request.args.to_dict()
+        params['stops'] = request.args.getlist('stops')
+        command = params.get('command', 'none')
+        self.count(command)
+        self.throttle.wait()
+        time.sleep(max(0, random.gauss(self.latency, self.jitter)))
+        roll = random.random()
+        if roll < self.http_error_rate:
+            self.count('http_error')
+            return Response('Service Unavailable', status=503)
+        if roll < self.http_error_rate + self.error_rate:
+            self.count('retriable_error')
+            return Response(self.fixtures.error(), mimetype=XML_MIMETYPE)
+        text = self.fixtures.response(params)
+        if text is None:
+            self.count('unsupported')
+            return Response('unsupported command', status=400)
+        return Response(text, mimetype=XML_MIMETYPE)
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        if request.path == FEED_PATH:
+            response = self.feed(request)
+        elif request.path == '/stats':
+            with self._lock:
+                stats = dict(self.stats)
+            response = Response(json.dumps(stats),
+                                mimetype='application/json')
+        else:
+            response = Response('not found', status=404)
+        return response(environ, start_response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help="mean response time, in seconds")
+    parser.add_argument('--jitter', type=float, default=0.05,
+                        help="standard deviation of the response time")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="fraction of shouldRetry=\"true\" errors")
+    parser.add_argument('--http-error-rate', type=float, default=0.0,
+                        help="fraction of HTTP 503 responses")
+    parser.add_argument('--max-rps', type=float, default=0,
+                        help="requests served per second, 0 for no limit")
+    args = parser.parse_args()
+
+    app = FakeUpstream(args.latency, args.jitter, args.error_rate,
+                       args.http_error_rate, args.max_rps)
+    run_simple(args.host, args.port, app, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+"""
+Load generator for the API. Drives the /api/v1 endpoints with a weighted
+mix of requests from a number of concurrent clients, and reports the
+throughput, latency percentiles and status codes per endpoint, along with
+the upstream calls made during the run.
+
+Usage: python loadtest/loadgen.py [--url http://localhost/api/v1]
+           [--upstream http://localhost:8090] [--clients 16]
+           [--duration 60] [--revalidate 0.2] [--output results.json]
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+import requests
+
+__author__ = "ndenev@gmail.com"
+
+# (name, path template, weight); {tag} is replaced by a random route tag,
+# {stop} by a random <route_tag>|<stop_tag> stop and {stops} by the query
+# string for a few of them, {stop_id} by a random stopId, {point} by the
+# lat/lon query string of a random stop and {departure} by a random
+# <route_tag>/stops/<stop_tag> of the route schedules
+MIX = [('root', '/', 2),
+       ('agency', '/agency', 5),
+       ('routes', '/routes', 20),
+       ('route_config', '/routes/config/{tag}', 25),
+       ('route_config_terse', '/routes/config/{tag}?terse=true', 5),
+       ('route_config_no_paths', '/routes/config/{tag}?exclude=paths', 5),
+       ('route_config_polyline', '/routes/config/{tag}?geometry=polyline',
+        5),
+       ('route_configs', '/routes/config?stream=true', 1),
+       ('route_schedule', '/routes/schedule/{tag}', 15),
+       ('next_departures', '/routes/schedule/{departure}/next', 10),
+       ('notinservice_route', '/routes/notinservice/{tag}', 15),
+       ('notinservice', '/routes/notinservice', 5),
+       ('predictions', '/predictions?stops={stop}', 20),
+       ('predictions_multi', '/predictions?{stops}', 5),
+       ('vehicles_route', '/vehicles/{tag}', 10),
+       ('vehicles', '/vehicles', 2),
+       ('stops_nearby', '/stops/nearby?{point}', 10),
+       ('stop', '/stops/{stop_id}', 5),
+       ('stop_routes', '/stops/{stop_id}/routes', 5),
+       ('stats', '/stats', 1)]
+MULTI_STOPS = 5
+
+
+def percentile(timings, pct):
+    if not timings:
+        return None
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+
+class Client(threading.Thread):
+    """ Sends requests until `deadline`, recording (name, status, seconds).
+    A `revalidate` fraction of the requests for an already seen path are
+    conditional, with the ETag received for it.
+    """
+
+    def __init__(self, url, targets, deadline, revalidate):
+        super(Client, self).__init__()
+        self.daemon = True
+        self.url = url
+        self.targets = targets
+        self.deadline = deadline
+        self.revalidate = revalidate
+        self.session = requests.Session()
+        self.etags = {}
+        self.results = []
+        self._choices = [(name, path) for name, path, weight in MIX
+                         for _ in range(weight)]
+
+    def request(self, name, path):
+        headers = {}
+        etag = self.etags.get(path)
+        if etag is not None and random.random() < self.revalidate:
+            headers['If-None-Match'] = etag
+        start = time.time()
+        try:
+            resp = self.session.get(self.url + path, headers=headers,
+                                    timeout=60)
+            resp.content
+            status = resp.status_code
+            if 'ETag' in resp.headers:
+                self.etags[path] = resp.headers['ETag']
+        except requests.RequestException:
+            status = 'error'
+        self.results.append((name, status, time.time() - start))
+
+    def run(self):
+        while time.time() < self.deadline:
+            name, path = random.choice(self._choices)
+            stops = random.sample(self.targets['stop'], MULTI_STOPS)
+            params = {k: random.choice(v) for k, v in self.targets.items()}
+            self.request(name, path.format(
+                stops="&".join("stops=" + stop for stop in stops), **params))
+
+
+def get_json(url):
+    try:
+        return requests.get(url, timeout=10).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def diff(after, before):
+    if after is None or before is None:
+        return None
+    return {k: v - before.get(k, 0) for k, v in after.items()
+            if isinstance(v, (int, long, float))}
+
+
+def report(results, elapsed):
+    endpoints = {}
+    for name, status, seconds in results:
+        endpoints.setdefault(name, []).append((status, seconds))
+    summary = {}
+    for name, samples in sorted(endpoints.items()):
+        timings = [seconds for _, seconds in samples]
+        statuses = {}
+        for status, _ in samples:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary[name] = {'requests': len(samples),
+                         'rps': len(samples) / elapsed,
+                         'p50': percentile(timings, 50),
+                         'p99': percentile(timings, 99),
+                         'status': statuses}
+    timings = [seconds for _, _, seconds in results]
+    return {'requests': len(results),
+            'rps': len(results) / elapsed,
+            'p50': percentile(timings, 50),
+            'p99': percentile(timings, 99),
+            'endpoints': summary}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://localhost/api/v1')
+    parser.add_argument('--upstream', default='http://localhost:8090',
+                        help="fake upstream, to count the calls made to it")
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--revalidate', type=float, default=0.2,
+                        help="fraction of conditional requests")
+    parser.add_argument('--output', help="write the results to this file")
+    args = parser.parse_args()
+
+    routes = get_json(args.url + '/routes')
+    if not routes:
+        sys.exit("can't get the route list from {}".format(args.url))
+    tags = [route['tag'] for route in routes['routes']]
+    targets = {'tag': tags, 'stop': [], 'stop_id': [], 'point': [],
+               'departure': []}
+    for tag in tags[:10]:
+        config = get_json(args.url + '/routes/config/' + tag) or {}
+        for route in config.get('routeconfig', []):
+            for stop in route['stop']:
+                targets['stop'].append("{}|{}".format(tag, stop['tag']))
+                targets['point'].append("lat={}&lon={}".format(stop['lat'],
+                                                               stop['lon']))
+                if 'stopId' in stop:
+                    targets['stop_id'].append(stop['stopId'])
+        schedule = get_json(args.url + '/routes/schedule/' + tag) or {}
+        for direction in schedule.get('schedule', []):
+            targets['departure'].extend(
+                "{}/stops/{}".format(tag, stop['tag'])
+                for stop in direction['header'])
+    for name, values in targets.items():
+        if not values:
+            sys.exit("no {} to request from {}".format(name, args.url))
+
+    upstream_before = get_json(args.upstream + '/stats')
+    api_before = get_json(args.url + '/stats')
+    start = time.time()
+    clients = [Client(args.url, targets, start + args.duration,
+                      args.revalidate)
+               for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    results = report([r for client in clients for r in client.results],
+                     elapsed)
+    results['clients'] = args.clients
+    results['duration'] = elapsed
+    results['upstream_calls'] = diff(get_json(args.upstream + '/stats'),
+                                     upstream_before)
+    api_after = get_json(args.url + '/stats')
+    if api_after is not None and api_before is not None:
+        results['upstream_fetches'] = diff(api_after.get('upstream'),
+                                           api_before.get('upstream'))
+
+    sys.stderr.write("{:<20} {:>8} {:>8} {:>9} {:>9}\n".format(
+        'endpoint', 'requests', 'rps', 'p50 ms', 'p99 ms'))
+    for name, endpoint in sorted(results['endpoints'].items()) + \
+            [('total', results)]:
+        sys.stderr.write("{:<20} {:>8} {:>8.1f} {:>9.1f} {:>9.1f}\n".format(
+            name, endpoint['requests'], endpoint['rps'],
+            (endpoint['p50'] or 0) * 1000, (endpoint['p99'] or 0) * 1000))
+    sys.stderr.write("upstream calls: {}\n".format(results['upstream_calls']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
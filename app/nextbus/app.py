@@ -2,12 +2,29 @@ import logging
 
 from flask import Flask
 from flask_restful import Api
+from flask_restful.representations.json import output_json as \
+    flask_restful_output_json
 from flask_cache import Cache
 from redis import Redis
 
-from nextbus.common.config import APP_CONFIG, REDIS_CONFIG
+from nextbus.common.config import APP_CONFIG, REDIS_CONFIG, NEXTBUS_CONFIG
 from nextbus.errors import api_error_map
 from nextbus.common.nextbusapi import NextbusApiClient
+from nextbus.common.backoff import BackoffPolicy
+from nextbus.common.ratelimit import RateLimiter
+from nextbus.common.responsecache import ResponseCache
+from nextbus.common.serviceindex import ServiceWindowIndex
+from nextbus.common.departures import DepartureIndex
+from nextbus.common.stopindex import StopIndex
+from nextbus.common.geometry import PathGeometry
+from nextbus.common.refresher import CacheRefresher
+from nextbus.common.vehicles import VehicleTracker
+from nextbus.common.stats import StatsBuffer
+from nextbus.common.metrics import REGISTRY
+from nextbus.common.profiler import RequestProfiler
+from nextbus.common.timing import add_server_timing, span
+from nextbus.common.encoding import ENCODERS, MSGPACK_MIMETYPE, \
+                                    output_msgpack
 from nextbus.resources.exceptions import ResourceNotFound, \
                                          InvalidRouteTagFormat
 
@@ -57,13 +74,56 @@ def create_app(config=None, environment=None, debug=False):
                   catch_all_404s=True)
 
     app.cache = Cache(app, config=APP_CONFIG['flask_cache_config'])
+    app.response_cache = ResponseCache(app.cache)
+    app.service_index = ServiceWindowIndex(app.cache)
+    app.departure_index = DepartureIndex(app.cache)
+    app.stop_index = StopIndex(app.cache)
+    app.path_geometry = PathGeometry(app.cache)
 
     app.stats_redis = Redis(host=REDIS_CONFIG['redis_host'],
                             port=REDIS_CONFIG['redis_port'],
                             password=REDIS_CONFIG['redis_pass'],
                             db=1)
+    app.stats = StatsBuffer(app.stats_redis,
+                            flush_interval=APP_CONFIG['stats_flush_interval'],
+                            max_pending=APP_CONFIG['stats_max_pending'],
+                            metrics=REGISTRY)
+    app.before_first_request(app.stats.start)
+    app.profiler = RequestProfiler(APP_CONFIG['profile_sample_rate'],
+                                   APP_CONFIG['profile_interval'])
+    # coordination between workers: fetch leases and the like
+    app.redis = Redis(host=REDIS_CONFIG['redis_host'],
+                      port=REDIS_CONFIG['redis_port'],
+                      password=REDIS_CONFIG['redis_pass'],
+                      db=2)
     setup_logging(app)
-    app.nextbus_api = NextbusApiClient(agency='sf-muni')
+    app.nextbus_api = NextbusApiClient(
+        agency=NEXTBUS_CONFIG['agency'],
+        endpoint=NEXTBUS_CONFIG['endpoint'],
+        max_concurrency=NEXTBUS_CONFIG['max_concurrency'],
+        refresh_concurrency=NEXTBUS_CONFIG['refresh_concurrency'],
+        stale_ttl=NEXTBUS_CONFIG['stale_ttl'],
+        pool_connections=NEXTBUS_CONFIG['pool_connections'],
+        pool_maxsize=NEXTBUS_CONFIG['pool_maxsize'],
+        backoff=BackoffPolicy(NEXTBUS_CONFIG['retries'],
+                              NEXTBUS_CONFIG['retry_base_delay'],
+                              NEXTBUS_CONFIG['retry_max_delay']),
+        request_budget=NEXTBUS_CONFIG['request_budget'],
+        rate_limiter=RateLimiter(app.redis, NEXTBUS_CONFIG['rate_limits'],
+                                 NEXTBUS_CONFIG['rate_limit_max_wait'],
+                                 NEXTBUS_CONFIG['refresh_rate_limits']),
+        predictions_ttl=NEXTBUS_CONFIG['predictions_ttl'],
+        batch_window=NEXTBUS_CONFIG['predictions_batch_window'],
+        batch_size=NEXTBUS_CONFIG['predictions_batch_size'])
+    app.vehicles = VehicleTracker(app.redis,
+                                  NEXTBUS_CONFIG['vehicles_poll_interval'],
+                                  NEXTBUS_CONFIG['vehicles_max_age'])
+    if NEXTBUS_CONFIG['refresh_interval']:
+        app.refresher = CacheRefresher(app,
+                                       NEXTBUS_CONFIG['refresh_interval'],
+                                       NEXTBUS_CONFIG['refresh_lead'])
+        # started in the worker processes, after uwsgi forks them
+        app.before_first_request(app.refresher.start)
     from nextbus.router import setup_router
     setup_router(app)
 
@@ -71,7 +131,18 @@ def create_app(config=None, environment=None, debug=False):
     app.config.update({'RESTFUL_JSON': {'separators': (', ', ': '),
                                         'indent': 2,
                                         'cls': NextbusObjectSerializer}})
-    from nextbus.resources import teardown_request
+    @app.api.representation('application/json')
+    def output_json(data, code, headers=None):
+        with span('serialize'):
+            return flask_restful_output_json(data, code, headers)
+    if MSGPACK_MIMETYPE in ENCODERS:
+        app.api.representation(MSGPACK_MIMETYPE)(output_msgpack)
+
+    from nextbus.resources import before_request, teardown_request, \
+                                  add_retry_after
+    app.before_request(before_request)
+    app.after_request(add_server_timing)
+    app.after_request(add_retry_after)
     app.teardown_request(teardown_request)
     setup_errorhandlers(app)
 
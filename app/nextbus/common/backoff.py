@@ -0,0 +1,56 @@
+import logging
+import random
+import time
+from functools import wraps
+
+from nextbus.common.metrics import RETRIES
+from nextbus.common.timing import span
+
+__author__ = "ndenev@gmail.com"
+
+logger = logging.getLogger('backoff')
+
+TRIES = 3
+BASE_DELAY = 0.2
+MAX_DELAY = 2.0
+
+
+class BackoffPolicy(object):
+    """ Exponential backoff with full jitter: the n-th retry waits a random
+    time of up to min(max_delay, base_delay * 2 ** n) seconds.
+    """
+
+    def __init__(self, tries=TRIES, base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delays(self):
+        for attempt in range(self.tries - 1):
+            yield random.uniform(0, min(self.max_delay,
+                                        self.base_delay * 2 ** attempt))
+
+
+def retry_with_backoff(exceptions):
+    """ Method decorator retrying on `exceptions` following the instance's
+    `backoff` policy. A retry is only made if it can start before the
+    instance's `deadline()`, so retries never outlive the request budget.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            deadline = self.deadline()
+            delays = self.backoff.delays()
+            while True:
+                try:
+                    return func(self, *args, **kwargs)
+                except exceptions as e:
+                    delay = next(delays, None)
+                    if delay is None or time.time() + delay >= deadline:
+                        raise
+                    logger.warning("{}, retrying in {:.2f}s".format(e, delay))
+                    RETRIES.inc(func.__name__)
+                    with span('backoff'):
+                        time.sleep(delay)
+        return wrapper
+    return decorator
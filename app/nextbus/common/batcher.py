@@ -0,0 +1,92 @@
+import threading
+import time
+
+__author__ = "ndenev@gmail.com"
+
+BATCH_WINDOW = 0.02
+BATCH_SIZE = 150
+
+
+class BatchTimeout(Exception):
+    pass
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.keys = []
+        self.results = {}
+        self.error = None
+        self.done = threading.Event()
+
+
+class RequestBatcher(object):
+    """ Coalesces lookups made concurrently by many threads into batched
+    calls of `fetch`, which takes a list of keys and returns a dict with
+    the values of the keys it found.
+
+    The first thread needing a key not already being looked up opens a
+    batch, waits `window` seconds for other threads to add their keys to
+    it (up to `max_size` keys), and makes the call for all of them. Keys
+    already part of a batch, open or in flight, are not looked up again.
+    """
+
+    def __init__(self, fetch, window=BATCH_WINDOW, max_size=BATCH_SIZE):
+        self.fetch = fetch
+        self.window = window
+        self.max_size = max_size
+        self._open = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _run(self, batch):
+        with self._lock:
+            if self._open is batch:
+                self._open = None
+        try:
+            batch.results = self.fetch(batch.keys)
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                for key in batch.keys:
+                    if self._pending.get(key) is batch:
+                        del self._pending[key]
+            batch.done.set()
+
+    def get_many(self, keys, timeout=None):
+        """ Look up the given keys, yielding (key, value, error) for each.
+        The value is None for keys `fetch` did not return.
+        """
+        batches = {}
+        leading = []
+        with self._lock:
+            for key in keys:
+                if key in batches:
+                    continue
+                batch = self._pending.get(key)
+                if batch is None:
+                    if (self._open is None or
+                            len(self._open.keys) >= self.max_size):
+                        self._open = _Batch()
+                        leading.append(self._open)
+                    batch = self._open
+                    batch.keys.append(key)
+                    self._pending[key] = batch
+                batches[key] = batch
+
+        if leading:
+            time.sleep(self.window)
+            for batch in leading:
+                self._run(batch)
+
+        deadline = None if timeout is None else time.time() + timeout
+        for key, batch in batches.items():
+            wait = None if deadline is None else max(0, deadline - time.time())
+            if not batch.done.wait(wait):
+                yield key, None, BatchTimeout("timed out waiting for "
+                                              "{}".format(key))
+            elif batch.error is not None:
+                yield key, None, batch.error
+            else:
+                yield key, batch.results.get(key), None
@@ -1,3 +1,4 @@
+import os
 
 REDIS_CONFIG = {'redis_host': 'redis1',
                 'redis_port': 6379,
@@ -9,7 +10,68 @@ flask_cache_config = {'CACHE_TYPE': 'redis',
                       'CACHE_REDIS_PASSWORD': REDIS_CONFIG['redis_pass'],
                       'CACHE_REDIS_DB': 0}
 
+NEXTBUS_CONFIG = {'agency': 'sf-muni',
+                  # overridden to point the load tests to a fake upstream
+                  'endpoint': os.environ.get(
+                      'NEXTBUS_ENDPOINT',
+                      'http://webservices.nextbus.com/service/publicXMLFeed'),
+                  'max_concurrency': 8,
+                  # serve expired upstream data for up to this many seconds
+                  # while it's being refreshed
+                  'stale_ttl': 600,
+                  # seconds between background refresh runs, 0 to disable
+                  'refresh_interval': 10,
+                  # refresh hot entries this many seconds before they expire
+                  'refresh_lead': 15,
+                  # threads refreshing in the background, apart from the
+                  # max_concurrency ones serving requests
+                  'refresh_concurrency': 2,
+                  # upstream keep-alive connection pools, and the connections
+                  # kept per host
+                  'pool_connections': 4,
+                  'pool_maxsize': 16,
+                  # upstream retries, with jittered exponential backoff
+                  'retries': 3,
+                  'retry_base_delay': 0.2,
+                  'retry_max_delay': 2.0,
+                  # seconds a request may spend on upstream calls and retries
+                  'request_budget': 10,
+                  # upstream requests per second and burst, for all workers
+                  'rate_limits': {'default': (2.0, 10),
+                                  'routeConfig': (2.0, 20),
+                                  'schedule': (1.0, 20)},
+                  # separate budget of the background cache refreshes: the
+                  # ~80 route configs kept warm with a 30s ttl, refreshed
+                  # 15s early, take ~4 requests per second on their own
+                  'refresh_rate_limits': {'default': (1.0, 10),
+                                          'routeConfig': (6.0, 90),
+                                          'schedule': (2.0, 90)},
+                  # longest a request queues for upstream rate limit tokens
+                  'rate_limit_max_wait': 2.0,
+                  # seconds stop predictions are cached for
+                  'predictions_ttl': 10,
+                  # stops missing from the cache are fetched together with
+                  # the ones requested in the next batch_window seconds,
+                  # up to batch_size stops per upstream call
+                  'predictions_batch_window': 0.02,
+                  'predictions_batch_size': 150,
+                  # vehicle locations are polled at most this often per
+                  # route, and dropped when not reported for vehicles_max_age
+                  'vehicles_poll_interval': 10,
+                  'vehicles_max_age': 300}
+
 APP_CONFIG = {'flask_cache_config': flask_cache_config,
               'flask_debug': True,
               'flask_host': "0.0.0.0",
-              'flask_port': 8080}
+              'flask_port': 8080,
+              # request stats are written to redis in batches, at least every
+              # stats_flush_interval seconds or stats_max_pending updates
+              'stats_flush_interval': 1.0,
+              'stats_max_pending': 100,
+              # fraction of requests run under the sampling profiler, whose
+              # profile is kept in the slowlog if they turn out slow
+              'profile_sample_rate': 0.0,
+              'profile_interval': 0.005,
+              # most requests served at once by run_async.py, more wait to
+              # be accepted
+              'async_max_connections': 1000}
@@ -0,0 +1,92 @@
+import bisect
+import heapq
+
+from nextbus.common.nextbusapi import SCHEDULE_NO_TIME
+
+__author__ = "ndenev@gmail.com"
+
+DEPARTURE_INDEX_TTL = 86400
+DEPARTURE_INDEX_PREFIX = 'departures'
+
+
+def build_departures(schedules):
+    """ Departures of a route as {stop_tag: [(serviceClass, direction,
+    [seconds, ...], [blockID, ...]), ...]}, with an entry per schedule
+    (service class and direction) stopping there, sorted by time.
+    """
+    departures = {}
+    for schedule in schedules:
+        block_ids = schedule.block_ids
+        for i, stop in enumerate(schedule.stops):
+            times = sorted((seconds, block_id) for seconds, block_id
+                           in zip(schedule.column(i), block_ids)
+                           if seconds != SCHEDULE_NO_TIME)
+            if not times:
+                continue
+            departures.setdefault(stop.tag, []).append(
+                (schedule.get('serviceClass'), schedule.get('direction'),
+                 [seconds for seconds, _ in times],
+                 [block_id for _, block_id in times]))
+    return departures
+
+
+def next_departures(entries, days, limit):
+    """ The first `limit` departures of a stop at or after the query time,
+    as (wait, seconds, serviceClass, direction, blockID) tuples.
+
+    `days` are the (serviceClass, seconds) of the service days to look at,
+    with the query time in seconds since the start of each of them, so the
+    trips of the previous service day running past midnight are included.
+    """
+    found = []
+    for service_class, seconds in days:
+        for entry_class, direction, times, block_ids in entries:
+            if entry_class != service_class:
+                continue
+            start = bisect.bisect_left(times, seconds)
+            for i in range(start, min(start + limit, len(times))):
+                found.append((times[i] - seconds, times[i], service_class,
+                              direction, block_ids[i]))
+    return heapq.nsmallest(limit, found)
+
+
+class DepartureIndex(object):
+    """ Per route and stop index of the scheduled departures, one sorted
+    list per service class and direction, searched with bisect.
+
+    The departures are built once per schedule content version, and kept
+    both in the shared cache and in process memory, so next departure
+    queries do not need the schedule itself.
+    """
+
+    def __init__(self, cache, ttl=DEPARTURE_INDEX_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self._departures = {}
+
+    @staticmethod
+    def _key(route_tag, version):
+        return "{}:{}:{}".format(DEPARTURE_INDEX_PREFIX, route_tag, version)
+
+    def departures(self, api, route_tag):
+        version = api.route_schedule_version(route_tag)
+        local = self._departures.get(route_tag)
+        if local is not None and local[0] == version:
+            return local[1]
+
+        key = self._key(route_tag, version)
+        departures = self.cache.get(key)
+        if departures is None:
+            departures = build_departures(api.route_schedule(route_tag))
+            self.cache.set(key, departures, timeout=self.ttl)
+        self._departures[route_tag] = (version, departures)
+        return departures
+
+    def next_departures(self, api, route_tag, stop_tag, days, limit):
+        """ The next departures of a route from a stop, see
+        next_departures(), or None for stops not in the route schedule.
+        """
+        entries = self.departures(api, route_tag).get(stop_tag)
+        if entries is None:
+            return None
+        return next_departures(entries, days, limit)
@@ -0,0 +1,54 @@
+import json
+from collections import OrderedDict
+
+from flask import make_response
+
+from nextbus.common.nextbusapi import NextbusObjectSerializer
+from nextbus.common.timing import span
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__author__ = "ndenev@gmail.com"
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/x-msgpack'
+
+
+def encode_json(data):
+    return json.dumps(data, cls=NextbusObjectSerializer, separators=(',', ':'))
+
+
+def _model_data(o):
+    return o._data
+
+
+def encode_msgpack(data):
+    """ MessagePack encoding of a response. NextbusObjects are packed
+    straight from their data, without going through JSON.
+    """
+    return msgpack.packb(data, default=_model_data)
+
+
+# response body encoders by mediatype, the first one being the default
+ENCODERS = OrderedDict([(JSON_MIMETYPE, encode_json)])
+if msgpack is not None:
+    ENCODERS[MSGPACK_MIMETYPE] = encode_msgpack
+
+
+def negotiate(accept):
+    """ The mediatype to encode a response in, for the given Accept header
+    values.
+    """
+    return accept.best_match(list(ENCODERS), default=JSON_MIMETYPE)
+
+
+def output_msgpack(data, code, headers=None):
+    """ flask-restful representation of the responses as MessagePack. """
+    with span('serialize'):
+        resp = make_response(encode_msgpack(data), code)
+    resp.headers.extend(headers or {})
+    resp.mimetype = MSGPACK_MIMETYPE
+    return resp
@@ -0,0 +1,152 @@
+import math
+
+from nextbus.common.nextbusapi import NextbusEncodedPath, NextbusPath
+
+__author__ = "ndenev@gmail.com"
+
+PATH_GEOMETRY_TTL = 86400
+PATH_GEOMETRY_PREFIX = 'path_geometry'
+POLYLINE_PRECISION = 5
+METERS_PER_DEGREE = math.pi * 6371008.8 / 180
+GEOMETRY_POINTS = 'points'
+GEOMETRY_POLYLINE = 'polyline'
+GEOMETRIES = (GEOMETRY_POINTS, GEOMETRY_POLYLINE)
+
+
+def simplify(lats, lons, tolerance):
+    """ Douglas-Peucker simplification of a line. Returns the indexes of
+    the points to keep, so that none of the dropped points is more than
+    `tolerance` meters away from the simplified line.
+    """
+    n = len(lats)
+    if n < 3 or tolerance <= 0:
+        return list(range(n))
+    # equirectangular projection to meters, fine at the scale of a city
+    cos_lat = math.cos(math.radians(sum(lats) / n))
+    xs = [lon * cos_lat * METERS_PER_DEGREE for lon in lons]
+    ys = [lat * METERS_PER_DEGREE for lat in lats]
+
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = xs[first], ys[first]
+        dx, dy = xs[last] - x1, ys[last] - y1
+        length = dx * dx + dy * dy
+        farthest, index = 0.0, None
+        for i in range(first + 1, last):
+            t = 0.0
+            if length:
+                t = max(0.0, min(1.0, ((xs[i] - x1) * dx +
+                                       (ys[i] - y1) * dy) / length))
+            distance = math.hypot(xs[i] - x1 - t * dx, ys[i] - y1 - t * dy)
+            if distance > farthest:
+                farthest, index = distance, i
+        if index is not None and farthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [i for i in range(n) if keep[i]]
+
+
+def _encode_value(value, chunks):
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+
+
+def encode_polyline(lats, lons, precision=POLYLINE_PRECISION):
+    """ Google encoded polyline of the given coordinates. """
+    factor = 10 ** precision
+    chunks = []
+    prev_lat = prev_lon = 0
+    for lat, lon in zip(lats, lons):
+        lat, lon = int(round(lat * factor)), int(round(lon * factor))
+        _encode_value(lat - prev_lat, chunks)
+        _encode_value(lon - prev_lon, chunks)
+        prev_lat, prev_lon = lat, lon
+    return ''.join(chunks)
+
+
+def decode_polyline(text, precision=POLYLINE_PRECISION):
+    """ The (lat, lon) coordinates of a Google encoded polyline. """
+    factor = float(10 ** precision)
+    values = []
+    value = shift = 0
+    for char in text:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    coordinates = []
+    lat = lon = 0
+    for i in range(0, len(values) - 1, 2):
+        lat += values[i]
+        lon += values[i + 1]
+        coordinates.append((lat / factor, lon / factor))
+    return coordinates
+
+
+def build_geometry(path, geometry, tolerance):
+    """ The geometry of a NextbusPath, simplified with `tolerance`, as an
+    encoded polyline or as (lats, lons) lists of the kept coordinates.
+    """
+    lats, lons = path.coordinates
+    keep = simplify(lats, lons, tolerance)
+    lats, lons = [lats[i] for i in keep], [lons[i] for i in keep]
+    if geometry == GEOMETRY_POLYLINE:
+        return encode_polyline(lats, lons)
+    return lats, lons
+
+
+class PathGeometry(object):
+    """ Alternative route path geometries: encoded polylines and paths
+    simplified with a given tolerance.
+
+    The geometries of a route are computed once per route config content
+    version, geometry and tolerance, and kept in the shared cache.
+    """
+
+    def __init__(self, cache, ttl=PATH_GEOMETRY_TTL):
+        self.cache = cache
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(version, route_tag, geometry, tolerance):
+        return "{}:{}:{}:{}:{}".format(PATH_GEOMETRY_PREFIX, version,
+                                       route_tag, geometry, tolerance)
+
+    def geometries(self, version, route, geometry, tolerance):
+        key = self._key(version, route.get('tag'), geometry, tolerance)
+        geometries = self.cache.get(key)
+        if geometries is None:
+            geometries = [build_geometry(path, geometry, tolerance)
+                          for path in route.get('path')]
+            self.cache.set(key, geometries, timeout=self.ttl)
+        return geometries
+
+    def apply(self, version, route, geometry, tolerance):
+        """ Replace the paths of a NextbusRouteConfig with the given
+        geometry. Routes without paths are left as they are.
+        """
+        paths = route.get('path')
+        if not paths:
+            return route
+        geometries = self.geometries(version, route, geometry, tolerance)
+        if geometry == GEOMETRY_POLYLINE:
+            route.set_paths([NextbusEncodedPath(polyline, tags=path.tags)
+                             for path, polyline in zip(paths, geometries)])
+        else:
+            simplified = []
+            for path, (lats, lons) in zip(paths, geometries):
+                simple = NextbusPath(tags=path.tags)
+                for lat, lon in zip(lats, lons):
+                    simple.add_coordinates(lat, lon)
+                simplified.append(simple)
+            route.set_paths(simplified)
+        return route
@@ -0,0 +1,94 @@
+import bisect
+import time
+
+__author__ = "ndenev@gmail.com"
+
+LATENCY_PREFIX = 'latency'
+# each window is a redis hash of bucket counts, kept for RETENTION seconds
+WINDOW = 60
+RETENTION = 3600
+PERCENTILES = (50, 95, 99)
+HIT = 'hit'
+MISS = 'miss'
+
+
+def _bucket_bounds(lowest=0.001, highest=120.0, factor=1.2):
+    """ Upper bounds in seconds of the histogram buckets. Bucket widths grow
+    geometrically, so every bucket has about the same relative error.
+    """
+    bounds = []
+    bound = lowest
+    while bound < highest:
+        bounds.append(round(bound, 6))
+        bound *= factor
+    bounds.append(highest)
+    return bounds
+
+
+BUCKETS = _bucket_bounds()
+
+
+def bucket_index(seconds):
+    return min(bisect.bisect_left(BUCKETS, seconds), len(BUCKETS) - 1)
+
+
+def window_start(now=None):
+    now = time.time() if now is None else now
+    return int(now) // WINDOW * WINDOW
+
+
+def window_key(start):
+    return "{}:{}".format(LATENCY_PREFIX, start)
+
+
+def field(name, outcome, bucket):
+    return "{}:{}:{}".format(name, outcome, bucket)
+
+
+def percentiles(counts):
+    """ Percentiles in milliseconds of a {bucket index: count} histogram,
+    reported as the upper bound of the bucket they fall in.
+    """
+    total = sum(counts.values())
+    result = {'count': total}
+    if not total:
+        return result
+    buckets = sorted(counts.items())
+    for p in PERCENTILES:
+        rank = total * p / 100.0
+        seen = 0
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                result['p{}'.format(p)] = round(BUCKETS[bucket] * 1000, 3)
+                break
+    return result
+
+
+class LatencyStats(object):
+    """ Reads the latency histograms written by all workers, and reports
+    percentiles per endpoint over a rolling time window.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def report(self, window=300, now=None):
+        last = window_start(now)
+        starts = range(last - max(window - WINDOW, 0) // WINDOW * WINDOW,
+                       last + 1, WINDOW)
+        pipe = self.redis.pipeline(transaction=False)
+        for start in starts:
+            pipe.hgetall(window_key(start))
+
+        histograms = {}
+        for window_counts in pipe.execute():
+            for key, count in window_counts.items():
+                name, outcome, bucket = key.rsplit(':', 2)
+                for o in (outcome, 'all'):
+                    counts = histograms.setdefault(name, {}).setdefault(o, {})
+                    counts[int(bucket)] = counts.get(int(bucket), 0) + int(count)
+
+        return {name: {outcome: percentiles(counts)
+                       for outcome, counts in outcomes.items()}
+                for name, outcomes in histograms.items()}
@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import time
+from functools import wraps
+from socket import gethostname
+
+__author__ = "ndenev@gmail.com"
+
+METRICS_KEY = 'metrics'
+# snapshots of workers not heard from for this long are left out
+METRICS_STALE = 300
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @property
+    def family(self):
+        """ Name of the metric in the HELP and TYPE lines. """
+        return self.name
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(labels), value] for labels, value
+                    in self._values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    @property
+    def family(self):
+        return self.name + '_total'
+
+    def inc(self, *labels, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def samples(self, labels, value):
+        yield self.family, labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # per bucket counts, then sum and count
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def samples(self, labels, value):
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            yield (self.name + '_bucket', labels + [('le', repr(bound))],
+                   cumulative)
+        yield self.name + '_bucket', labels + [('le', '+Inf')], value[-1]
+        yield self.name + '_sum', labels, value[-2]
+        yield self.name + '_count', labels, value[-1]
+
+
+class Registry(object):
+    """ Metrics of one worker process. Workers publish snapshots of their
+    metrics to redis, and any worker can render the sum over all of them.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    @staticmethod
+    def worker_id():
+        return "{}:{}".format(gethostname(), os.getpid())
+
+    def snapshot(self):
+        return {'time': time.time(),
+                'metrics': {m.name: m.snapshot() for m in self.metrics}}
+
+    def publish(self, pipe):
+        pipe.hset(METRICS_KEY, self.worker_id(), json.dumps(self.snapshot()))
+
+    def collect(self, redis):
+        """ Sum of the metrics published by all live workers, this one
+        included, as {name: {labels: value}}.
+        """
+        snapshots = redis.hgetall(METRICS_KEY)
+        snapshots[self.worker_id()] = json.dumps(self.snapshot())
+        now = time.time()
+        merged = {m.name: {} for m in self.metrics}
+        metrics = {m.name: m for m in self.metrics}
+        for worker, snapshot in snapshots.items():
+            snapshot = json.loads(snapshot)
+            if now - snapshot['time'] > METRICS_STALE:
+                redis.hdel(METRICS_KEY, worker)
+                continue
+            for name, values in snapshot['metrics'].items():
+                if name not in metrics:
+                    continue
+                for labels, value in values:
+                    labels = tuple(labels)
+                    current = merged[name].get(labels)
+                    merged[name][labels] = (value if current is None else
+                                            metrics[name].merge(current, value))
+        return merged
+
+    def render(self, redis):
+        """ Text exposition format of the metrics of all workers. """
+        merged = self.collect(redis)
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.family,
+                                               metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.family, metric.kind))
+            for labels, value in sorted(merged[metric.name].items()):
+                labels = list(zip(metric.labelnames, labels))
+                for name, sample_labels, sample in metric.samples(labels,
+                                                                  value):
+                    lines.append("{}{} {}".format(name,
+                                                  _format_labels(sample_labels),
+                                                  _format_value(sample)))
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'nextbus_requests', 'API requests served, per resource.', ['resource'])
+REQUEST_DURATION = REGISTRY.histogram(
+    'nextbus_request_duration_seconds', 'API request latency, per resource.',
+    ['resource'])
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    'nextbus_upstream_requests', 'Requests made to the NextBus XML feed.',
+    ['command'])
+UPSTREAM_ERRORS = REGISTRY.counter(
+    'nextbus_upstream_errors', 'Failed requests to the NextBus XML feed.',
+    ['command'])
+UPSTREAM_DURATION = REGISTRY.histogram(
+    'nextbus_upstream_duration_seconds',
+    'Latency of requests to the NextBus XML feed.', ['command'])
+UPSTREAM_CACHE = REGISTRY.counter(
+    'nextbus_upstream_cache_requests',
+    'Upstream document cache lookups, by result (hit, stale or miss).',
+    ['command', 'result'])
+RETRIES = REGISTRY.counter(
+    'nextbus_retries', 'Retried upstream operations.', ['operation'])
+XML_BYTES = REGISTRY.counter(
+    'nextbus_xml_parsed_bytes', 'Bytes of upstream XML parsed.', ['command'])
+OBJECTS_BUILT = REGISTRY.counter(
+    'nextbus_objects_built', 'Objects built from the upstream XML.',
+    ['type'])
+
+
+def count_built(from_etree):
+    """ Count the objects built by a `from_etree` classmethod. Apply it
+    below the classmethod decorator.
+    """
+    @wraps(from_etree)
+    def wrapper(cls, etree, *args, **kwargs):
+        OBJECTS_BUILT.inc(cls.__name__)
+        return from_etree(cls, etree, *args, **kwargs)
+    return wrapper
@@ -1,10 +1,26 @@
+import collections
 import logging
+import hashlib
+import itertools
+import threading
+import time
+import uuid
 import xml.etree.ElementTree as ET
+from array import array
+from io import BytesIO
 import requests
-from flask import current_app
-from requests.exceptions import ConnectionError
+from flask import current_app, g, has_app_context
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, RequestException, Timeout
 from json import JSONEncoder
-from retry import retry
+
+from nextbus.common.backoff import BackoffPolicy, retry_with_backoff
+from nextbus.common.batcher import RequestBatcher, BATCH_WINDOW, BATCH_SIZE
+from nextbus.common.metrics import count_built, UPSTREAM_REQUESTS, \
+                                   UPSTREAM_ERRORS, UPSTREAM_DURATION, \
+                                   UPSTREAM_CACHE, XML_BYTES
+from nextbus.common.timing import add_spans, span, stages
 
 #from nextbus.resources.exceptions import ResourceNotFound
 
@@ -14,6 +30,36 @@ logger = logging.getLogger('nextbusapi')
 DEFAULT_AGENCY = 'sf-muni'
 DEFAULT_ENDPOINT = 'http://webservices.nextbus.com/service/publicXMLFeed'
 CACHE_TTL = 30
+CACHE_TTL_LONG = 3600
+CACHE_KEY_PREFIX = 'nextbus'
+MAX_CONCURRENCY = 8
+REFRESH_CONCURRENCY = 2
+STALE_TTL = 600
+HOT_TTL = 3600
+LEASE_TTL = 15
+LEASE_POLL_INTERVAL = 0.05
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+REQUEST_TIMEOUT = 10
+MIN_REQUEST_TIMEOUT = 1
+REQUEST_BUDGET = 10
+RETRIABLE_ERRORS = (ConnectionError, Timeout)
+STATS_UPSTREAM_FETCHES = 'upstream_fetches'
+STATS_UPSTREAM_COALESCED = 'upstream_coalesced'
+# predictions change with every vehicle location report, so they are not
+# served stale, and cached per stop for a short time only
+PREDICTIONS_TTL = 10
+# schedule times of the blocks not stopping at a stop
+SCHEDULE_NO_TIME = -1
+SCHEDULE_NO_TIME_TEXT = '--'
+# delete a fetch lease only if it is still ours: it may have expired and
+# been taken by another worker since
+RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 #
 # XML Api Specification
@@ -25,6 +71,12 @@ CMD_AGENCY_LIST = 'agencyList'
 CMD_ROUTE_LIST = 'routeList'
 CMD_ROUTE_CONFIG = 'routeConfig'
 CMD_ROUTE_SCHEDULE = 'schedule'
+CMD_PREDICTIONS = 'predictions'
+CMD_PREDICTIONS_MULTI = 'predictionsForMultiStops'
+CMD_VEHICLE_LOCATIONS = 'vehicleLocations'
+# the documents kept warm by the refresher, once requested
+HOT_COMMANDS = frozenset([CMD_AGENCY_LIST, CMD_ROUTE_LIST, CMD_ROUTE_CONFIG,
+                          CMD_ROUTE_SCHEDULE])
 
 
 class NextbusApiError(Exception):
@@ -42,9 +94,18 @@ class NextbusApiFatalError(NextbusApiError):
     pass
 
 
+class NextbusApiRateLimited(NextbusApiError):
+    """ The upstream request budget is exhausted. """
+    pass
+
+
+_UNSET = object()
+
+
 class NextbusObject(object):
     """ Base class for all Nextbus API objects/resources.
     """
+    __slots__ = ()
     _attributes = []
 
     def __init__(self, **params):
@@ -63,7 +124,7 @@ class NextbusObject(object):
 
     def __eq__(self, other):
         return (isinstance(other, self.__class__)
-            and self.__dict__ == other.__dict__)
+            and self._data == other._data)
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -78,6 +139,35 @@ class NextbusObject(object):
         return self.__repr__()
 
 
+class NextbusRecord(NextbusObject):
+    """ Base class for the small and numerous Nextbus API objects.
+    Attributes are kept in slots instead of a per instance dict, and only
+    the attributes which were set are part of the object data.
+    """
+    __slots__ = ()
+
+    def __init__(self, **params):
+        for k, v in params.items():
+            if k not in self._attributes:
+                raise ValueError("Unknown attribute {} for {}",
+                                 k, self.__class__.__name__)
+            setattr(self, k, v)
+
+    @property
+    def _data(self):
+        data = {}
+        for k in self.__slots__:
+            v = getattr(self, k, _UNSET)
+            if v is not _UNSET:
+                data[k] = v
+        return data
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key, default)
+
+
 class NextbusAgencyList(NextbusObject):
     _attributes = ['agency']
 
@@ -93,6 +183,7 @@ class NextbusAgencyList(NextbusObject):
         self._data['agency'].append(agency)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         agency_list_obj = cls()
         for agency in etree.findall('agency'):
@@ -108,6 +199,7 @@ class NextbusAgency(NextbusObject):
         super(NextbusAgency, self).__init__(**params)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         params = {'tag': etree.get('tag'),
                   'title': etree.get('title'),
@@ -131,6 +223,7 @@ class NextbusRouteList(NextbusObject):
         self._data['routes'].append(route)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         route_list = cls()
         for route in etree.findall('route'):
@@ -146,6 +239,7 @@ class NextbusRoute(NextbusObject):
         super(NextbusRoute, self).__init__(**params)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         params = {'tag': etree.get('tag'),
                   'title': etree.get('title')}
@@ -170,10 +264,12 @@ class NextbusRouteConfigList(NextbusObject):
         self._data['routeconfig'].append(route)
 
     @classmethod
-    def from_etree(cls, etree):
+    @count_built
+    def from_etree(cls, etree, verbose=True, terse=False, fields=None):
         route_configs = cls()
         for route_cfg_et in etree.findall('route'):
-            route_cfg = NextbusRouteConfig.from_etree(route_cfg_et)
+            route_cfg = NextbusRouteConfig.from_etree(route_cfg_et, verbose,
+                                                      terse, fields)
             route_configs.add_route_config(route_cfg)
         return route_configs
 
@@ -185,6 +281,8 @@ class NextbusRouteConfig(NextbusObject):
     _attributes = ['tag', 'title', 'color', 'oppositeColor', 'stop',
                    'direction', 'useForUI', 'latMax', 'latMin',
                    'lonMax', 'lonMin']
+    # everything a route config can be projected to
+    fields = frozenset(_attributes + ['path'])
 
     def __init__(self, stops=[], directions=[], paths=[], **params):
         super(NextbusRouteConfig, self).__init__(**params)
@@ -216,33 +314,60 @@ class NextbusRouteConfig(NextbusObject):
             raise ValueError("Expected NextbusRoutePath instance.")
         self._data['path'].append(path)
 
+    def set_paths(self, paths):
+        """ Replace the paths, with NextbusPath or NextbusEncodedPath
+        objects.
+        """
+        for path in paths:
+            if not isinstance(path, (NextbusPath, NextbusEncodedPath)):
+                raise ValueError("Expected NextbusPath or NextbusEncodedPath "
+                                 "instance.")
+        self._data['path'] = list(paths)
+
     @classmethod
-    def from_etree(cls, etree):
-        params = {k: etree.get(k) for k in cls._attributes}
+    @count_built
+    def from_etree(cls, etree, verbose=True, terse=False, fields=None):
+        """ Build the route config from a verbose (or not) routeConfig
+        element. Without `verbose`, the directions not meant for the UI and
+        the path tags are left out, and with `terse` the paths, like in the
+        upstream output variants. Only the `fields` attributes are built, if
+        given.
+        """
+        fields = cls.fields if fields is None else fields
+        params = {k: etree.get(k) for k in cls._attributes if k in fields}
         if not etree.get('useForUI'):
-            del params['useForUI']
+            params.pop('useForUI', None)
 
         route_conf = cls(**params)
 
-        for stop in etree.findall('stop'):
-            route_conf.add_stop(NextbusRouteStop.from_etree(stop))
+        if 'stop' in fields:
+            for stop in etree.findall('stop'):
+                route_conf.add_stop(NextbusRouteStop.from_etree(stop))
 
-        for directn in etree.findall('direction'):
-            route_conf.add_direction(NextbusDirection.from_etree(directn))
+        if 'direction' in fields:
+            for directn in etree.findall('direction'):
+                if verbose or directn.get('useForUI') != 'false':
+                    route_conf.add_direction(
+                        NextbusDirection.from_etree(directn))
 
-        for path in etree.findall('path'):
-            route_conf.add_path(NextbusPath.from_etree(path))
+        if 'path' in fields and not terse:
+            for path in etree.findall('path'):
+                route_conf.add_path(NextbusPath.from_etree(path, verbose))
 
+        for k in cls.fields - fields:
+            route_conf._data.pop(k, None)
         return route_conf
 
 
-class NextbusRouteStop(NextbusObject):
-    _attributes = ['tag', 'title', 'shortTitle', 'lat', 'lon', 'stopId']
+class NextbusRouteStop(NextbusRecord):
+    __slots__ = _attributes = ('tag', 'title', 'shortTitle', 'lat', 'lon',
+                               'stopId')
 
     def __init__(self, **params):
         super(NextbusRouteStop, self).__init__(**params)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         params = {'tag': etree.get('tag'),
                   'title': etree.get('title'),
@@ -270,6 +395,7 @@ class NextbusDirection(NextbusObject):
         self._data['stop'].append(stop)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         params = {'tag': etree.get('tag'),
                   'title': etree.get('title'),
@@ -284,99 +410,262 @@ class NextbusDirection(NextbusObject):
 
 
 class NextbusPath(NextbusObject):
-    def __init__(self, points=[], tags=[]):
-        super(NextbusPath, self).__init__()
+    """ Path of a route. The points are stored as columns of numeric
+    coordinates, and serialized without NextbusPoint objects.
+    """
+    __slots__ = ('_tags', '_lat', '_lon')
 
-        self._data['tag'] = []
+    def __init__(self, points=[], tags=[]):
+        self._tags = []
         for tag in tags:
             self.add_tag(tag)
 
-        self._data['point'] = []
+        self._lat = array('d')
+        self._lon = array('d')
         for point in points:
             self.add_point(point)
 
     def add_tag(self, tag):
         if not isinstance(tag, NextbusPathTag):
             raise ValueError("Expected NextbusPathTag")
-        self._data['tag'].append(tag)
+        self._tags.append(tag)
 
     def add_point(self, point):
         if not isinstance(point, NextbusPoint):
             raise ValueError("Expected NextbusPoint instance.")
-        self._data['point'].append(point)
+        self.add_coordinates(point.get('lat'), point.get('lon'))
+
+    def add_coordinates(self, lat, lon):
+        self._lat.append(float(lat))
+        self._lon.append(float(lon))
+
+    @property
+    def coordinates(self):
+        """ The (lat, lon) columns of the path points. """
+        return self._lat, self._lon
+
+    @property
+    def tags(self):
+        return self._tags
+
+    def __len__(self):
+        return len(self._lat)
+
+    @property
+    def _data(self):
+        # formatted in their shortest form, as the upstream sends them
+        return {'tag': self._tags,
+                'point': [{'lat': lat, 'lon': lon} for lat, lon
+                          in zip(map(repr, self._lat), map(repr, self._lon))]}
+
+    def __eq__(self, other):
+        return (isinstance(other, self.__class__)
+            and self._tags == other._tags
+            and self._lat == other._lat
+            and self._lon == other._lon)
 
     @classmethod
-    def from_etree(cls, etree):
+    @count_built
+    def from_etree(cls, etree, tags=True):
         path = cls()
 
-        for tag in etree.iter('tag'):
-            path.add_tag(NextbusPathTag.from_etree(tag))
+        if tags:
+            for tag in etree.iter('tag'):
+                path.add_tag(NextbusPathTag.from_etree(tag))
 
         for point in etree.iter('point'):
-            path.add_point(NextbusPoint.from_etree(point))
+            path.add_coordinates(point.get('lat'), point.get('lon'))
 
         return path
 
 
-class NextbusPathTag(NextbusObject):
-    _attributes = ['id']
+class NextbusEncodedPath(NextbusObject):
+    """ Path of a route, with the points as a Google encoded polyline. """
+    _attributes = ['tag', 'polyline']
+
+    def __init__(self, polyline, tags=[]):
+        super(NextbusEncodedPath, self).__init__(polyline=polyline)
+        self._data['tag'] = []
+        for tag in tags:
+            self.add_tag(tag)
+
+    def add_tag(self, tag):
+        if not isinstance(tag, NextbusPathTag):
+            raise ValueError("Expected NextbusPathTag")
+        self._data['tag'].append(tag)
+
+
+class NextbusPathTag(NextbusRecord):
+    __slots__ = _attributes = ('id',)
 
     def __init__(self, **params):
         super(NextbusPathTag, self).__init__(**params)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         return cls(id=etree.get('id'))
 
 
-class NextbusPoint(NextbusObject):
-    _attributes = ['lat', 'lon']
+class NextbusPoint(NextbusRecord):
+    __slots__ = _attributes = ('lat', 'lon')
 
     def __init__(self, **params):
         super(NextbusPoint, self).__init__(**params)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         params = {'lat': etree.get('lat'),
                   'lon': etree.get('lon')}
         return cls(**params)
 
 
-class NextbusDirectionStop(NextbusObject):
-    _attributes = ['tag']
+class NextbusDirectionStop(NextbusRecord):
+    __slots__ = _attributes = ('tag',)
 
     def __init__(self, **params):
         super(NextbusDirectionStop, self).__init__(**params)
 
     @classmethod
+    @count_built
     def from_etree(cls, etree):
         return cls(tag=etree.get('tag'))
 
 
+def schedule_seconds(epoch_time):
+    """ Seconds since the start of the service day of a schedule
+    epochTime, which is in milliseconds and goes past 24:00:00 for the
+    trips after midnight.
+    """
+    epoch_time = int(epoch_time)
+    if epoch_time < 0:
+        return SCHEDULE_NO_TIME
+    return epoch_time // 1000
+
+
+def schedule_epoch_time(seconds):
+    if seconds == SCHEDULE_NO_TIME:
+        return str(SCHEDULE_NO_TIME)
+    return str(seconds * 1000)
+
+
+def schedule_time_text(seconds):
+    """ The "HH:MM:SS" schedule time, wrapped around midnight as NextBus
+    does, of the seconds since the start of the service day.
+    """
+    if seconds == SCHEDULE_NO_TIME:
+        return SCHEDULE_NO_TIME_TEXT
+    seconds %= 86400
+    return "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
 class NextbusRouteSchedule(NextbusObject):
+    """ Schedule of a route in one direction and service class. The stop
+    times are stored as a blocks x stops matrix of seconds since the start
+    of the service day, in an integer array, and only turned into
+    NextbusRouteScheduleBlock objects on access.
+    """
+    __slots__ = ('_attrs', '_stops', '_block_ids', '_times')
     _attributes = ['tag', 'title', 'scheduleClass',
                    'serviceClass', 'direction']
 
-    def __init__(self, header, blocks, **params):
-        super(NextbusRouteSchedule, self).__init__(**params)
-        self._data['header'] = header
-        self._data['block'] = blocks
+    def __init__(self, stops=[], block_ids=[], times=[], **params):
+        self._attrs = {}
+        for k, v in params.items():
+            if k not in self._attributes:
+                raise ValueError("Unknown attribute {} for {}",
+                                 k, self.__class__.__name__)
+            self._attrs[k] = v
+        self._stops = list(stops)
+        self._block_ids = list(block_ids)
+        self._times = array('i', times)
+        if len(self._times) != len(self._stops) * len(self._block_ids):
+            raise ValueError("Expected {} x {} schedule times.".format(
+                len(self._block_ids), len(self._stops)))
+
+    def get(self, key, default=None):
+        if key in self._attributes:
+            return self._attrs.get(key, default)
+        return self._data.get(key, default)
+
+    @property
+    def stops(self):
+        """ The NextbusRouteScheduleHeaderEntry of the matrix columns. """
+        return self._stops
+
+    @property
+    def block_ids(self):
+        """ The blockID of the matrix rows. """
+        return self._block_ids
+
+    @property
+    def times(self):
+        """ The row major matrix of the stop times, in seconds since the
+        start of the service day, or SCHEDULE_NO_TIME for blocks not
+        stopping there.
+        """
+        return self._times
+
+    def row(self, i):
+        width = len(self._stops)
+        return self._times[i * width:(i + 1) * width]
+
+    def column(self, i):
+        return self._times[i::len(self._stops)]
+
+    @property
+    def _data(self):
+        data = dict(self._attrs)
+        data['header'] = self._stops
+        texts = {}
+        blocks = []
+        for i, block_id in enumerate(self._block_ids):
+            stopdata = []
+            for stop, seconds in zip(self._stops, self.row(i)):
+                text = texts.get(seconds)
+                if text is None:
+                    text = texts[seconds] = (schedule_time_text(seconds),
+                                             schedule_epoch_time(seconds))
+                stopdata.append({'tag': stop.tag, 'epochTime': text[1],
+                                 'time': text[0]})
+            blocks.append(NextbusRouteScheduleBlock(stopdata,
+                                                    blockID=block_id))
+        data['block'] = blocks
+        return data
+
+    def __eq__(self, other):
+        return (isinstance(other, self.__class__)
+            and self._attrs == other._attrs
+            and self._stops == other._stops
+            and self._block_ids == other._block_ids
+            and self._times == other._times)
 
     @classmethod
     def from_etree(cls, etree):
-        routes = []
-        for rt in etree.findall('route'):
-            header = rt.find('header')
-            hstops = [NextbusRouteScheduleHeaderEntry(e.text, **e.attrib) for e
-                      in header.findall('stop')]
-            blocks = []
-            for block in rt.findall('tr'):
-                stopdata = [NextbusRouteSchedulePrediction(e.text, **e.attrib)
-                            for e in block.findall('stop')]
-                blocks.append(NextbusRouteScheduleBlock(stopdata,
-                                                        **block.attrib))
-            routes.append(NextbusRouteSchedule(hstops, blocks, **rt.attrib))
-        return routes
+        return [cls.from_route_etree(rt) for rt in etree.findall('route')]
+
+    @classmethod
+    @count_built
+    def from_route_etree(cls, rt):
+        header = rt.find('header')
+        hstops = [NextbusRouteScheduleHeaderEntry(e.text, **e.attrib) for e
+                  in header.findall('stop')]
+        # loop routes list a stop more than once, so the rows are matched
+        # to the header by position
+        tags = [stop.tag for stop in hstops]
+        block_ids = []
+        times = array('i')
+        for block in rt.findall('tr'):
+            block_ids.append(block.get('blockID'))
+            row = block.findall('stop')
+            if [e.get('tag') for e in row] != tags:
+                raise NextbusApiFatalError(
+                    "Stops of block {} do not match the schedule header of "
+                    "route {}.".format(block.get('blockID'), rt.get('tag')))
+            times.extend(schedule_seconds(e.get('epochTime')) for e in row)
+        return cls(hstops, block_ids, times, **rt.attrib)
 
 
 class NextbusRouteScheduleHeader(NextbusObject):
@@ -385,12 +674,13 @@ class NextbusRouteScheduleHeader(NextbusObject):
         self._data['stop'] = stops
 
 
-class NextbusRouteScheduleHeaderEntry(NextbusObject):
-    _attributes = ['tag']
+class NextbusRouteScheduleHeaderEntry(NextbusRecord):
+    __slots__ = ('tag', 'title')
+    _attributes = ('tag',)
 
     def __init__(self, text, **params):
         super(NextbusRouteScheduleHeaderEntry, self).__init__(**params)
-        self._data['title'] = text
+        self.title = text
 
 
 class NextbusRouteScheduleBlock(NextbusObject):
@@ -401,86 +691,788 @@ class NextbusRouteScheduleBlock(NextbusObject):
         self._data['stop_prediction'] = stopdata
 
 
-class NextbusRouteSchedulePrediction(NextbusObject):
-    _attributes = ['tag', 'epochTime']
+class NextbusRouteSchedulePrediction(NextbusRecord):
+    __slots__ = ('tag', 'epochTime', 'time')
+    _attributes = ('tag', 'epochTime')
 
     def __init__(self, text_time, **params):
         super(NextbusRouteSchedulePrediction, self).__init__(**params)
-        self._data['time'] = text_time
+        self.time = text_time
+
+
+class NextbusPredictions(NextbusObject):
+    """ Arrival predictions of the vehicles of a route at a stop. """
+    _attributes = ['agencyTitle', 'routeTag', 'routeTitle', 'stopTag',
+                   'stopTitle', 'dirTitleBecauseNoPredictions']
+
+    def __init__(self, directions=[], messages=[], **params):
+        super(NextbusPredictions, self).__init__(**params)
+        self._data['direction'] = []
+        self._data['message'] = []
+        for direction in directions:
+            self.add_direction(direction)
+        for message in messages:
+            self.add_message(message)
+
+    def add_direction(self, direction):
+        if not isinstance(direction, NextbusPredictionDirection):
+            raise ValueError("Expected NextbusPredictionDirection instance.")
+        self._data['direction'].append(direction)
+
+    def add_message(self, message):
+        if not isinstance(message, NextbusPredictionMessage):
+            raise ValueError("Expected NextbusPredictionMessage instance.")
+        self._data['message'].append(message)
+
+    @classmethod
+    @count_built
+    def from_etree(cls, etree):
+        params = {k: v for k, v in etree.attrib.items()
+                  if k in cls._attributes}
+        predictions = cls(**params)
+        for direction in etree.findall('direction'):
+            predictions.add_direction(
+                NextbusPredictionDirection.from_etree(direction))
+        for message in etree.findall('message'):
+            predictions.add_message(
+                NextbusPredictionMessage.from_etree(message))
+        return predictions
+
+
+class NextbusPredictionDirection(NextbusObject):
+    _attributes = ['title']
+
+    def __init__(self, predictions=[], **params):
+        super(NextbusPredictionDirection, self).__init__(**params)
+        self._data['prediction'] = []
+        for prediction in predictions:
+            self.add_prediction(prediction)
+
+    def add_prediction(self, prediction):
+        if not isinstance(prediction, NextbusPrediction):
+            raise ValueError("Expected NextbusPrediction instance.")
+        self._data['prediction'].append(prediction)
+
+    @classmethod
+    @count_built
+    def from_etree(cls, etree):
+        direction = cls(title=etree.get('title'))
+        for prediction in etree.findall('prediction'):
+            direction.add_prediction(NextbusPrediction.from_etree(prediction))
+        return direction
+
+
+class NextbusPrediction(NextbusRecord):
+    __slots__ = _attributes = ('epochTime', 'seconds', 'minutes',
+                               'isDeparture', 'affectedByLayover',
+                               'isScheduleBased', 'delayed', 'slowness',
+                               'dirTag', 'vehicle', 'vehiclesInConsist',
+                               'block', 'tripTag')
+
+    def __init__(self, **params):
+        super(NextbusPrediction, self).__init__(**params)
+
+    @classmethod
+    @count_built
+    def from_etree(cls, etree):
+        return cls(**{k: v for k, v in etree.attrib.items()
+                      if k in cls._attributes})
+
+
+class NextbusPredictionMessage(NextbusRecord):
+    __slots__ = _attributes = ('text', 'priority')
+
+    def __init__(self, **params):
+        super(NextbusPredictionMessage, self).__init__(**params)
+
+    @classmethod
+    @count_built
+    def from_etree(cls, etree):
+        return cls(text=etree.get('text'), priority=etree.get('priority'))
+
+
+class NextbusVehicle(NextbusRecord):
+    __slots__ = _attributes = ('id', 'routeTag', 'dirTag', 'lat', 'lon',
+                               'secsSinceReport', 'predictable', 'heading',
+                               'speedKmHr', 'leadingVehicleId')
+
+    def __init__(self, **params):
+        super(NextbusVehicle, self).__init__(**params)
+
+    @classmethod
+    @count_built
+    def from_etree(cls, etree):
+        return cls(**{k: v for k, v in etree.attrib.items()
+                      if k in cls._attributes})
 
 
 class NextbusApiClient(object):
-    def __init__(self, agency=DEFAULT_AGENCY, endpoint=DEFAULT_ENDPOINT):
+    def __init__(self, agency=DEFAULT_AGENCY, endpoint=DEFAULT_ENDPOINT,
+                 max_concurrency=MAX_CONCURRENCY,
+                 refresh_concurrency=REFRESH_CONCURRENCY, stale_ttl=STALE_TTL,
+                 hot_ttl=HOT_TTL, lease_ttl=LEASE_TTL,
+                 pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 backoff=None, request_budget=REQUEST_BUDGET,
+                 rate_limiter=None, predictions_ttl=PREDICTIONS_TTL,
+                 batch_window=BATCH_WINDOW, batch_size=BATCH_SIZE):
         self.agency = agency
         self.endpoint = endpoint
         self.headers = {'Accept-Encoding': 'gzip, deflate'}
-        self.timeout = 10
+        self.timeout = REQUEST_TIMEOUT
+        self.backoff = backoff or BackoffPolicy()
+        self.request_budget = request_budget
+        self.rate_limiter = rate_limiter
+        self.session = self._make_session(pool_connections, pool_maxsize)
+        self.max_concurrency = max_concurrency
+        self.refresh_concurrency = refresh_concurrency
+        self.stale_ttl = stale_ttl
+        self.hot_ttl = hot_ttl
+        self.lease_ttl = lease_ttl
+        self._pool = None
+        self._refresh_pool = None
+        self._pool_lock = threading.Lock()
+        self._hot = {}
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+        self.predictions_ttl = predictions_ttl
+        self._predictions_batcher = RequestBatcher(self._fetch_predictions,
+                                                   batch_window, batch_size)
 
     @staticmethod
-    def _parse_xml(text):
+    def _make_session(pool_connections, pool_maxsize):
+        """ Keep-alive session, with at most `pool_maxsize` connections to
+        each of up to `pool_connections` hosts. Requests over the per host
+        limit wait for a free connection instead of opening new ones.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def deadline(self):
+        """ Time by which the upstream calls made for the current request
+        should be done. Outside of requests, a full budget from now.
+        """
+        deadline = g.get('deadline') if has_app_context() else None
+        if deadline is None:
+            deadline = time.time() + self.request_budget
+        return deadline
+
+    def _get_pool(self, background=False):
+        # created on first use, so they are not shared across forked workers
+        with self._pool_lock:
+            if background:
+                if self._refresh_pool is None:
+                    self._refresh_pool = ThreadPool(self.refresh_concurrency)
+                return self._refresh_pool
+            if self._pool is None:
+                self._pool = ThreadPool(self.max_concurrency)
+            return self._pool
+
+    def fan_out(self, func, route_tags, background=False):
+        """ Call `func(route_tag)` for every route tag on the client thread
+        pool, running at most `max_concurrency` calls at once. Yields
+        (route_tag, result, error) tuples in order of completion, where
+        error is the NextbusApiError or upstream request exception raised
+        for that route tag, if any. `background` calls run on the separate
+        `refresh_concurrency` pool, so they don't hold up requests.
+        """
+        app = current_app._get_current_object()
+        # the calls share the remaining budget of the current request
+        deadline = self.deadline()
+
+        def call(route_tag):
+            with app.app_context():
+                g.deadline = deadline
+                try:
+                    result = route_tag, func(route_tag), None
+                except (NextbusApiError, RequestException) as e:
+                    result = route_tag, None, e
+                return result + (stages(),)
+
+        def results(calls):
+            # the stages timed in the workers count for the current request
+            for route_tag, result, error, spans in calls:
+                add_spans(spans)
+                yield route_tag, result, error
+
+        route_tags = list(route_tags)
+        if len(route_tags) <= 1:
+            return results(call(route_tag) for route_tag in route_tags)
+        return results(self._get_pool(background).imap_unordered(
+            call, route_tags))
+
+    @staticmethod
+    def _raise_error(err):
+        if err.get('shouldRetry') == "true":
+            raise NextbusApiRetriableError(err.text)
+        raise NextbusApiFatalError(err.text)
+
+    @classmethod
+    def _parse_xml(cls, text):
         etree = ET.fromstring(text)
         err = etree.find('Error')
         if err is None:
             return etree
-        if err.get('shouldRetry') == "true":
-            raise NextbusApiRetriableError(err.text)
-        raise NextbusApiFatalError(err.text)
+        cls._raise_error(err)
+
+    @classmethod
+    def _iterparse_xml(cls, text, tag):
+        """ Incrementally parse the document, yielding the top level
+        elements named `tag` one at a time. Elements already yielded are
+        released, so only one of them is kept in memory.
+        """
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        events = ET.iterparse(BytesIO(text), events=('start', 'end'))
+        _, root = next(events)
+        depth = 0
+        for event, elem in events:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 0:
+                continue
+            if elem.tag == 'Error':
+                cls._raise_error(elem)
+            if elem.tag == tag:
+                yield elem
+            root.clear()
 
-    @retry((ConnectionError, NextbusApiRetriableError), tries=3, delay=10)
-    def _make_request(self, command, params={}, set_agency=True, cache_ttl=CACHE_TTL):
+    @staticmethod
+    def content_version(text):
+        """ Digest of an upstream document, identifying its content. """
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        return hashlib.sha1(text).hexdigest()
+
+    def _request_params(self, command, params=None, set_agency=True):
+        params = dict(params or {})
         if set_agency:
             params['a'] = self.agency
         params['command'] = command
+        return params
 
-        def _cached_request(endpoint, params, headers, timeout):
-            current_app.logger.info("Making HTTP request to NextbusXMLFeed: "
-                                    " {} with params {}".format(endpoint,
-                                                                params))
-            req = requests.get(endpoint, headers=headers,
-                               timeout=timeout, params=params)
-            req.raise_for_status()
-            return req
+    @staticmethod
+    def _cache_key(params):
+        return "{}:{}".format(CACHE_KEY_PREFIX,
+                              "&".join("{}={}".format(k, v) for k, v
+                                       in sorted(params.items())))
 
-        # abuse the flask-cache decorator so we can set custom ttl per request type
-        cached_request = current_app.cache.memoize(cache_ttl)(_cached_request)
+    @staticmethod
+    def _version_key(cache_key):
+        return "{}:version".format(cache_key)
+
+    def _upstream_get(self, params):
+        current_app.logger.info("Making HTTP request to NextbusXMLFeed: "
+                                " {} with params {}".format(self.endpoint,
+                                                            params))
+        command = params['command']
+        timeout = min(self.timeout, max(MIN_REQUEST_TIMEOUT,
+                                        self.deadline() - time.time()))
+        UPSTREAM_REQUESTS.inc(command)
+        start = time.time()
+        try:
+            with span('upstream'):
+                req = self.session.get(self.endpoint, headers=self.headers,
+                                       timeout=timeout, params=params)
+                req.raise_for_status()
+                text = req.text
+        except RequestException:
+            UPSTREAM_ERRORS.inc(command)
+            raise
+        finally:
+            UPSTREAM_DURATION.observe(time.time() - start, command)
+        return {'version': self.content_version(text),
+                'fetched': time.time(),
+                'text': text}
+
+    def _store(self, key, doc, cache_ttl):
+        # keep entries past their ttl, so they can be served while stale
+        timeout = cache_ttl + self.stale_ttl
+        with span('cache'):
+            current_app.cache.set(key, doc, timeout=timeout)
+            current_app.cache.set(self._version_key(key),
+                                  {'version': doc['version'],
+                                   'fetched': doc['fetched']},
+                                  timeout=timeout)
 
-        req = cached_request(self.endpoint, params,
-                             self.headers, self.timeout)
+    @staticmethod
+    def _lease_key(cache_key):
+        return "{}:lease".format(cache_key)
 
-        etree = self._parse_xml(req.text)
+    def _acquire_lease(self, key):
+        """ Take the short lived, cross worker lease for fetching the key.
+        Returns the lease token, or None if another worker holds it.
+        """
+        token = uuid.uuid4().hex
+        if current_app.redis.set(self._lease_key(key), token,
+                                 px=int(self.lease_ttl * 1000), nx=True):
+            return token
+        return None
+
+    def _release_lease(self, key, token):
+        release = current_app.redis.register_script(RELEASE_LEASE_LUA)
+        release(keys=[self._lease_key(key)], args=[token])
+
+    def _wait_for_refresh(self, key, since):
+        """ Wait for the worker holding the lease to store a document
+        fetched after `since`. Returns None if the lease is released or
+        expires without one, or the request deadline passes.
+        """
+        deadline = min(time.time() + self.lease_ttl, self.deadline())
+        while time.time() < deadline:
+            time.sleep(LEASE_POLL_INTERVAL)
+            entry = current_app.cache.get(self._version_key(key))
+            if entry is not None and entry['fetched'] >= since:
+                doc = current_app.cache.get(key)
+                if doc is not None:
+                    return doc
+            if not current_app.redis.exists(self._lease_key(key)):
+                return None
+        return None
+
+    def _rate_limit(self, command, background=False):
+        if self.rate_limiter is None:
+            return
+        with span('ratelimit'):
+            allowed = self.rate_limiter.acquire(command, self.deadline(),
+                                                background)
+        if not allowed:
+            raise NextbusApiRateLimited("upstream rate limit exceeded "
+                                        "for {}".format(command))
+
+    def _refresh(self, key, params, cache_ttl, wait=True, background=False):
+        """ Fetch the document from upstream and store it in the cache.
+
+        Only the worker holding the (redis backed) lease for the key goes
+        upstream. Other workers wait for its result, or if `wait` is False,
+        return None and keep using what they have. `background` refreshes,
+        not answering a request, use the refresh rate limits.
+        """
+        started = time.time()
+        token = self._acquire_lease(key)
+        if token is None:
+            current_app.stats.incr(STATS_UPSTREAM_COALESCED)
+            if not wait:
+                return None
+            with span('lease_wait'):
+                doc = self._wait_for_refresh(key, started)
+            if doc is not None:
+                return doc
+            logger.info("lease wait for {} timed out, fetching".format(key))
+        try:
+            self._rate_limit(params['command'], background)
+            current_app.stats.incr(STATS_UPSTREAM_FETCHES)
+            doc = self._upstream_get(params)
+            self._store(key, doc, cache_ttl)
+            return doc
+        finally:
+            if token is not None:
+                self._release_lease(key, token)
+
+    def _refresh_async(self, key, params, cache_ttl):
+        """ Refresh the cache entry on the refresh thread pool, unless a
+        refresh of it is already in flight in this process.
+        """
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        app = current_app._get_current_object()
+
+        def refresh():
+            with app.app_context():
+                try:
+                    self._refresh(key, params, cache_ttl, wait=False,
+                                  background=True)
+                except Exception:
+                    logger.exception("refreshing {} failed".format(key))
+                finally:
+                    with self._refresh_lock:
+                        self._refreshing.discard(key)
+
+        self._get_pool(background=True).apply_async(refresh)
+
+    @staticmethod
+    def _is_stale(entry, cache_ttl):
+        return time.time() - entry['fetched'] > cache_ttl
+
+    def _mark_hot(self, key, params, cache_ttl, pinned=False):
+        if params['command'] not in HOT_COMMANDS:
+            return
+        hot = self._hot.get(key)
+        self._hot[key] = (params, cache_ttl, time.time(),
+                          pinned or (hot is not None and hot[3]))
+
+    def _unmark_hot(self, command, params=None, set_agency=True):
+        key = self._cache_key(self._request_params(command, params,
+                                                   set_agency))
+        hot = self._hot.get(key)
+        if hot is not None and not hot[3]:
+            self._hot.pop(key, None)
+
+    def _fetch(self, command, params=None, set_agency=True,
+               cache_ttl=CACHE_TTL, serve_stale=True, hot=True):
+        """ Returns the raw upstream document for the given command as a
+        dict with 'version', 'fetched' and 'text' keys, going through the
+        cache. Stale documents are returned while being refreshed, unless
+        `serve_stale` is False. Only `hot` documents are kept fresh by
+        `refresh_expiring`.
+        """
+        params = self._request_params(command, params, set_agency)
+        key = self._cache_key(params)
+        if hot:
+            self._mark_hot(key, params, cache_ttl)
+        with span('cache'):
+            doc = current_app.cache.get(key)
+        if doc is None:
+            UPSTREAM_CACHE.inc(command, 'miss')
+            return self._refresh(key, params, cache_ttl)
+        if self._is_stale(doc, cache_ttl):
+            UPSTREAM_CACHE.inc(command, 'stale')
+            if not serve_stale:
+                return self._refresh(key, params, cache_ttl)
+            self._refresh_async(key, params, cache_ttl)
+        else:
+            UPSTREAM_CACHE.inc(command, 'hit')
+        return doc
+
+    def _invalidate(self, command, params=None, set_agency=True):
+        key = self._cache_key(self._request_params(command, params,
+                                                   set_agency))
+        current_app.cache.delete_many(key, self._version_key(key))
+
+    def _version(self, command, params=None, set_agency=True,
+                 cache_ttl=CACHE_TTL):
+        """ Content version of the upstream document, without fetching the
+        document itself from the cache if possible.
+        """
+        params = self._request_params(command, params, set_agency)
+        key = self._cache_key(params)
+        entry = current_app.cache.get(self._version_key(key))
+        if entry is None:
+            return self._fetch(command, params, False, cache_ttl)['version']
+        self._mark_hot(key, params, cache_ttl)
+        if self._is_stale(entry, cache_ttl):
+            self._refresh_async(key, params, cache_ttl)
+        return entry['version']
+
+    def seed_hot_requests(self):
+        """ Mark the agency list, route list and the config and schedule of
+        every route as hot, so they are kept fresh by `refresh_expiring`.
+        """
+        seeds = [(CMD_AGENCY_LIST, None, False, CACHE_TTL_LONG),
+                 (CMD_ROUTE_LIST, None, True, CACHE_TTL_LONG)]
+        for route in self.route_list().get('routes'):
+            tag = route.get('tag')
+            seeds.append((CMD_ROUTE_CONFIG, self._route_config_params(tag),
+                          True, CACHE_TTL))
+            seeds.append((CMD_ROUTE_SCHEDULE,
+                          self._route_schedule_params(tag),
+                          True, CACHE_TTL_LONG))
+        for command, params, set_agency, cache_ttl in seeds:
+            params = self._request_params(command, params, set_agency)
+            self._mark_hot(self._cache_key(params), params, cache_ttl,
+                           pinned=True)
+
+    def hot_requests(self):
+        """ Cache keys of the hot requests, with their upstream params and
+        ttl. Requests not used for `hot_ttl` seconds are dropped.
+        """
+        now = time.time()
+        for key, (params, cache_ttl, used, pinned) in list(self._hot.items()):
+            if not pinned and now - used > self.hot_ttl:
+                self._hot.pop(key, None)
+                continue
+            yield key, params, cache_ttl
+
+    def refresh_expiring(self, lead):
+        """ Refresh the hot cache entries which are missing or expire in the
+        next `lead` seconds. Returns the number of refreshed entries.
+        Entries cached for `lead` seconds or less would be refreshed on
+        every run, and are left to expire.
+        """
+        hot = [(key, params, cache_ttl) for key, params, cache_ttl
+               in self.hot_requests() if cache_ttl > lead]
+        if not hot:
+            return 0
+        entries = current_app.cache.get_many(
+            *[self._version_key(key) for key, _, _ in hot])
+        expiring = [(key, params, cache_ttl) for (key, params, cache_ttl), entry
+                    in zip(hot, entries)
+                    if entry is None or self._is_stale(entry, cache_ttl - lead)]
+
+        refreshed = 0
+        for (key, _, _), doc, error in self.fan_out(
+                lambda spec: self._refresh(*spec, wait=False,
+                                           background=True), expiring,
+                background=True):
+            if error is not None:
+                logger.warning("refreshing {} failed: {}".format(key, error))
+            elif doc is not None:
+                refreshed += 1
+        return refreshed
+
+    @retry_with_backoff(RETRIABLE_ERRORS + (NextbusApiRetriableError,))
+    def _make_request(self, command, params=None, set_agency=True,
+                      cache_ttl=CACHE_TTL, serve_stale=True, hot=True):
+        doc = self._fetch(command, params, set_agency, cache_ttl, serve_stale,
+                          hot)
+        XML_BYTES.inc(command, amount=len(doc['text']))
+        try:
+            with span('parse'):
+                return self._parse_xml(doc['text'])
+        except NextbusApiRetriableError:
+            # don't keep serving the error from the cache on retry
+            self._invalidate(command, params, set_agency)
+            raise
+        except NextbusApiFatalError:
+            # nor keep refreshing errors, e.g. for unknown route tags
+            self._unmark_hot(command, params, set_agency)
+            raise
+
+    @retry_with_backoff(RETRIABLE_ERRORS + (NextbusApiRetriableError,))
+    def _make_stream_request(self, command, tag, params=None,
+                             set_agency=True, cache_ttl=CACHE_TTL):
+        """ Like `_make_request`, but returns an iterator over the top level
+        `tag` elements of the document. The first element is parsed before
+        returning, so upstream errors are raised here and not mid-stream.
+        """
+        doc = self._fetch(command, params, set_agency, cache_ttl)
+        XML_BYTES.inc(command, amount=len(doc['text']))
+        elements = self._iterparse_xml(doc['text'], tag)
+        try:
+            first = next(elements)
+        except StopIteration:
+            return iter([])
+        except NextbusApiRetriableError:
+            self._invalidate(command, params, set_agency)
+            raise
+        except NextbusApiFatalError:
+            self._unmark_hot(command, params, set_agency)
+            raise
+        return itertools.chain([first], elements)
+
+    @staticmethod
+    def _route_config_params(route_tag=None):
+        """ Route configs are always fetched verbose, the richest variant,
+        and the other variants are derived from it.
+        """
+        params = {'verbose': True}
+        if route_tag is not None:
+            params['r'] = route_tag
+        return params
 
-        return etree
+    @staticmethod
+    def _route_schedule_params(route_tag=None):
+        params = {}
+        if route_tag is not None:
+            params['r'] = route_tag
+        return params
 
     def agency_list(self):
         etree = self._make_request(CMD_AGENCY_LIST,
                                    set_agency=False,
-                                   cache_ttl=3600)
-        return NextbusAgencyList.from_etree(etree)
+                                   cache_ttl=CACHE_TTL_LONG)
+        with span('build'):
+            return NextbusAgencyList.from_etree(etree)
+
+    def agency_list_version(self):
+        return self._version(CMD_AGENCY_LIST,
+                             set_agency=False,
+                             cache_ttl=CACHE_TTL_LONG)
 
     def route_list(self):
-        etree = self._make_request(CMD_ROUTE_LIST, cache_ttl=3600)
-        return NextbusRouteList.from_etree(etree)
+        etree = self._make_request(CMD_ROUTE_LIST, cache_ttl=CACHE_TTL_LONG)
+        with span('build'):
+            return NextbusRouteList.from_etree(etree)
 
-    def route_config(self, route_tag=None, verbose=False, terse=False):
-        params = {}
-        if route_tag is not None:
-            params['r'] = route_tag
-        if verbose is not False:
-            params['verbose'] = True
-        if terse is not False:
-            params['terse'] = True
-        etree = self._make_request(CMD_ROUTE_CONFIG, params=params)
-        return NextbusRouteConfigList.from_etree(etree)
+    def route_list_version(self):
+        return self._version(CMD_ROUTE_LIST, cache_ttl=CACHE_TTL_LONG)
 
-    def route_schedule(self, route_tag=None):
-        params = {}
-        if route_tag is not None:
-            params.update({'r': route_tag})
+    def route_config(self, route_tag=None, verbose=False, terse=False,
+                     fields=None):
+        """ Configuration of the given (or all) routes. `terse` leaves out
+        the paths, and `fields` limits the route config attributes built.
+        """
+        etree = self._make_request(CMD_ROUTE_CONFIG,
+                                   params=self._route_config_params(route_tag))
+        with span('build'):
+            return NextbusRouteConfigList.from_etree(etree, verbose, terse,
+                                                     fields)
+
+    def iter_route_config(self, route_tag=None, verbose=False, terse=False,
+                          fields=None):
+        """ Generator over the NextbusRouteConfig objects of the given (or
+        all) routes, parsed one route at a time.
+        """
+        elements = self._make_stream_request(
+            CMD_ROUTE_CONFIG, 'route',
+            params=self._route_config_params(route_tag))
+        return (NextbusRouteConfig.from_etree(e, verbose, terse, fields)
+                for e in elements)
+
+    def route_config_version(self, route_tag=None):
+        """ Content version of the route configs, the same for all their
+        variants and projections.
+        """
+        return self._version(CMD_ROUTE_CONFIG,
+                             params=self._route_config_params(route_tag))
 
+    def route_schedule(self, route_tag=None):
         etree = self._make_request(CMD_ROUTE_SCHEDULE,
-                                   params=params,
-                                   cache_ttl=3600)
-        return NextbusRouteSchedule.from_etree(etree)
+                                   params=self._route_schedule_params(route_tag),
+                                   cache_ttl=CACHE_TTL_LONG)
+        with span('build'):
+            return NextbusRouteSchedule.from_etree(etree)
+
+    def iter_route_schedule(self, route_tag=None):
+        """ Generator over the NextbusRouteSchedule objects of the given (or
+        all) routes, parsed one route at a time.
+        """
+        elements = self._make_stream_request(
+            CMD_ROUTE_SCHEDULE, 'route',
+            params=self._route_schedule_params(route_tag),
+            cache_ttl=CACHE_TTL_LONG)
+        return (NextbusRouteSchedule.from_route_etree(e) for e in elements)
+
+    def route_configs(self, route_tags, verbose=False, terse=False,
+                      fields=None):
+        """ Concurrently fetch the configuration of the given routes,
+        yielding (route_tag, NextbusRouteConfigList, error) as they complete.
+        """
+        return self.fan_out(
+            lambda tag: self.route_config(tag, verbose, terse, fields),
+            route_tags)
+
+    def route_schedules(self, route_tags):
+        """ Concurrently fetch the schedules of the given routes, yielding
+        (route_tag, [NextbusRouteSchedule, ...], error) as they complete.
+        """
+        return self.fan_out(self.route_schedule, route_tags)
+
+    def route_schedule_version(self, route_tag=None):
+        return self._version(CMD_ROUTE_SCHEDULE,
+                             params=self._route_schedule_params(route_tag),
+                             cache_ttl=CACHE_TTL_LONG)
+
+    def _predictions_key(self, stop):
+        return "{}:predictions:{}:{}:{}".format(CACHE_KEY_PREFIX, self.agency,
+                                                *stop)
+
+    @retry_with_backoff(RETRIABLE_ERRORS + (NextbusApiRetriableError,))
+    def _fetch_predictions(self, stops):
+        """ Fetch the predictions of the given (route_tag, stop_tag) stops
+        with a single upstream call, and cache them per stop. Returns the
+        XML of the predictions of each stop, by stop.
+        """
+        params = self._request_params(
+            CMD_PREDICTIONS_MULTI,
+            {'stops': ["{}|{}".format(*stop) for stop in stops]})
+        self._rate_limit(CMD_PREDICTIONS_MULTI)
+        current_app.stats.incr(STATS_UPSTREAM_FETCHES)
+        doc = self._upstream_get(params)
+        XML_BYTES.inc(CMD_PREDICTIONS_MULTI, amount=len(doc['text']))
+        with span('parse'):
+            etree = self._parse_xml(doc['text'])
+            texts = {(p.get('routeTag'), p.get('stopTag')): ET.tostring(p)
+                     for p in etree.findall('predictions')}
+        with span('cache'):
+            current_app.cache.set_many({self._predictions_key(stop): text
+                                        for stop, text in texts.items()},
+                                       timeout=self.predictions_ttl)
+        return texts
+
+    @staticmethod
+    def _build_predictions(text):
+        with span('build'):
+            return NextbusPredictions.from_etree(ET.fromstring(text))
+
+    def predictions_for_multi_stops(self, stops):
+        """ Predictions for many (route_tag, stop_tag) stops, yielding
+        (stop, NextbusPredictions, error) for each distinct stop.
+
+        Stops not in the cache are fetched with `predictionsForMultiStops`
+        calls, batched together with the stops requested concurrently by
+        other requests.
+        """
+        stops = list(collections.OrderedDict.fromkeys(stops))
+        with span('cache'):
+            cached = current_app.cache.get_many(
+                *[self._predictions_key(stop) for stop in stops])
+        missing = []
+        for stop, text in zip(stops, cached):
+            if text is None:
+                missing.append(stop)
+                continue
+            UPSTREAM_CACHE.inc(CMD_PREDICTIONS_MULTI, 'hit')
+            yield stop, self._build_predictions(text), None
+        for _ in missing:
+            UPSTREAM_CACHE.inc(CMD_PREDICTIONS_MULTI, 'miss')
+
+        timeout = max(0, self.deadline() - time.time())
+        for stop, text, error in self._predictions_batcher.get_many(missing,
+                                                                   timeout):
+            if error is None and text is None:
+                error = NextbusApiFatalError("no predictions for stop {} of "
+                                             "route {}".format(stop[1],
+                                                               stop[0]))
+            if error is not None:
+                yield stop, None, error
+            else:
+                yield stop, self._build_predictions(text), None
+
+    def predictions(self, route_tag, stop_tag):
+        """ Predictions for a single stop of a route. """
+        for _, predictions, error in self.predictions_for_multi_stops(
+                [(route_tag, stop_tag)]):
+            if error is not None:
+                raise error
+            return predictions
+
+    def stop_predictions(self, stop_id, route_tag=None):
+        """ Predictions for all routes, or the given route, serving the stop
+        with the given stopId, with a `predictions` call.
+        """
+        params = {'stopId': stop_id}
+        if route_tag is not None:
+            params['routeTag'] = route_tag
+        # predictions are only fetched on demand, never refreshed
+        etree = self._make_request(CMD_PREDICTIONS, params=params,
+                                   cache_ttl=self.predictions_ttl,
+                                   serve_stale=False, hot=False)
+        with span('build'):
+            return [NextbusPredictions.from_etree(p)
+                    for p in etree.findall('predictions')]
+
+    @retry_with_backoff(RETRIABLE_ERRORS + (NextbusApiRetriableError,))
+    def vehicle_locations(self, route_tag=None, last_time=0):
+        """ Locations of the vehicles of the given (or all) routes reported
+        since `last_time` (epoch milliseconds, 0 for the last 15 minutes).
+        Returns the NextbusVehicle objects and the time to use as
+        `last_time` for the next call. Vehicle locations are not cached.
+        """
+        params = {'t': last_time}
+        if route_tag is not None:
+            params['r'] = route_tag
+        params = self._request_params(CMD_VEHICLE_LOCATIONS, params)
+        self._rate_limit(CMD_VEHICLE_LOCATIONS)
+        current_app.stats.incr(STATS_UPSTREAM_FETCHES)
+        doc = self._upstream_get(params)
+        XML_BYTES.inc(CMD_VEHICLE_LOCATIONS, amount=len(doc['text']))
+        with span('parse'):
+            etree = self._parse_xml(doc['text'])
+        with span('build'):
+            vehicles = [NextbusVehicle.from_etree(v)
+                        for v in etree.findall('vehicle')]
+        last = etree.find('lastTime')
+        return vehicles, int(last.get('time')) if last is not None \
+            else last_time
 
 
 class NextbusObjectSerializer(JSONEncoder):
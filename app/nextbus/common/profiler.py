@@ -0,0 +1,88 @@
+import random
+import sys
+import threading
+
+__author__ = "ndenev@gmail.com"
+
+SAMPLE_INTERVAL = 0.005
+MAX_STACKS = 20
+
+
+class SamplingProfiler(object):
+    """ Statistical profiler for a single thread.
+
+    A background thread looks at the stack of the profiled thread every
+    `interval` seconds and counts the distinct stacks seen, so the profiled
+    code runs at full speed. The result is in the "collapsed" format read
+    by flamegraph tools: one "file:function:line;..." string per stack,
+    outermost frame first, with the number of samples it was seen in.
+    """
+
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        if thread_id is None:
+            thread_id = threading.current_thread().ident
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self._stacks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("{}:{}:{}".format(code.co_filename, code.co_name,
+                                           frame.f_lineno))
+            frame = frame.f_back
+        return ";".join(reversed(stack))
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = self.collapse(frame)
+        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='profiler-{}'.format(
+                                            self.thread_id))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def profile(self, max_stacks=MAX_STACKS):
+        """ The most sampled stacks, as a list of (stack, samples). """
+        stacks = sorted(self._stacks.items(), key=lambda s: s[1],
+                        reverse=True)
+        return stacks[:max_stacks]
+
+
+class RequestProfiler(object):
+    """ Profiles a random `sample_rate` fraction of the requests. Profiling
+    costs little, but the profile is only worth keeping for slow requests.
+    """
+
+    def __init__(self, sample_rate=0.0, interval=SAMPLE_INTERVAL):
+        self.sample_rate = sample_rate
+        self.interval = interval
+
+    def start(self):
+        """ A running profiler of the current thread, or None if this
+        request is not sampled.
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return SamplingProfiler(interval=self.interval).start()
@@ -0,0 +1,148 @@
+import logging
+import time
+
+__author__ = "ndenev@gmail.com"
+
+logger = logging.getLogger('ratelimit')
+
+RATELIMIT_PREFIX = 'ratelimit'
+DEFAULT_RATE = 'default'
+MAX_QUEUE_WAIT = 2.0
+REFRESH_PREFIX = 'refresh:'
+
+# Refill the bucket for the time passed since the last call, then take the
+# requested tokens if there are enough. Returns whether the tokens were
+# taken and otherwise how long until they would be available, as a string
+# since lua numbers are truncated to integers in redis replies. The time is
+# the redis server's, so the clocks of the workers don't matter.
+TOKEN_BUCKET_LUA = """
+redis.replicate_commands()
+local key, stats_key = KEYS[1], KEYS[2]
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local command = ARGV[4]
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+    allowed = 1
+    redis.call('HINCRBY', stats_key, command .. ':allowed', 1)
+else
+    wait = (requested - tokens) / rate
+    redis.call('HINCRBY', stats_key, command .. ':denied', 1)
+end
+redis.call('HMSET', key, 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+
+class RateLimiter(object):
+    """ Token bucket rate limiter shared by all workers through redis.
+
+    `rates` maps upstream commands to (requests per second, burst) tuples,
+    with the 'default' entry used for commands not listed. Background
+    refreshes take their tokens from separate `refresh_rates` buckets, if
+    given, so keeping the cache warm doesn't starve the requests missing
+    it. Every take is a single atomic script call.
+    """
+
+    def __init__(self, redis, rates, max_queue_wait=MAX_QUEUE_WAIT,
+                 refresh_rates=None):
+        self.redis = redis
+        self.rates = rates
+        self.refresh_rates = refresh_rates
+        self.max_queue_wait = max_queue_wait
+        self._script = redis.register_script(TOKEN_BUCKET_LUA)
+
+    @staticmethod
+    def _key(command):
+        return "{}:{}".format(RATELIMIT_PREFIX, command)
+
+    @staticmethod
+    def _stats_key():
+        return "{}:stats".format(RATELIMIT_PREFIX)
+
+    def _bucket(self, command, background=False):
+        """ The bucket name and its (rate, burst) for the command. """
+        rates, bucket = self.rates, command
+        if background and self.refresh_rates is not None:
+            rates, bucket = self.refresh_rates, REFRESH_PREFIX + command
+        return bucket, rates.get(command, rates[DEFAULT_RATE])
+
+    def _take(self, command, tokens=1, background=False):
+        """ Returns (allowed, seconds to wait before retrying). """
+        bucket, (rate, capacity) = self._bucket(command, background)
+        allowed, wait = self._script(keys=[self._key(bucket),
+                                           self._stats_key()],
+                                     args=[rate, capacity, tokens, bucket])
+        return bool(allowed), float(wait)
+
+    def acquire(self, command, deadline, background=False):
+        """ Take a token for an upstream `command` request. If the budget is
+        exhausted, queue for up to `max_queue_wait` seconds as long as the
+        deadline allows, otherwise shed the request by returning False.
+        Background requests are shed right away, and retried by the next
+        refresh.
+        """
+        queued = 0.0
+        while True:
+            allowed, wait = self._take(command, background=background)
+            if allowed:
+                return True
+            if (background or queued + wait > self.max_queue_wait
+                    or time.time() + wait > deadline):
+                logger.warning("rate limit for {} exhausted, "
+                               "shedding request".format(command))
+                self.redis.hincrby(self._stats_key(), "{}:shed".format(
+                    self._bucket(command, background)[0]), 1)
+                return False
+            queued += wait
+            time.sleep(wait)
+
+    def _now(self):
+        seconds, microseconds = self.redis.time()
+        return seconds + microseconds / 1000000.0
+
+    def utilization(self):
+        """ Per command bucket state and counters, with the background
+        refresh buckets named "refresh:<command>". Utilization is the
+        fraction of the burst capacity currently used.
+        """
+        buckets = [self._bucket(command) for command in sorted(self.rates)]
+        if self.refresh_rates is not None:
+            buckets += [self._bucket(command, background=True)
+                        for command in sorted(self.refresh_rates)]
+        pipe = self.redis.pipeline()
+        for bucket, _ in buckets:
+            pipe.hmget(self._key(bucket), 'tokens', 'ts')
+        pipe.hgetall(self._stats_key())
+        results = pipe.execute()
+        counters = results.pop()
+
+        now = self._now()
+        utilization = {}
+        for (bucket, (rate, capacity)), (tokens, ts) in zip(buckets, results):
+            if tokens is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, float(tokens)
+                             + max(0, now - float(ts)) * rate)
+            stats = {'rate': rate,
+                     'capacity': capacity,
+                     'tokens': round(tokens, 2),
+                     'utilization': round(1 - tokens / capacity, 4)}
+            for counter in ('allowed', 'denied', 'shed'):
+                value = counters.get("{}:{}".format(bucket, counter))
+                stats[counter] = int(value or 0)
+            utilization[bucket] = stats
+        return utilization
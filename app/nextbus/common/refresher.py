@@ -0,0 +1,50 @@
+import logging
+import threading
+import time
+
+__author__ = "ndenev@gmail.com"
+
+logger = logging.getLogger('refresher')
+
+REFRESH_INTERVAL = 10
+REFRESH_LEAD = 15
+
+
+class CacheRefresher(object):
+    """ Background thread keeping the hot upstream documents in the cache,
+    re-fetching them shortly before they expire, so request threads are
+    served from the cache instead of waiting on upstream.
+    """
+
+    def __init__(self, app, interval=REFRESH_INTERVAL, lead=REFRESH_LEAD):
+        self.app = app
+        self.interval = interval
+        self.lead = lead
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='cache-refresher')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def refresh(self):
+        with self.app.app_context():
+            api = self.app.nextbus_api
+            api.seed_hot_requests()
+            refreshed = api.refresh_expiring(self.lead)
+            if refreshed:
+                logger.info("refreshed {} cache entries".format(refreshed))
+            return refreshed
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("cache refresh failed")
+            time.sleep(self.interval)
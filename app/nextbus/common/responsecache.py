@@ -0,0 +1,115 @@
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, request, make_response
+from werkzeug.wrappers import BaseResponse
+
+from nextbus.common.encoding import ENCODERS, JSON_MIMETYPE, negotiate
+from nextbus.common.timing import span
+
+__author__ = "ndenev@gmail.com"
+
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_PREFIX = 'response'
+# Bump when the serialized output changes, so stale bodies are not served.
+RESPONSE_FORMAT_VERSION = 1
+
+
+class ResponseCache(object):
+    """ Cache of finished response bodies.
+
+    Bodies are keyed on the resource, the route tag, the query arguments,
+    the mediatype and the content version of the upstream document they
+    were built from, so they stay valid across upstream refreshes that
+    return the same data.
+    """
+
+    def __init__(self, cache, ttl=RESPONSE_CACHE_TTL):
+        self.cache = cache
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(resource, tag, args, version, mediatype=JSON_MIMETYPE):
+        query = "&".join("{}={}".format(k, v) for k, v in sorted(args))
+        return "{}:{}:{}:{}:{}:{}:{}".format(RESPONSE_CACHE_PREFIX,
+                                             RESPONSE_FORMAT_VERSION,
+                                             resource, tag or '', query,
+                                             mediatype, version)
+
+    @staticmethod
+    def etag(key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, body):
+        self.cache.set(key, body, timeout=self.ttl)
+
+    @staticmethod
+    def encode(data, mediatype=JSON_MIMETYPE):
+        return ENCODERS[mediatype](data)
+
+
+def _cached_response(body, etag, mediatype):
+    resp = make_response(body)
+    resp.mimetype = mediatype
+    resp.set_etag(etag)
+    resp.vary.add('Accept')
+    return resp
+
+
+def cached_response(meth):
+    """ Resource method decorator serving the encoded response body from
+    the response cache, and answering conditional requests with
+    304 Not Modified.
+
+    The resource must implement `upstream_version` taking the same
+    arguments as the decorated method, returning None when the response
+    should not be cached. Use it in `method_decorators`.
+    """
+    resource = meth.__self__
+
+    @wraps(meth)
+    def wrapper(*args, **kwargs):
+        version = resource.upstream_version(*args, **kwargs)
+        if version is None:
+            return meth(*args, **kwargs)
+        response_cache = current_app.response_cache
+        mediatype = negotiate(request.accept_mimetypes)
+        key = response_cache.make_key(resource.__class__.__name__,
+                                      kwargs.get('tag'),
+                                      request.args.items(multi=True),
+                                      version, mediatype)
+        etag = response_cache.etag(key)
+
+        if etag in request.if_none_match:
+            resource.counter()
+            g.cache_hit = True
+            resp = make_response('', 304)
+            resp.set_etag(etag)
+            resp.vary.add('Accept')
+            return resp
+
+        with span('cache'):
+            body = response_cache.get(key)
+        if body is not None:
+            resource.counter()
+            g.cache_hit = True
+            return _cached_response(body, etag, mediatype)
+
+        rv = meth(*args, **kwargs)
+        if isinstance(rv, BaseResponse):
+            # streamed responses are not stored, but have the same ETag
+            rv.set_etag(etag)
+            return rv
+        data, code = rv if isinstance(rv, tuple) else (rv, 200)
+        if code != 200:
+            return rv
+        with span('serialize'):
+            body = response_cache.encode(data, mediatype)
+        with span('cache'):
+            response_cache.set(key, body)
+        return _cached_response(body, etag, mediatype)
+
+    return wrapper
@@ -0,0 +1,87 @@
+from nextbus.common.nextbusapi import SCHEDULE_NO_TIME
+
+__author__ = "ndenev@gmail.com"
+
+SERVICE_INDEX_TTL = 86400
+SERVICE_INDEX_PREFIX = 'service_windows'
+DAY = 86400
+
+
+def first_bus(schedule):
+    """ Seconds since midnight of the first scheduled stop, in block order. """
+    for seconds in schedule.times:
+        if seconds != SCHEDULE_NO_TIME:
+            return seconds % DAY
+
+
+def last_bus(schedule):
+    """ Seconds since midnight of the last scheduled stop, in block order. """
+    for seconds in reversed(schedule.times):
+        if seconds != SCHEDULE_NO_TIME:
+            return seconds % DAY
+
+
+def time_in_window(start, end, x):
+    """ Check if `x` seconds since midnight falls in the service window.
+    Windows wrapping around midnight have an end before the start.
+    """
+    if start <= end:
+        return start <= x <= end
+    return start <= x or x <= end
+
+
+def build_windows(schedules):
+    """ Service windows of a route as {serviceClass: [(start, end), ...]},
+    one window per schedule (direction) with any service.
+    """
+    windows = {}
+    for schedule in schedules:
+        start, end = first_bus(schedule), last_bus(schedule)
+        if start is None:
+            continue
+        windows.setdefault(schedule.get('serviceClass'), []).append(
+            (start, end))
+    return windows
+
+
+class ServiceWindowIndex(object):
+    """ Per route and service class index of the times with service.
+
+    The windows are built once per schedule content version, and kept both
+    in the shared cache and in process memory, so checking if a route runs
+    at a given time does not need the schedule itself.
+    """
+
+    def __init__(self, cache, ttl=SERVICE_INDEX_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self._windows = {}
+
+    @staticmethod
+    def _key(route_tag, version):
+        return "{}:{}:{}".format(SERVICE_INDEX_PREFIX, route_tag, version)
+
+    def windows(self, api, route_tag):
+        version = api.route_schedule_version(route_tag)
+        local = self._windows.get(route_tag)
+        if local is not None and local[0] == version:
+            return local[1]
+
+        key = self._key(route_tag, version)
+        windows = self.cache.get(key)
+        if windows is None:
+            windows = build_windows(api.route_schedule(route_tag))
+            self.cache.set(key, windows, timeout=self.ttl)
+        self._windows[route_tag] = (version, windows)
+        return windows
+
+    def windows_many(self, api, route_tags):
+        """ Windows of many routes, with the missing ones built
+        concurrently. Yields (route_tag, windows, error) as they complete.
+        """
+        return api.fan_out(lambda tag: self.windows(api, tag), route_tags)
+
+    @staticmethod
+    def in_service(windows, service_class, seconds):
+        return any(time_in_window(start, end, seconds) for start, end
+                   in windows.get(service_class, ()))
@@ -0,0 +1,116 @@
+import atexit
+import logging
+import threading
+import time
+
+from nextbus.common import latency
+
+__author__ = "ndenev@gmail.com"
+
+logger = logging.getLogger('stats')
+
+FLUSH_INTERVAL = 1.0
+MAX_PENDING = 100
+SLOW_LOG_KEY = 'slowlog'
+SLOW_LOG_SIZE = 50
+
+
+class StatsBuffer(object):
+    """ In process buffer for the request statistics kept in redis.
+
+    Counters, latency histograms and slowlog entries are aggregated in
+    memory and written in a single pipelined round trip, every
+    `flush_interval` seconds from a background thread, or as soon as
+    `max_pending` updates are buffered.
+    A crashing worker loses at most that much statistics data.
+    """
+
+    def __init__(self, redis, flush_interval=FLUSH_INTERVAL,
+                 max_pending=MAX_PENDING, slowlog_size=SLOW_LOG_SIZE,
+                 metrics=None):
+        self.redis = redis
+        self.metrics = metrics
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.slowlog_size = slowlog_size
+        self._counters = {}
+        self._slowlog = []
+        self._latency = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+            self._pending += 1
+            full = self._pending >= self.max_pending
+        if full:
+            self.flush()
+
+    def observe(self, name, seconds, outcome=latency.MISS):
+        """ Record a request latency in the histogram of the endpoint. """
+        field = latency.field(name, outcome, latency.bucket_index(seconds))
+        key = (latency.window_start(), field)
+        with self._lock:
+            self._latency[key] = self._latency.get(key, 0) + 1
+            self._pending += 1
+            full = self._pending >= self.max_pending
+        if full:
+            self.flush()
+
+    def slowlog(self, entry, request_time):
+        """ Add a JSON encoded entry to the slowlog, scored by time taken. """
+        with self._lock:
+            self._slowlog.append((entry, request_time))
+            self._pending += 1
+            full = self._pending >= self.max_pending
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counters, self._counters = self._counters, {}
+            slowlog, self._slowlog = self._slowlog, []
+            histograms, self._latency = self._latency, {}
+            self._pending = 0
+        if (not counters and not slowlog and not histograms
+                and self.metrics is None):
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        if self.metrics is not None:
+            self.metrics.publish(pipe)
+        for name, amount in counters.items():
+            pipe.incr(name, amount)
+        windows = set()
+        for (start, field), count in histograms.items():
+            pipe.hincrby(latency.window_key(start), field, count)
+            windows.add(start)
+        for start in windows:
+            pipe.expire(latency.window_key(start), latency.RETENTION)
+        for entry, request_time in slowlog:
+            pipe.zadd(SLOW_LOG_KEY, entry, request_time)
+        if slowlog:
+            pipe.zremrangebyrank(SLOW_LOG_KEY, 0, -(self.slowlog_size + 1))
+        results = pipe.execute()
+        if slowlog and results[-1] > 0:
+            logger.info("trimming off {} slowlog entries".format(results[-1]))
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='stats-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("flushing stats failed")
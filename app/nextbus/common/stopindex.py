@@ -0,0 +1,212 @@
+import heapq
+import math
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = "ndenev@gmail.com"
+
+STOP_INDEX_TTL = 86400
+STOP_INDEX_PREFIX = 'stop_index'
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# grid cell size, in degrees of latitude and longitude
+CELL_SIZE = 0.01
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Distance in meters between two points given in degrees. """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def build_stops(route_configs):
+    """ The distinct stops of the given routes as (stopId, tag, title, lat,
+    lon, [route, ...]) tuples, with a route entry per route and direction
+    serving the stop. Stops served by many routes are told apart by their
+    stopId, or by their tag if they have none.
+    """
+    stops = {}
+    order = []
+    for route in route_configs.get('routeconfig'):
+        route_entry = {'routeTag': route.get('tag'),
+                       'routeTitle': route.get('title')}
+        directions = {}
+        for direction in route.get('direction'):
+            for stop in direction.get('stop'):
+                directions.setdefault(stop.get('tag'), []).append(
+                    dict(route_entry, directionTag=direction.get('tag'),
+                         directionTitle=direction.get('title'),
+                         directionName=direction.get('name')))
+        for stop in route.get('stop'):
+            stop_id = stop.get('stopId')
+            key = ('id', stop_id) if stop_id else ('tag', stop.get('tag'))
+            entry = stops.get(key)
+            if entry is None:
+                entry = stops[key] = (stop_id, stop.get('tag'),
+                                      stop.get('title'), stop.get('lat'),
+                                      stop.get('lon'), [])
+                order.append(key)
+            for route_stop in directions.get(stop.get('tag'), [route_entry]):
+                if route_stop not in entry[5]:
+                    entry[5].append(route_stop)
+    return [stops[stop_key] for stop_key in order]
+
+
+def index_stops(stops):
+    """ Inverted index of the stops by stopId and by tag. """
+    index = {}
+    for stop in stops:
+        if stop[1] is not None:
+            index.setdefault(stop[1], stop)
+    for stop in stops:
+        if stop[0] is not None:
+            index[stop[0]] = stop
+    return index
+
+
+def stop_data(stop):
+    stop_id, tag, title, lat, lon, routes = stop
+    route_tags = []
+    for route in routes:
+        if route['routeTag'] not in route_tags:
+            route_tags.append(route['routeTag'])
+    return {'stopId': stop_id, 'tag': tag, 'title': title, 'lat': lat,
+            'lon': lon, 'routes': route_tags}
+
+
+class SpatialIndex(object):
+    """ Uniform grid over the stop coordinates. Lookups only compute the
+    distance to the stops in the grid cells overlapping the search radius,
+    with NumPy if it's installed.
+    """
+
+    def __init__(self, stops, cell_size=CELL_SIZE):
+        self.stops = stops
+        self.cell_size = cell_size
+        self._lat = array('d', (float(stop[3]) for stop in stops))
+        self._lon = array('d', (float(stop[4]) for stop in stops))
+        self._cells = {}
+        for i, (lat, lon) in enumerate(zip(self._lat, self._lon)):
+            self._cells.setdefault(self._cell(lat, lon), []).append(i)
+        if numpy is not None:
+            self._lat_rad = numpy.radians(numpy.frombuffer(self._lat))
+            self._lon_rad = numpy.radians(numpy.frombuffer(self._lon))
+
+    def __len__(self):
+        return len(self.stops)
+
+    def _cell(self, lat, lon):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lon / self.cell_size)))
+
+    def _candidates(self, lat, lon, radius):
+        dlat = radius / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+        lat0, lon0 = self._cell(lat - dlat, lon - dlon)
+        lat1, lon1 = self._cell(lat + dlat, lon + dlon)
+        if (lat1 - lat0 + 1) * (lon1 - lon0 + 1) > len(self._cells):
+            return range(len(self.stops))
+        candidates = []
+        for x in range(lat0, lat1 + 1):
+            for y in range(lon0, lon1 + 1):
+                candidates.extend(self._cells.get((x, y), ()))
+        return candidates
+
+    def _nearest_numpy(self, lat, lon, candidates, radius, limit):
+        idx = numpy.array(candidates, dtype=numpy.intp)
+        lat_rad, lon_rad = math.radians(lat), math.radians(lon)
+        stop_lat = self._lat_rad[idx]
+        a = (numpy.sin((stop_lat - lat_rad) / 2) ** 2 +
+             math.cos(lat_rad) * numpy.cos(stop_lat) *
+             numpy.sin((self._lon_rad[idx] - lon_rad) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS * numpy.arcsin(
+            numpy.sqrt(numpy.minimum(a, 1.0)))
+        within = numpy.nonzero(distances <= radius)[0]
+        nearest = within[numpy.lexsort((idx[within],
+                                        distances[within]))][:limit]
+        return [(float(distances[i]), int(idx[i])) for i in nearest]
+
+    def _nearest_python(self, lat, lon, candidates, radius, limit):
+        found = []
+        for i in candidates:
+            distance = haversine(lat, lon, self._lat[i], self._lon[i])
+            if distance <= radius:
+                found.append((distance, i))
+        return heapq.nsmallest(limit, found)
+
+    def nearby(self, lat, lon, radius, limit):
+        """ Up to `limit` stops within `radius` meters, nearest first, as
+        (distance, stop) tuples.
+        """
+        candidates = self._candidates(lat, lon, radius)
+        if not candidates:
+            return []
+        if numpy is not None:
+            nearest = self._nearest_numpy(lat, lon, candidates, radius, limit)
+        else:
+            nearest = self._nearest_python(lat, lon, candidates, radius,
+                                           limit)
+        return [(distance, self.stops[i]) for distance, i in nearest]
+
+
+class StopIndex(object):
+    """ Spatial and inverted (by stopId and tag) indexes over the stops of
+    all routes.
+
+    The stops are collected once per route config content version, and kept
+    both in the shared cache and, indexed, in process memory, so the indexes
+    are rebuilt when the route configs are refreshed upstream.
+    """
+
+    def __init__(self, cache, ttl=STOP_INDEX_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self._indexes = None
+
+    @staticmethod
+    def _key(version):
+        return "{}:{}".format(STOP_INDEX_PREFIX, version)
+
+    def _load(self, api):
+        version = api.route_config_version()
+        local = self._indexes
+        if local is not None and local[0] == version:
+            return local
+
+        key = self._key(version)
+        stops = self.cache.get(key)
+        if stops is None:
+            stops = build_stops(api.route_config(terse=True))
+            self.cache.set(key, stops, timeout=self.ttl)
+        local = (version, SpatialIndex(stops), index_stops(stops))
+        self._indexes = local
+        return local
+
+    def index(self, api):
+        return self._load(api)[1]
+
+    def nearby(self, api, lat, lon, radius, limit):
+        """ Stops within `radius` meters of the given point, nearest first,
+        with their distance in meters and the routes serving them.
+        """
+        return [dict(stop_data(stop), distance=round(distance, 1))
+                for distance, stop
+                in self.index(api).nearby(lat, lon, radius, limit)]
+
+    def stop(self, api, stop):
+        """ The stop with the given stopId or tag, or None. """
+        stop = self._load(api)[2].get(stop)
+        return stop_data(stop) if stop is not None else None
+
+    def stop_routes(self, api, stop):
+        """ The routes and directions serving the stop with the given stopId
+        or tag, or None for unknown stops.
+        """
+        stop = self._load(api)[2].get(stop)
+        return list(stop[5]) if stop is not None else None
@@ -0,0 +1,30 @@
+import json
+
+from flask import Response
+
+from nextbus.common.nextbusapi import NextbusObjectSerializer
+
+__author__ = "ndenev@gmail.com"
+
+JSON_MIMETYPE = 'application/json'
+
+
+def stream_json_list(name, items):
+    """ Generate the JSON document `{name: [item, ...]}` chunk by chunk,
+    encoding one item at a time.
+    """
+    encoder = NextbusObjectSerializer(separators=(',', ':'))
+    yield '{{{}:['.format(json.dumps(name))
+    for i, item in enumerate(items):
+        if i:
+            yield ','
+        yield encoder.encode(item)
+    yield ']}'
+
+
+def streaming_response(name, items):
+    """ Chunked JSON response built from an iterator of NextbusObjects. """
+    resp = Response(stream_json_list(name, items), mimetype=JSON_MIMETYPE)
+    # let the frontend pass the chunks through as they are produced
+    resp.headers['X-Accel-Buffering'] = 'no'
+    return resp
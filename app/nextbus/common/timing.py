@@ -0,0 +1,63 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+__author__ = "ndenev@gmail.com"
+
+SERVER_TIMING_HEADER = 'Server-Timing'
+
+
+@contextmanager
+def span(name):
+    """ Time a stage of the current request. Time spent in the same stage
+    more than once (e.g. one parse per route) adds up. Outside of an
+    application context this does nothing.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if has_app_context():
+            spans = g.get('spans')
+            if spans is None:
+                spans = g.spans = OrderedDict()
+            spans[name] = spans.get(name, 0.0) + time.time() - start
+
+
+def add_spans(spans):
+    """ Add stage durations timed elsewhere, e.g. on a thread pool, to the
+    current request. Stages run in parallel add up.
+    """
+    if not has_app_context():
+        return
+    current = g.get('spans')
+    if current is None:
+        current = g.spans = OrderedDict()
+    for name, seconds in spans.items():
+        current[name] = current.get(name, 0.0) + seconds
+
+
+def stages():
+    """ Seconds spent in each stage of the current request. """
+    return g.get('spans') or OrderedDict()
+
+
+def server_timing(spans, total=None):
+    """ `Server-Timing` header value for the given stage durations. """
+    metrics = ["{};dur={:.1f}".format(name, seconds * 1000)
+               for name, seconds in spans.items()]
+    if total is not None:
+        metrics.append("total;dur={:.1f}".format(total * 1000))
+    return ", ".join(metrics)
+
+
+def add_server_timing(response):
+    """ after_request hook adding the `Server-Timing` header. """
+    spans = stages()
+    start = g.get('start')
+    if spans or start is not None:
+        response.headers[SERVER_TIMING_HEADER] = server_timing(
+            spans, None if start is None else time.time() - start)
+    return response
@@ -0,0 +1,117 @@
+import json
+import logging
+import time
+
+from requests.exceptions import RequestException
+
+from nextbus.common.nextbusapi import NextbusApiError, NextbusVehicle
+
+__author__ = "ndenev@gmail.com"
+
+logger = logging.getLogger('vehicles')
+
+VEHICLES_PREFIX = 'vehicles'
+ALL_ROUTES = '_all'
+# the route of each vehicle, and the routes with vehicles
+VEHICLE_ROUTES_KEY = VEHICLES_PREFIX + ':vehicle_routes'
+ROUTES_KEY = VEHICLES_PREFIX + ':routes'
+POLL_INTERVAL = 10
+# vehicles not reported for this long are dropped
+MAX_AGE = 300
+
+
+class VehicleTracker(object):
+    """ Vehicle locations per route, kept in redis and shared by all
+    workers.
+
+    Reading the vehicles of a route (or of all routes) polls upstream for
+    the locations reported since the previous poll, using the feed's `t`
+    parameter, at most once every `poll_interval` seconds across all
+    workers, and merges them into the per route state. Readers in between
+    are served from the state alone.
+    """
+
+    def __init__(self, redis, poll_interval=POLL_INTERVAL, max_age=MAX_AGE):
+        self.redis = redis
+        self.poll_interval = poll_interval
+        self.max_age = max_age
+
+    @staticmethod
+    def _key(name, route_tag=None):
+        return "{}:{}:{}".format(VEHICLES_PREFIX, name,
+                                 route_tag or ALL_ROUTES)
+
+    def poll(self, api, route_tag=None):
+        """ Merge the locations reported since the last poll of the route
+        (or of all routes). Returns the number of updated vehicles, or None
+        if the route was polled less than `poll_interval` seconds ago.
+        """
+        if not self.redis.set(self._key('poll', route_tag), 1, nx=True,
+                              px=int(self.poll_interval * 1000)):
+            return None
+        last_time = int(self.redis.get(self._key('last_time', route_tag))
+                        or 0)
+        vehicles, last_time = api.vehicle_locations(route_tag, last_time)
+        self.merge(vehicles, last_time, route_tag)
+        return len(vehicles)
+
+    def merge(self, vehicles, last_time, route_tag=None):
+        now = time.time()
+        ids = [vehicle.id for vehicle in vehicles]
+        previous = self.redis.hmget(VEHICLE_ROUTES_KEY, ids) if ids else []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for vehicle, previous_route in zip(vehicles, previous):
+            data = vehicle._data
+            data['reported'] = now - int(data.pop('secsSinceReport', 0))
+            route = data.get('routeTag') or route_tag
+            if previous_route is not None and previous_route != route:
+                # the vehicle moved to another route
+                pipe.hdel(self._key('route', previous_route), vehicle.id)
+            key = self._key('route', route)
+            pipe.hset(key, vehicle.id, json.dumps(data))
+            pipe.expire(key, self.max_age)
+            pipe.hset(VEHICLE_ROUTES_KEY, vehicle.id, route)
+            pipe.sadd(ROUTES_KEY, route)
+        pipe.set(self._key('last_time', route_tag), last_time)
+        pipe.execute()
+
+    def vehicles(self, api, route_tag=None):
+        """ The vehicles of the given (or all) routes, and the time of the
+        last upstream report merged.
+        """
+        try:
+            self.poll(api, route_tag)
+        except (NextbusApiError, RequestException) as e:
+            logger.warning("polling vehicles of {} failed: {}".format(
+                route_tag or "all routes", e))
+
+        if route_tag is not None:
+            routes = [route_tag]
+        else:
+            routes = sorted(self.redis.smembers(ROUTES_KEY))
+        pipe = self.redis.pipeline(transaction=False)
+        for route in routes:
+            pipe.hgetall(self._key('route', route))
+        pipe.get(self._key('last_time', route_tag))
+        results = pipe.execute()
+        last_time = int(results.pop() or 0)
+
+        now = time.time()
+        vehicles = []
+        expired = []
+        for route, entries in zip(routes, results):
+            for vehicle_id, entry in sorted(entries.items()):
+                data = json.loads(entry)
+                age = now - data.pop('reported')
+                if age > self.max_age:
+                    expired.append((route, vehicle_id))
+                    continue
+                data['secsSinceReport'] = str(int(age))
+                vehicles.append(NextbusVehicle(**data))
+        if expired:
+            pipe = self.redis.pipeline(transaction=False)
+            for route, vehicle_id in expired:
+                pipe.hdel(self._key('route', route), vehicle_id)
+            pipe.execute()
+        return vehicles, last_time
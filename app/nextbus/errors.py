@@ -11,5 +11,9 @@ api_error_map = {
     'ResourceNotFound': {
         'message': 'Resource not found.',
         'status': 404,
+    },
+    'NextbusApiRateLimited': {
+        'message': 'Upstream rate limit exceeded, try again later.',
+        'status': 503,
     }
 }
@@ -1,53 +1,98 @@
-from flask_restful import reqparse, Resource
+from flask_restful import inputs, reqparse, Resource
 from flask import g, request, current_app
 from socket import gethostname
-from datetime import datetime
+from datetime import datetime, timedelta
 import calendar
 
 import json
 import time
 
-from nextbus.common.nextbusapi import NextbusApiError
+from nextbus.common.nextbusapi import NextbusApiError, NextbusRouteConfig, \
+                                      NextbusApiRateLimited, \
+                                      schedule_time_text, \
+                                      STATS_UPSTREAM_FETCHES, \
+                                      STATS_UPSTREAM_COALESCED
+from nextbus.common.geometry import GEOMETRIES, GEOMETRY_POINTS
+from nextbus.common.responsecache import cached_response
+from nextbus.common.serviceindex import DAY
+from nextbus.common.streaming import streaming_response
+from nextbus.common.stats import SLOW_LOG_KEY, SLOW_LOG_SIZE
+from nextbus.common.latency import LatencyStats, HIT, MISS, RETENTION
+from nextbus.common.metrics import REQUESTS, REQUEST_DURATION
+from nextbus.common.timing import span, stages
 from nextbus.resources.exceptions import ResourceNotFound, InvalidRouteTagFormat
 
 CACHE_TTL = 30
 SLOW_THRESH = 2.0
-SLOW_LOG_SIZE = 50
+MAX_PREDICTION_STOPS = 300
+NEARBY_RADIUS = 500
+NEARBY_MAX_RADIUS = 5000
+NEARBY_LIMIT = 20
+NEARBY_MAX_LIMIT = 100
+MAX_PATH_TOLERANCE = 1000
+DEPARTURES_LIMIT = 5
+DEPARTURES_MAX_LIMIT = 50
+# seconds clients are asked to wait when the upstream budget is exhausted
+RETRY_AFTER = 1
+
+
+def before_request():
+    """ Start the request clock, before any upstream version lookups. """
+    g.start = time.time()
+    g.deadline = g.start + current_app.nextbus_api.request_budget
+    g.profiler = current_app.profiler.start()
+
+
+def add_retry_after(response):
+    """ after_request hook asking clients to retry the 503 responses, sent
+    when the upstream rate limit is exceeded, after RETRY_AFTER seconds.
+    """
+    if response.status_code == 503 and 'Retry-After' not in response.headers:
+        response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response
 
 
 def teardown_request(exception=None):
     """ We are logging slow queries here. """
+    profiler = g.get('profiler')
+    if profiler is not None:
+        profiler.stop()
     if exception is not None:
         current_app.logger.exception(exception)
         return
-    if 'start' not in g:
+    if 'stat_name' not in g:
         return
     request_time = time.time() - g.start
+    REQUESTS.inc(g.stat_name)
+    REQUEST_DURATION.observe(request_time, g.stat_name)
+    current_app.stats.observe(g.stat_name, request_time,
+                              HIT if g.get('cache_hit') else MISS)
     if request_time > SLOW_THRESH:
         current_app.logger.info("logging slow request {} time: {}".format(
                                                           request.url_rule,
                                                           request_time))
-        current_app.stats_redis.zadd('slowlog',
-                             json.dumps({'time': time.time(),
-                                         'path': request.path,
-                                         'method': request.method,
-                                         'args': request.args.to_dict(),
-                                         'remote_host': request.remote_addr,
-                                         'api_host': gethostname()}),
-                             request_time)
-
-        r = current_app.stats_redis.zremrangebyrank('slowlog', 0, -(SLOW_LOG_SIZE + 1))
-
-        if r > 0:
-            current_app.logger.info("trimming off {} slowlog entries".format(r))
+        entry = {'time': time.time(),
+                 'path': request.path,
+                 'method': request.method,
+                 'args': request.args.to_dict(),
+                 'remote_host': request.remote_addr,
+                 'api_host': gethostname(),
+                 # milliseconds spent in each stage
+                 'stages': {name: round(seconds * 1000, 1)
+                            for name, seconds in stages().items()}}
+        if profiler is not None:
+            entry['profile'] = profiler.profile()
+        current_app.stats.slowlog(json.dumps(entry), request_time)
 
 
 class NextbusApiResource(Resource):
     _display_name = None
 
     def counter(self):
-        g.start = time.time()
-        current_app.stats_redis.incr(self._display_name)
+        # set by before_request, unless called outside of a full request
+        g.setdefault('start', time.time())
+        g.stat_name = self._display_name
+        current_app.stats.incr(self._display_name)
 
 
 class ApiStats(NextbusApiResource):
@@ -57,8 +102,14 @@ class ApiStats(NextbusApiResource):
         self.counter()
         ids = [k._display_name for k in NextbusApiResource.__subclasses__()
                if k._display_name is not None]
+        # include this worker's buffered counts
+        current_app.stats.flush()
         hits = current_app.stats_redis.mget(ids)
-        return {'stats': {k: int(v) if v else 0 for k, v in zip(ids, hits)}}, 200
+        fetches, coalesced = current_app.stats_redis.mget(
+            [STATS_UPSTREAM_FETCHES, STATS_UPSTREAM_COALESCED])
+        return {'stats': {k: int(v) if v else 0 for k, v in zip(ids, hits)},
+                'upstream': {'fetches': int(fetches or 0),
+                             'coalesced': int(coalesced or 0)}}, 200
 
 
 class ApiSlowLog(NextbusApiResource):
@@ -67,7 +118,8 @@ class ApiSlowLog(NextbusApiResource):
     def get(self):
         self.counter()
         slowlog = []
-        for rj, rt in current_app.stats_redis.zrevrange('slowlog', 0,
+        current_app.stats.flush()
+        for rj, rt in current_app.stats_redis.zrevrange(SLOW_LOG_KEY, 0,
                                                 SLOW_LOG_SIZE - 1,
                                                 withscores=True):
             rd = json.loads(rj)
@@ -76,6 +128,31 @@ class ApiSlowLog(NextbusApiResource):
         return {'slowlog': slowlog}, 200
 
 
+class ApiLatency(NextbusApiResource):
+    _display_name = "stats_latency"
+
+    def get(self):
+        self.counter()
+        parser = reqparse.RequestParser()
+        parser.add_argument('window', type=int, default=300)
+        args = parser.parse_args()
+        window = max(60, min(args.window, RETENTION))
+        current_app.stats.flush()
+        report = LatencyStats(current_app.stats_redis).report(window)
+        return {'latency': report, 'window': window}, 200
+
+
+class ApiRateLimit(NextbusApiResource):
+    _display_name = "stats_ratelimit"
+
+    def get(self):
+        self.counter()
+        rate_limiter = current_app.nextbus_api.rate_limiter
+        if rate_limiter is None:
+            return {'ratelimit': {}}, 200
+        return {'ratelimit': rate_limiter.utilization()}, 200
+
+
 class ApiRoot(NextbusApiResource):
     _display_name = "root"
 
@@ -87,7 +164,11 @@ class ApiRoot(NextbusApiResource):
 
 
 class Agency(NextbusApiResource):
-    _stat_name = "agency_list"
+    _display_name = "agency_list"
+    method_decorators = [cached_response]
+
+    def upstream_version(self):
+        return current_app.nextbus_api.agency_list_version()
 
     def get(self):
         self.counter()
@@ -100,6 +181,10 @@ class Agency(NextbusApiResource):
 
 class Routes(NextbusApiResource):
     _display_name = "routes_list"
+    method_decorators = [cached_response]
+
+    def upstream_version(self):
+        return current_app.nextbus_api.route_list_version()
 
     def get(self):
         self.counter()
@@ -111,12 +196,28 @@ class Routes(NextbusApiResource):
 
 class RouteSchedule(NextbusApiResource):
     _display_name = "routes_schedule"
+    method_decorators = [cached_response]
+
+    def upstream_version(self, tag=None):
+        try:
+            return current_app.nextbus_api.route_schedule_version(tag)
+        except NextbusApiError:
+            return None
 
     def get(self, tag=None):
         self.counter()
+        parser = reqparse.RequestParser()
+        parser.add_argument('stream', type=inputs.boolean, default=False)
+        args = parser.parse_args()
         try:
+            if args.stream:
+                schedules = current_app.nextbus_api.iter_route_schedule(tag)
+                return streaming_response('schedule', schedules)
             schedule = current_app.nextbus_api.route_schedule(tag)
             return {'schedule': schedule}, 200
+        except NextbusApiRateLimited:
+            # a 503, not a client error
+            raise
         except NextbusApiError as e:
             return {'error': e.message}, 400
 
@@ -134,24 +235,6 @@ class NotInService(NextbusApiResource):
         else:
             return "sun"
 
-    @staticmethod
-    def _find_first_bus_in_schedule(schedule):
-        blocks = schedule.get('block')
-        for stop in blocks:
-            for stop_pred in stop.get('stop_prediction'):
-                stop_pred_time = stop_pred.get('time')
-                if stop_pred_time != "--":
-                    return datetime.strptime(stop_pred_time, '%H:%M:%S').time()
-
-    @staticmethod
-    def _find_last_bus_in_schedule(schedule):
-        blocks = schedule.get('block')
-        for stop in reversed(blocks):
-            for stop_pred in reversed(stop.get('stop_prediction')):
-                stop_pred_time = stop_pred.get('time')
-                if stop_pred_time != "--":
-                    return datetime.strptime(stop_pred_time, '%H:%M:%S').time()
-
     def get(self, tag=None):
         self.counter()
         parser = reqparse.RequestParser()
@@ -160,71 +243,278 @@ class NotInService(NextbusApiResource):
 
         check_time = datetime.fromtimestamp(args.get('time'))
         service_class = self._get_serviceclass(check_time)
-        check_time = check_time.time()
+        seconds = (check_time.hour * 3600 + check_time.minute * 60
+                   + check_time.second)
 
-        current_app.logger.info("THE TIME IS: {}".format(check_time))
-
-        route_availability = {}
-
-        def _time_in_range(start, end, x):
-            if start <= end:
-                return start <= x <= end
-            else:
-                return start <= x or x <= end
+        current_app.logger.info("THE TIME IS: {}".format(check_time.time()))
 
+        api = current_app.nextbus_api
         tags_to_check = []
         if tag is not None:
             tags_to_check.append(tag)
         else:
-            for route in current_app.nextbus_api.route_list().get('routes'):
-                tag = route.get('tag')
-                tags_to_check.append(tag)
-
-        for tag in tags_to_check:
-            route_availability[tag] = False
-            #tag = route.get('tag')
-            schedules = current_app.nextbus_api.route_schedule(tag)
-            service_start_times = []
-            service_end_times = []
-            for schedule in schedules:
-                if schedule.get('serviceClass') != service_class:
-                    continue
-                first_bus = self._find_first_bus_in_schedule(schedule)
-                #current_app.logger.info("first bus {} for schedule".format(first_bus))
-                service_start_times.append(first_bus)
-                last_bus = self._find_last_bus_in_schedule(schedule)
-                #current_app.logger.info("last bus {} for schedule".format(last_bus))
-                service_end_times.append(last_bus)
-                if _time_in_range(first_bus, last_bus, check_time):
-                    current_app.logger.info("There is service for route {} at {}".format(tag, check_time))
-                    route_availability[tag] = True
-
-            #current_app.logger.info('Route {} starts at {} and ends at {}'.format(tag, service_start_time, service_end_time))
-        return {'notinservice': [k for k,v in route_availability.items() if v is False]}, 200
+            for route in api.route_list().get('routes'):
+                tags_to_check.append(route.get('tag'))
+
+        service_index = current_app.service_index
+        not_in_service = []
+        errors = {}
+        with span('service_index'):
+            for route_tag, windows, error in service_index.windows_many(
+                    api, tags_to_check):
+                if error is not None:
+                    current_app.logger.warning("no schedule for route {}: "
+                                               "{}".format(route_tag, error))
+                    errors[route_tag] = str(error)
+                elif not service_index.in_service(windows, service_class,
+                                                  seconds):
+                    not_in_service.append(route_tag)
+
+        response = {'notinservice': sorted(not_in_service)}
+        if errors:
+            response['errors'] = errors
+        return response, 200
+
+
+class NextDepartures(NextbusApiResource):
+    _display_name = "next_departures"
+
+    def get(self, tag, stop):
+        self.counter()
+        parser = reqparse.RequestParser()
+        parser.add_argument('time', type=float, default=float(time.time()))
+        parser.add_argument('limit', type=int, default=DEPARTURES_LIMIT)
+        args = parser.parse_args()
+        if not 0 < args.limit <= DEPARTURES_MAX_LIMIT:
+            return {'error': "limit must be between 1 and {}".format(
+                DEPARTURES_MAX_LIMIT)}, 400
+
+        query_time = int(args.get('time'))
+        check_time = datetime.fromtimestamp(query_time)
+        seconds = (check_time.hour * 3600 + check_time.minute * 60
+                   + check_time.second)
+        # the trips of the previous service day running past midnight
+        previous = NotInService._get_serviceclass(check_time -
+                                                  timedelta(days=1))
+        days = [(NotInService._get_serviceclass(check_time), seconds),
+                (previous, seconds + DAY)]
+        try:
+            with span('departure_index'):
+                departures = current_app.departure_index.next_departures(
+                    current_app.nextbus_api, tag, stop, days, args.limit)
+        except NextbusApiRateLimited:
+            raise
+        except NextbusApiError as e:
+            return {'error': e.message}, 400
+        if departures is None:
+            raise ResourceNotFound("unknown stop {} for route {}".format(
+                stop, tag))
+        return {'departures': [{'time': schedule_time_text(departure),
+                                'timestamp': query_time + wait,
+                                'serviceClass': service_class,
+                                'direction': direction,
+                                'blockID': block_id}
+                               for wait, departure, service_class, direction,
+                               block_id in departures]}, 200
 
 
 class StopPredictions(NextbusApiResource):
     _display_name = "stop_predictions"
 
+    @staticmethod
+    def _parse_args():
+        parser = reqparse.RequestParser()
+        parser.add_argument('stops', action='append', default=[])
+        parser.add_argument('stopId')
+        parser.add_argument('routeTag')
+        return parser.parse_args()
+
     def get(self):
         self.counter()
-        return {'error': "not implemented"}
+        args = self._parse_args()
+        api = current_app.nextbus_api
+        if args.get('stopId'):
+            try:
+                return {'predictions': api.stop_predictions(
+                    args.get('stopId'), args.get('routeTag'))}, 200
+            except NextbusApiError as e:
+                return {'error': e.message}, 400
+
+        stops = []
+        for stop in args.get('stops'):
+            route_tag, sep, stop_tag = stop.partition('|')
+            if not (route_tag and sep and stop_tag):
+                return {'error': "invalid stop {}, expected "
+                                 "<route_tag>|<stop_tag>".format(stop)}, 400
+            stops.append((route_tag, stop_tag))
+        if not stops:
+            return {'error': "no stops given, use stops=<route_tag>|"
+                             "<stop_tag> or stopId=<stop_id>"}, 400
+        if len(stops) > MAX_PREDICTION_STOPS:
+            return {'error': "at most {} stops per request".format(
+                MAX_PREDICTION_STOPS)}, 400
+
+        predictions = []
+        errors = {}
+        for stop, stop_predictions, error in \
+                api.predictions_for_multi_stops(stops):
+            if error is not None:
+                errors["|".join(stop)] = str(error)
+            else:
+                predictions.append(stop_predictions)
+        response = {'predictions': predictions}
+        if errors:
+            response['errors'] = errors
+        return response, 200
 
 
-class RouteConfig(NextbusApiResource):
-    _display_name = "routes_config"
+class Vehicles(NextbusApiResource):
+    _display_name = "vehicles"
 
     def get(self, tag=None):
         self.counter()
+        vehicles, last_time = current_app.vehicles.vehicles(
+            current_app.nextbus_api, tag)
+        return {'vehicles': vehicles, 'lastTime': last_time}, 200
+
+
+class NearbyStops(NextbusApiResource):
+    _display_name = "stops_nearby"
+
+    @staticmethod
+    def _parse_args():
+        parser = reqparse.RequestParser()
+        parser.add_argument('lat', type=float, required=True)
+        parser.add_argument('lon', type=float, required=True)
+        parser.add_argument('radius', type=float, default=NEARBY_RADIUS)
+        parser.add_argument('limit', type=int, default=NEARBY_LIMIT)
+        return parser.parse_args()
+
+    def get(self):
+        self.counter()
+        args = self._parse_args()
+        if not (-90 <= args.lat <= 90 and -180 <= args.lon <= 180):
+            return {'error': "invalid coordinates"}, 400
+        if not 0 < args.radius <= NEARBY_MAX_RADIUS:
+            return {'error': "radius must be between 0 and {} "
+                             "meters".format(NEARBY_MAX_RADIUS)}, 400
+        if not 0 < args.limit <= NEARBY_MAX_LIMIT:
+            return {'error': "limit must be between 1 and {}".format(
+                NEARBY_MAX_LIMIT)}, 400
+        with span('stop_index'):
+            stops = current_app.stop_index.nearby(
+                current_app.nextbus_api, args.lat, args.lon, args.radius,
+                args.limit)
+        return {'stops': stops}, 200
+
+
+class Stop(NextbusApiResource):
+    _display_name = "stop"
+
+    def get(self, stop):
+        self.counter()
+        with span('stop_index'):
+            data = current_app.stop_index.stop(current_app.nextbus_api, stop)
+        if data is None:
+            raise ResourceNotFound("unknown stop {}".format(stop))
+        return {'stop': data}, 200
+
+
+class StopRoutes(NextbusApiResource):
+    _display_name = "stop_routes"
+
+    def get(self, stop):
+        self.counter()
+        with span('stop_index'):
+            routes = current_app.stop_index.stop_routes(
+                current_app.nextbus_api, stop)
+        if routes is None:
+            raise ResourceNotFound("unknown stop {}".format(stop))
+        return {'routes': routes}, 200
+
+
+class RouteConfig(NextbusApiResource):
+    _display_name = "routes_config"
+    method_decorators = [cached_response]
+    # plural names accepted in `fields` and `exclude`
+    _field_aliases = {'stops': 'stop', 'directions': 'direction',
+                      'paths': 'path'}
+
+    @staticmethod
+    def _parse_args():
         parser = reqparse.RequestParser()
         parser.add_argument('verbose', type=bool)
         parser.add_argument('terse', type=bool)
-        args = parser.parse_args()
+        parser.add_argument('stream', type=inputs.boolean, default=False)
+        parser.add_argument('fields', action='append')
+        parser.add_argument('exclude', action='append')
+        parser.add_argument('geometry', choices=GEOMETRIES,
+                            default=GEOMETRY_POINTS)
+        parser.add_argument('tolerance', type=float, default=0.0)
+        return parser.parse_args()
+
+    @classmethod
+    def _field_names(cls, values):
+        names = set()
+        for value in values or ():
+            for name in value.split(','):
+                name = cls._field_aliases.get(name.strip(), name.strip())
+                if name not in NextbusRouteConfig.fields:
+                    raise ValueError("unknown route config field "
+                                     "{}".format(name))
+                names.add(name)
+        return names
+
+    @classmethod
+    def _projection(cls, args):
+        """ The route config fields selected with the comma separated
+        `fields` and `exclude` arguments, or None for all of them.
+        """
+        if not args.fields and not args.exclude:
+            return None
+        fields = (cls._field_names(args.fields) if args.fields
+                  else set(NextbusRouteConfig.fields))
+        return frozenset(fields - cls._field_names(args.exclude))
+
+    def upstream_version(self, tag=None):
+        return current_app.nextbus_api.route_config_version(tag)
 
-        routes = current_app.nextbus_api.route_config(tag,
-                                                      verbose=args.verbose,
-                                                      terse=args.terse)
+    def get(self, tag=None):
+        self.counter()
+        args = self._parse_args()
+        try:
+            fields = self._projection(args)
+        except ValueError as e:
+            return {'error': str(e)}, 400
+        if not 0 <= args.tolerance <= MAX_PATH_TOLERANCE:
+            return {'error': "tolerance must be between 0 and {} "
+                             "meters".format(MAX_PATH_TOLERANCE)}, 400
+
+        api = current_app.nextbus_api
+        reshape = None
+        if args.geometry != GEOMETRY_POINTS or args.tolerance:
+            version = api.route_config_version(tag)
+            path_geometry = current_app.path_geometry
+            tolerance = round(args.tolerance, 1)
+
+            def reshape(route):
+                return path_geometry.apply(version, route, args.geometry,
+                                           tolerance)
+
+        if args.stream:
+            routes = api.iter_route_config(tag, verbose=args.verbose,
+                                           terse=args.terse, fields=fields)
+            if reshape is not None:
+                routes = (reshape(route) for route in routes)
+            return streaming_response('routeconfig', routes)
+
+        routes = api.route_config(tag, verbose=args.verbose, terse=args.terse,
+                                  fields=fields)
 
         if routes is None:
             raise ResourceNotFound
+        if reshape is not None:
+            with span('geometry'):
+                for route in routes.get('routeconfig'):
+                    reshape(route)
         return routes, 200
@@ -4,8 +4,13 @@ from flask import current_app, make_response
 from werkzeug.routing import BaseConverter, ValidationError
 from nextbus.resources import Agency, Routes, RouteConfig, \
                               RouteSchedule, StopPredictions, \
-                              ApiStats, ApiRoot, ApiSlowLog, NotInService
+                              ApiStats, ApiRoot, ApiSlowLog, NotInService, \
+                              ApiRateLimit, ApiLatency, Vehicles, \
+                              NearbyStops, Stop, StopRoutes, NextDepartures
 from nextbus.resources.exceptions import InvalidRouteTagFormat
+from nextbus.common.metrics import REGISTRY
+
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
 
 
 class RouteTagConverter(BaseConverter):
@@ -17,6 +22,13 @@ class RouteTagConverter(BaseConverter):
         return value
 
 
+def metrics():
+    """ Prometheus text exposition of the metrics of all workers. """
+    resp = make_response(REGISTRY.render(current_app.stats_redis))
+    resp.headers['Content-Type'] = METRICS_CONTENT_TYPE
+    return resp
+
+
 def setup_routing_converters(app):
     app.url_map.converters['route_tag'] = RouteTagConverter
 
@@ -26,6 +38,8 @@ def setup_router(app):
     app.api.add_resource(ApiRoot, '/')
     app.api.add_resource(ApiStats, '/stats')
     app.api.add_resource(ApiSlowLog, '/stats/slowlog')
+    app.api.add_resource(ApiRateLimit, '/stats/ratelimit')
+    app.api.add_resource(ApiLatency, '/stats/latency')
     app.api.add_resource(Agency, '/agency')
     app.api.add_resource(Routes, '/routes')
     app.api.add_resource(RouteConfig, '/routes/config',
@@ -33,6 +47,15 @@ def setup_router(app):
     """ Route schedule endpoint. """
     app.api.add_resource(RouteSchedule, '/routes/schedule',
                                         '/routes/schedule/<route_tag:tag>')
+    app.api.add_resource(NextDepartures, '/routes/schedule/<route_tag:tag>'
+                                         '/stops/<stop>/next')
     app.api.add_resource(NotInService, '/routes/notinservice',
                                        '/routes/notinservice/<route_tag:tag>')
     app.api.add_resource(StopPredictions, '/predictions')
+    app.api.add_resource(Vehicles, '/vehicles',
+                                   '/vehicles/<route_tag:tag>')
+    app.api.add_resource(NearbyStops, '/stops/nearby')
+    app.api.add_resource(Stop, '/stops/<stop>')
+    app.api.add_resource(StopRoutes, '/stops/<stop>/routes')
+    # outside of the api prefix, where scrapers look for it
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,35 @@
+"""
+Single process, gevent based server for the API. The standard library
+sockets, sleeps, threads and locks are monkey patched before anything else
+is imported, so the upstream fetches, redis cache lookups and stats writes
+yield to the other requests while waiting on I/O, instead of stalling the
+whole worker.
+
+Usage: python run_async.py
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from nextbus import create_app
+from nextbus.common.config import APP_CONFIG
+
+
+def make_server(app, host, port, max_connections):
+    """ WSGI server running each request in a greenlet, at most
+    `max_connections` at once.
+    """
+    return WSGIServer((host, port), app, spawn=Pool(max_connections))
+
+
+def main():
+    app = create_app(debug=APP_CONFIG['flask_debug'])
+    server = make_server(app, APP_CONFIG['flask_host'],
+                         APP_CONFIG['flask_port'],
+                         APP_CONFIG['async_max_connections'])
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
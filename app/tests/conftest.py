@@ -1,18 +1,36 @@
 import os
 import sys
+import gzip
 import socket
+import time
 import pytest
+import requests
 
 from flask import Flask
 from flask_restful import Api
 from flask_cache import Cache
 
+import lupa
 from mockredis import mock_redis_client
 
 sys.path.insert(0, os.path.realpath(os.path.dirname(__file__)+"/.."))
-from nextbus.common.nextbusapi import NextbusApiClient
+from nextbus.common.nextbusapi import NextbusApiClient, NextbusObjectSerializer
+from nextbus.common.responsecache import ResponseCache
+from nextbus.common.serviceindex import ServiceWindowIndex
+from nextbus.common.departures import DepartureIndex
+from nextbus.common.stopindex import StopIndex
+from nextbus.common.geometry import PathGeometry
+from nextbus.common.encoding import ENCODERS, MSGPACK_MIMETYPE, output_msgpack
+from nextbus.common.stats import StatsBuffer
+from nextbus.common.vehicles import VehicleTracker
+from nextbus.common.metrics import REGISTRY
+from nextbus.common.profiler import RequestProfiler
+from nextbus.common.timing import add_server_timing
 from nextbus.errors import api_error_map
 
+MOCK_DIR = os.path.join(os.path.realpath(os.path.dirname(__file__)),
+                                         'data/nextbus-xml')
+
 
 def sucket(*args, **kwargs):
     raise Exception("No network access during testing!")
@@ -20,21 +38,129 @@ def sucket(*args, **kwargs):
 socket.socket = sucket
 
 
+class MockResponse(object):
+    def __init__(self, *args, **kwargs):
+        assert len(args) == 1
+        assert args[0] == 'http://webservices.nextbus.com/service/publicXMLFeed'
+        self.params = kwargs.get('params', None)
+
+    def raise_for_status(self):
+        pass
+
+    def __repr__(self):
+        return "MockResponse({})".format(self.params)
+
+    @property
+    def text(self):
+        xml_file = "{}{}{}.xml.gz".format(self.params['command'],
+                                   "_r_{}".format(self.params.get('r')) if 'r' in self.params else "",
+                                   "_verbose" if 'verbose' in self.params else "")
+        return gzip.open(os.path.join(MOCK_DIR, xml_file), 'rb').read()
+
+
+class LuaScript(object):
+    """ redis-py Script run with lupa against a mockredis client, whose
+    own script support needs a system wide lua install.
+    """
+
+    def __init__(self, redis, script):
+        self.redis = redis
+        self.runtime = lupa.LuaRuntime(unpack_returned_tuples=True)
+        self.func = self.runtime.eval(
+            "function(KEYS, ARGV, redis) {} end".format(script))
+
+    def _to_lua(self, value):
+        if value is None:
+            return False
+        if isinstance(value, (list, tuple)):
+            return self.runtime.table(*[self._to_lua(v) for v in value])
+        return value
+
+    def _to_python(self, value):
+        if value is None or value is False:
+            return None
+        if value is True:
+            return 1
+        if isinstance(value, float):
+            # lua numbers are truncated to integers in redis replies
+            return int(value)
+        if lupa.lua_type(value) == 'table':
+            return [self._to_python(v) for v in value.values()]
+        return value
+
+    def call(self, command, *args):
+        command = command.lower()
+        if command == 'time':
+            return self._to_lua(self.redis.time())
+        if command == 'hmset':
+            args = (args[0], dict(zip(args[1::2], args[2::2])))
+        return self._to_lua(self.redis.call(command, *args))
+
+    def __call__(self, keys=[], args=[], client=None):
+        redis = self.runtime.table_from({
+            'call': self.call,
+            'replicate_commands': lambda: True})
+        return self._to_python(self.func(self.runtime.table(*keys),
+                                         self.runtime.table(*args), redis))
+
+
+def lua_redis_client():
+    """ mockredis client running scripts with lupa, with the server time
+    command.
+    """
+    client = mock_redis_client()
+    client.register_script = lambda script: LuaScript(client, script)
+    client.time = lambda: (int(time.time()), int(time.time() % 1 * 1000000))
+    return client
+
+
 @pytest.fixture
-def app(monkeypatch):
+def mock_get_request(monkeypatch):
+    monkeypatch.setattr(requests, 'Response', MockResponse)
+
+    def mock_get(session, *args, **kwargs):
+        return MockResponse(*args, **kwargs)
+    monkeypatch.setattr(requests.Session, 'get', mock_get)
+
+
+def make_app():
+    """ The API app, with in memory caches and redis. """
     mock_app = Flask(__name__)
     mock_app.api = Api(mock_app,
                        prefix='/api/v1',
                        errors=api_error_map,
                        catch_all_404s=True)
     mock_app.config['CACHE_TYPE'] = 'simple'
+    mock_app.config['RESTFUL_JSON'] = {'cls': NextbusObjectSerializer}
+    if MSGPACK_MIMETYPE in ENCODERS:
+        mock_app.api.representation(MSGPACK_MIMETYPE)(output_msgpack)
     mock_app.cache = Cache(mock_app)
+    mock_app.response_cache = ResponseCache(mock_app.cache)
+    mock_app.service_index = ServiceWindowIndex(mock_app.cache)
+    mock_app.departure_index = DepartureIndex(mock_app.cache)
+    mock_app.stop_index = StopIndex(mock_app.cache)
+    mock_app.path_geometry = PathGeometry(mock_app.cache)
     mock_app.testing = True
     mock_app.debug = True
 
     from nextbus.router import setup_router
     setup_router(mock_app)
+    from nextbus.resources import before_request, teardown_request, \
+                                  add_retry_after
+    mock_app.before_request(before_request)
+    mock_app.after_request(add_server_timing)
+    mock_app.after_request(add_retry_after)
+    mock_app.teardown_request(teardown_request)
     mock_app.stats_redis = mock_redis_client()
+    mock_app.stats = StatsBuffer(mock_app.stats_redis, metrics=REGISTRY)
+    mock_app.redis = lua_redis_client()
+    mock_app.profiler = RequestProfiler()
+    mock_app.vehicles = VehicleTracker(mock_app.redis)
     mock_app.nextbus_api = NextbusApiClient()
 
     return mock_app
+
+
+@pytest.fixture
+def app(monkeypatch):
+    return make_app()
@@ -0,0 +1,75 @@
+"""
+The gevent server of run_async.py. Its monkey patching is process wide, so
+the server runs in a child process, running this module.
+"""
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+APP_DIR = os.path.realpath(os.path.dirname(__file__) + "/..")
+ROUTES = ['E', 'F', 'J', 'KT', 'L']
+UPSTREAM_LATENCY = 2.0
+
+
+def serve_and_fetch():
+    """ Serves the app with run_async.make_server, in front of a fake
+    upstream answering after UPSTREAM_LATENCY, and times concurrent requests
+    for the schedules of ROUTES.
+    """
+    sys.path[:0] = [APP_DIR, os.path.join(APP_DIR, 'loadtest')]
+    import run_async
+    import socket
+    import requests
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    patched_socket = socket.socket
+    import conftest
+    # conftest bans the network, the servers here are local
+    socket.socket = patched_socket
+    from fake_upstream import FakeUpstream, FEED_PATH
+    from nextbus.common.nextbusapi import NextbusApiClient
+
+    upstream = WSGIServer(('127.0.0.1', 0),
+                          FakeUpstream(latency=UPSTREAM_LATENCY), log=None)
+    upstream.start()
+    app = conftest.make_app()
+    app.nextbus_api = NextbusApiClient(endpoint='http://127.0.0.1:{}{}'.format(
+        upstream.server_port, FEED_PATH))
+    server = run_async.make_server(app, '127.0.0.1', 0, len(ROUTES))
+    server.start()
+    url = 'http://127.0.0.1:{}/api/v1/routes/schedule/{{}}'.format(
+        server.server_port)
+
+    def fetch(route_tag):
+        resp = requests.get(url.format(route_tag))
+        return resp.status_code, [s['tag'] for s in resp.json()['schedule']]
+
+    start = time.time()
+    responses = Pool(len(ROUTES)).map(fetch, ROUTES)
+    elapsed = time.time() - start
+    server.stop()
+    upstream.stop()
+    return {'responses': responses, 'elapsed': elapsed}
+
+
+def test_concurrent_upstream_requests():
+    # requests waiting on the upstream let the others run
+    pytest.importorskip('gevent')
+    output = subprocess.check_output(
+        [sys.executable, os.path.splitext(__file__)[0] + '.py'])
+    result = json.loads(output.splitlines()[-1])
+    for route_tag, (status, tags) in zip(ROUTES, result['responses']):
+        assert status == 200
+        assert set(tags) == set([route_tag])
+    # served one after the other, the upstream round trips alone would take
+    # len(ROUTES) * UPSTREAM_LATENCY
+    assert result['elapsed'] < len(ROUTES) * UPSTREAM_LATENCY / 2
+
+
+if __name__ == '__main__':
+    print(json.dumps(serve_and_fetch()))
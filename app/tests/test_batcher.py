@@ -0,0 +1,67 @@
+import threading
+
+from nextbus.common.batcher import RequestBatcher, BatchTimeout
+
+
+def test_batcher_coalesces_concurrent_lookups():
+    calls = []
+
+    def fetch(keys):
+        calls.append(sorted(keys))
+        return {key: key.upper() for key in keys if key != 'missing'}
+
+    batcher = RequestBatcher(fetch, window=0.1)
+    results = {}
+
+    def lookup(keys):
+        for key, value, error in batcher.get_many(keys):
+            results.setdefault(key, set()).add((value, error))
+
+    threads = [threading.Thread(target=lookup, args=(keys,))
+               for keys in (['a', 'b'], ['b', 'c'], ['c', 'missing', 'a'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [['a', 'b', 'c', 'missing']]
+    assert results == {'a': {('A', None)}, 'b': {('B', None)},
+                       'c': {('C', None)}, 'missing': {(None, None)}}
+
+
+def test_batcher_max_size_and_errors():
+    calls = []
+
+    def fetch(keys):
+        calls.append(keys)
+        raise ValueError("upstream down")
+
+    batcher = RequestBatcher(fetch, window=0, max_size=2)
+    results = list(batcher.get_many(['a', 'b', 'c']))
+    assert calls == [['a', 'b'], ['c']]
+    assert sorted(key for key, _, _ in results) == ['a', 'b', 'c']
+    assert all(isinstance(error, ValueError) for _, _, error in results)
+
+    # nothing is left pending after failures
+    calls[:] = []
+    list(batcher.get_many(['a']))
+    assert calls == [['a']]
+
+
+def test_batcher_timeout():
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch(keys):
+        started.set()
+        release.wait()
+        return {}
+
+    batcher = RequestBatcher(fetch, window=0)
+    leader = threading.Thread(target=lambda: list(batcher.get_many(['a'])))
+    leader.start()
+    started.wait()
+    [(key, value, error)] = batcher.get_many(['a'], timeout=0.01)
+    release.set()
+    leader.join()
+    assert isinstance(error, BatchTimeout)
@@ -0,0 +1,72 @@
+import json
+import time
+from datetime import datetime
+
+from nextbus.common.departures import build_departures, next_departures
+from nextbus.common.nextbusapi import SCHEDULE_NO_TIME
+
+
+def scan(schedules, stop_tag, service_class, seconds):
+    """ The departures from a stop, the slow way. """
+    found = []
+    for schedule in schedules:
+        if schedule.get('serviceClass') != service_class:
+            continue
+        for i, stop in enumerate(schedule.stops):
+            if stop.tag != stop_tag:
+                continue
+            for block_id, t in zip(schedule.block_ids, schedule.column(i)):
+                if t != SCHEDULE_NO_TIME and t >= seconds:
+                    found.append((t - seconds, t, service_class,
+                                  schedule.get('direction'), block_id))
+    return sorted(found)
+
+
+def test_next_departures(mock_get_request, app):
+    with app.test_request_context('/api/v1/routes/schedule/F'):
+        schedules = app.nextbus_api.route_schedule('F')
+    departures = build_departures(schedules)
+    stop_tag = schedules[0].stops[0].tag
+    entries = departures[stop_tag]
+    assert all(times == sorted(times) for _, _, times, _ in entries)
+
+    for seconds in (0, 3600, 30000, 86399, 90000):
+        days = [('wkd', seconds)]
+        expected = scan(schedules, stop_tag, 'wkd', seconds)
+        assert next_departures(entries, days, 5) == expected[:5]
+        assert next_departures(entries, days, 100) == expected[:100]
+
+    # after midnight, the late trips of the previous service day come first
+    found = next_departures(entries, [('wkd', 1800), ('sun', 1800 + 86400)],
+                            3)
+    assert found[0][2] == 'sun' and found[0][1] > 86400
+    assert [wait for wait, _, _, _, _ in found] == \
+        sorted(wait for wait, _, _, _, _ in found)
+
+
+def test_next_departures_endpoint(monkeypatch, mock_get_request, app):
+    url = '/api/v1/routes/schedule/F/stops/{}/next'
+    with app.test_client() as c:
+        now = int(time.time())
+        resp = c.get(url.format('3311') + '?time={}&limit=3'.format(now))
+        assert resp.status_code == 200
+        departures = json.loads(resp.data)['departures']
+        assert len(departures) == 3
+        assert all(d['timestamp'] >= now for d in departures)
+        for d in departures:
+            departure = datetime.fromtimestamp(d['timestamp'])
+            assert departure.strftime('%H:%M:%S') == d['time']
+            assert d['direction'] == 'Inbound'
+
+        # known version is answered from memory, without the schedule
+        api = app.nextbus_api
+
+        def no_schedule(*args, **kwargs):
+            raise AssertionError("schedule should not be parsed")
+        monkeypatch.setattr(api, 'route_schedule', no_schedule)
+        resp = c.get(url.format('3311') + '?time={}&limit=3'.format(now))
+        assert json.loads(resp.data)['departures'] == departures
+
+        monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+        assert c.get(url.format('nosuchstop')).status_code == 404
+        assert c.get(url.format('3311') + '?limit=0').status_code == 400
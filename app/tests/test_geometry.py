@@ -0,0 +1,89 @@
+import json
+import math
+
+import pytest
+
+from nextbus.common import geometry
+from nextbus.common.geometry import decode_polyline, encode_polyline, \
+                                    simplify, METERS_PER_DEGREE
+
+
+def test_polyline():
+    # the example from the format documentation
+    lats, lons = [38.5, 40.7, 43.252], [-120.2, -120.95, -126.453]
+    text = encode_polyline(lats, lons)
+    assert text == '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+    assert decode_polyline(text) == list(zip(lats, lons))
+    assert encode_polyline([], []) == ''
+
+
+def distance_to_segment(x, y, x1, y1, x2, y2):
+    dx, dy = x2 - x1, y2 - y1
+    t = 0.0
+    if dx or dy:
+        t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) /
+                         (dx * dx + dy * dy)))
+    return math.hypot(x - x1 - t * dx, y - y1 - t * dy)
+
+
+def test_simplify(mock_get_request, app):
+    assert simplify([0.0, 0.0, 0.0], [0.0, 0.001, 0.002], 1) == [0, 2]
+    assert simplify([0.0, 0.001, 0.0], [0.0, 0.001, 0.002], 1) == [0, 1, 2]
+    assert simplify([0.0, 0.001, 0.0], [0.0, 0.001, 0.002], 0) == [0, 1, 2]
+
+    with app.test_request_context():
+        routes = app.nextbus_api.route_config()
+    points = kept = 0
+    for route in routes.get('routeconfig'):
+        for path in route.get('path'):
+            lats, lons = path.coordinates
+            keep = simplify(lats, lons, 10)
+            assert keep[0] == 0 and keep[-1] == len(lats) - 1
+            points += len(lats)
+            kept += len(keep)
+            # no dropped point strays more than the tolerance
+            cos_lat = math.cos(math.radians(sum(lats) / len(lats)))
+            xy = [(lon * cos_lat * METERS_PER_DEGREE,
+                   lat * METERS_PER_DEGREE) for lat, lon in zip(lats, lons)]
+            for first, last in zip(keep, keep[1:]):
+                for i in range(first + 1, last):
+                    assert distance_to_segment(
+                        *(xy[i] + xy[first] + xy[last])) <= 10
+    assert kept < points
+
+
+def test_route_config_geometry(monkeypatch, mock_get_request, app):
+    with app.test_client() as c:
+        points = json.loads(c.get('/api/v1/routes/config').data)
+        resp = c.get('/api/v1/routes/config?geometry=polyline')
+        assert resp.status_code == 200
+        polylines = json.loads(resp.data)
+        for route, encoded in zip(points['routeconfig'],
+                                  polylines['routeconfig']):
+            assert len(route['path']) == len(encoded['path'])
+            for path, encoded_path in zip(route['path'], encoded['path']):
+                assert sorted(encoded_path) == ['polyline', 'tag']
+                decoded = decode_polyline(encoded_path['polyline'])
+                assert len(decoded) == len(path['point'])
+                for (lat, lon), point in zip(decoded, path['point']):
+                    assert lat == pytest.approx(float(point['lat']), abs=1e-5)
+                    assert lon == pytest.approx(float(point['lon']), abs=1e-5)
+
+        simplified = c.get('/api/v1/routes/config?geometry=polyline'
+                           '&tolerance=20')
+        assert len(simplified.data) < len(resp.data) < len(json.dumps(points))
+        c.get('/api/v1/routes/config?tolerance=20')
+
+        def fail(*args):
+            raise AssertionError("geometry should come from the cache")
+        monkeypatch.setattr(geometry, 'build_geometry', fail)
+        # computed once per tolerance, whatever the rest of the request
+        resp = c.get('/api/v1/routes/config?geometry=polyline&tolerance=20'
+                     '&stream=true')
+        assert json.loads(resp.data) == json.loads(simplified.data)
+        resp = c.get('/api/v1/routes/config?tolerance=20&verbose=true')
+        routes = json.loads(resp.data)['routeconfig']
+        assert any(path['tag'] for route in routes for path in route['path'])
+
+        assert c.get('/api/v1/routes/config?geometry=svg').status_code == 400
+        assert c.get('/api/v1/routes/config?tolerance=-1').status_code == 400
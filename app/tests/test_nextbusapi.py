@@ -1,10 +1,12 @@
-import os
-import json
 import gzip
+import json
+import time
+from array import array
 
 import pytest
 import requests
 import xml.etree.ElementTree as ET
+from flask import g
 
 from nextbus.common.nextbusapi import NextbusApiClient, NextbusAgency, \
                                       NextbusAgencyList, NextbusRouteList, \
@@ -13,43 +15,20 @@ from nextbus.common.nextbusapi import NextbusApiClient, NextbusAgency, \
                                       NextbusRouteStop, NextbusDirection, \
                                       NextbusPath, NextbusPoint, \
                                       NextbusDirectionStop, \
+                                      NextbusRouteSchedule, \
                                       NextbusRouteSchedulePrediction, \
-                                      NextbusRouteScheduleBlock
+                                      NextbusRouteScheduleBlock, \
+                                      NextbusObjectSerializer, \
+                                      NextbusPredictions, \
+                                      NextbusApiFatalError, \
+                                      SCHEDULE_NO_TIME, CMD_ROUTE_LIST, \
+                                      CACHE_TTL_LONG
+from nextbus.common.backoff import BackoffPolicy, retry_with_backoff
 
 from nextbus.resources import Agency, Routes, RouteSchedule, RouteConfig
 from nextbus.resources.exceptions import InvalidRouteTagFormat
 
-MOCK_DIR = os.path.join(os.path.realpath(os.path.dirname(__file__)),
-                                         'data/nextbus-xml')
-
-
-class MockResponse(object):
-    def __init__(self, *args, **kwargs):
-        assert len(args) == 1
-        assert args[0] == 'http://webservices.nextbus.com/service/publicXMLFeed'
-        self.params = kwargs.get('params', None)
-
-    def raise_for_status(self):
-        pass
-
-    def __repr__(self):
-        return "MockResponse({})".format(self.params)
-
-    @property
-    def text(self):
-        xml_file = "{}{}.xml.gz".format(self.params['command'],
-                                   "_r_{}".format(self.params.get('r')) if 'r' in self.params else "")
-        return gzip.open(os.path.join(MOCK_DIR, xml_file), 'rb').read()
-
-
-@pytest.fixture
-def mock_get_request(monkeypatch):
-    monkeypatch.setattr(requests, 'Response', MockResponse)
-
-    def mock_get(*args, **kwargs):
-        return MockResponse(*args, **kwargs)
-    monkeypatch.setattr(requests, 'get', mock_get)
-
+from conftest import MOCK_DIR, MockResponse
 
 def test_new_client():
     assert(NextbusApiClient())
@@ -233,6 +212,52 @@ def test_route_schedule_block_obj():
     assert nrsb.get('stop_prediction') == []
 
 
+def test_route_schedule_matrix():
+    with gzip.open('{}/schedule_r_KT.xml.gz'.format(MOCK_DIR), 'rb') as f:
+        etree = ET.fromstring(f.read())
+    schedules = NextbusRouteSchedule.from_etree(etree)
+    for schedule, rt in zip(schedules, etree.findall('route')):
+        assert schedule.get('serviceClass') == rt.get('serviceClass')
+        blocks = rt.findall('tr')
+        assert schedule.block_ids == [tr.get('blockID') for tr in blocks]
+        assert len(schedule.times) == len(blocks) * len(schedule.stops)
+        # the model data is still built from the matrix as it was upstream
+        expected = [[{'tag': e.get('tag'), 'epochTime': e.get('epochTime'),
+                      'time': e.text} for e in tr.findall('stop')]
+                    for tr in blocks]
+        data = json.loads(json.dumps(schedule, cls=NextbusObjectSerializer))
+        assert [block['stop_prediction'] for block in data['block']] == \
+            expected
+        assert [stop['title'] for stop in data['header']] == \
+            [e.text for e in rt.find('header').findall('stop')]
+
+    schedule = schedules[0]
+    assert schedule.row(0) == schedule.times[:len(schedule.stops)]
+    assert schedule.column(0)[1] == schedule.times[len(schedule.stops)]
+    assert SCHEDULE_NO_TIME in schedule.times
+    # trips after midnight are past 24:00:00, their text wraps around
+    late = max(schedule.times)
+    assert late > 86400
+    assert NextbusRouteSchedule(schedule.stops[:1], ['1'], [late]).get(
+        'block')[0].get('stop_prediction')[0].get('time') == '01:26:00'
+
+    with pytest.raises(ValueError):
+        NextbusRouteSchedule(schedule.stops, ['1'], [0])
+
+    # loop routes list a stop twice, the rows are read by position
+    rt = ET.fromstring(
+        '<route tag="L"><header><stop tag="a">A</stop><stop tag="b">B</stop>'
+        '<stop tag="a">A</stop></header><tr blockID="1">'
+        '<stop tag="a" epochTime="3600000">01:00:00</stop>'
+        '<stop tag="b" epochTime="-1">--</stop>'
+        '<stop tag="a" epochTime="7200000">02:00:00</stop></tr></route>')
+    assert list(NextbusRouteSchedule.from_route_etree(rt).times) == \
+        [3600, SCHEDULE_NO_TIME, 7200]
+    rt.find('tr').remove(rt.find('tr').find('stop'))
+    with pytest.raises(NextbusApiFatalError):
+        NextbusRouteSchedule.from_route_etree(rt)
+
+
 def test_bad_object():
     with pytest.raises(ValueError):
         NextbusPoint(doesnot=False, exist=True)
@@ -252,3 +277,333 @@ def test_repr_and_str():
     p = NextbusPoint(lat="0.0", lon="1.1")
     assert repr(p) == "NextbusPoint(lat='0.0', lon='1.1')"
     assert str(p) == "NextbusPoint(lat='0.0', lon='1.1')"
+
+
+def test_iter_route_config(mock_get_request, app):
+    with app.test_request_context('/api/v1/routes/config'):
+        api = app.nextbus_api
+        routes = api.iter_route_config()
+        assert list(routes) == api.route_config().get('routeconfig')
+
+
+def test_route_config_variants(monkeypatch, mock_get_request, app):
+    def fixture(name):
+        with gzip.open('{}/{}.xml.gz'.format(MOCK_DIR, name), 'rb') as f:
+            return NextbusRouteConfigList.from_etree(ET.fromstring(f.read()))
+
+    calls = []
+    get = requests.Session.get
+    monkeypatch.setattr(requests.Session, 'get',
+                        lambda *args, **kwargs: calls.append(1) or
+                        get(*args, **kwargs))
+    with app.test_request_context('/api/v1/routes/config'):
+        api = app.nextbus_api
+        # all derived from a single verbose upstream document
+        assert api.route_config(verbose=True) == fixture('routeConfig_verbose')
+        assert api.route_config() == fixture('routeConfig')
+        assert api.route_config(terse=True) == fixture('routeConfig_terse')
+        assert len(calls) == 1
+
+        routes = api.route_config(fields=frozenset(['tag', 'stop']))
+        for route in routes.get('routeconfig'):
+            assert sorted(route._data) == ['stop', 'tag']
+
+
+def test_single_route_config_variants():
+    def fixture(name):
+        with gzip.open('{}/{}.xml.gz'.format(MOCK_DIR, name), 'rb') as f:
+            return ET.fromstring(f.read())
+
+    for tag in ['1', '61']:
+        verbose = fixture('routeConfig_r_{}_verbose'.format(tag))
+        recorded = fixture('routeConfig_r_{}'.format(tag))
+        assert verbose.findall('route/path/tag')
+        assert not recorded.findall('route/path/tag')
+        assert NextbusRouteConfigList.from_etree(verbose) != \
+            NextbusRouteConfigList.from_etree(recorded)
+        assert NextbusRouteConfigList.from_etree(verbose, verbose=False) == \
+            NextbusRouteConfigList.from_etree(recorded)
+
+    # the terse variant of a single route was never recorded, use the full one
+    terse = [r for r in fixture('routeConfig_terse').findall('route')
+             if r.get('tag') == '61']
+    assert NextbusRouteConfigList.from_etree(
+        fixture('routeConfig_r_61_verbose'), verbose=False, terse=True) == \
+        NextbusRouteConfigList([NextbusRouteConfig.from_etree(terse[0])])
+
+
+def test_iter_route_schedule_error(monkeypatch, mock_get_request, app):
+    monkeypatch.setattr(MockResponse, 'text',
+                        '<body><Error shouldRetry="false">bad</Error></body>')
+    with app.test_request_context('/api/v1/routes/schedule'):
+        with pytest.raises(NextbusApiFatalError):
+            app.nextbus_api.iter_route_schedule('F')
+
+
+def test_compact_objects():
+    p = NextbusPoint(lat="0.5", lon="1.1")
+    assert not hasattr(p, '__dict__')
+    assert p.get('get') is None
+    stop = NextbusRouteStop(tag='1', title='x')
+    assert stop.get('shortTitle') is None
+    assert 'shortTitle' not in stop._data
+
+    path = NextbusPath([p, NextbusPoint(lat="-1", lon="2.25")])
+    lats, lons = path.coordinates
+    assert isinstance(lats, array) and isinstance(lons, array)
+    assert list(lats) == [0.5, -1.0]
+    assert list(lons) == [1.1, 2.25]
+    assert len(path) == 2
+    # serialized in the shortest form of the numbers
+    assert path.get('point') == [{'lat': '0.5', 'lon': '1.1'},
+                                 {'lat': '-1.0', 'lon': '2.25'}]
+
+
+def test_route_schedules_fan_out(monkeypatch, mock_get_request, app):
+    api = app.nextbus_api
+    route_schedule = api.route_schedule
+
+    def failing_schedule(route_tag=None):
+        if route_tag == 'X':
+            raise NextbusApiFatalError("no such route")
+        return route_schedule(route_tag)
+    monkeypatch.setattr(api, 'route_schedule', failing_schedule)
+
+    with app.test_request_context('/api/v1/routes/schedule'):
+        results = {tag: (schedule, error) for tag, schedule, error
+                   in api.route_schedules(['E', 'F', 'J', 'X'])}
+        assert sorted(results) == ['E', 'F', 'J', 'X']
+        for tag in ['E', 'F', 'J']:
+            schedule, error = results[tag]
+            assert error is None
+            assert schedule == route_schedule(tag)
+        assert results['X'][0] is None
+        assert isinstance(results['X'][1], NextbusApiFatalError)
+
+
+def test_fan_out_deadline(mock_get_request, app):
+    api = app.nextbus_api
+    with app.test_request_context('/api/v1/routes/notinservice'):
+        g.deadline = time.time() + 0.5
+        deadlines = [deadline for _, deadline, _
+                     in api.fan_out(lambda tag: api.deadline(), ['E', 'F'])]
+        assert deadlines == [g.deadline, g.deadline]
+
+
+def test_stale_while_revalidate(monkeypatch, mock_get_request, app):
+    api = app.nextbus_api
+    with app.test_request_context('/api/v1/routes'):
+        params = api._request_params(CMD_ROUTE_LIST)
+        key = api._cache_key(params)
+        doc = api._fetch(CMD_ROUTE_LIST, cache_ttl=CACHE_TTL_LONG)
+        stale = dict(doc, fetched=time.time() - CACHE_TTL_LONG - 1,
+                     version='stale')
+        api._store(key, stale, CACHE_TTL_LONG)
+
+        refreshes = []
+        monkeypatch.setattr(api, '_refresh_async',
+                            lambda *args: refreshes.append(args))
+        assert api._fetch(CMD_ROUTE_LIST,
+                          cache_ttl=CACHE_TTL_LONG)['version'] == 'stale'
+        assert api.route_list_version() == 'stale'
+        assert len(refreshes) == 2
+
+        # the refresher picks up expiring hot entries
+        assert api.refresh_expiring(lead=0) == 1
+        assert api.route_list_version() == doc['version']
+
+
+def test_seed_hot_requests(mock_get_request, app):
+    api = app.nextbus_api
+    with app.test_request_context('/api/v1/routes'):
+        api.seed_hot_requests()
+        commands = sorted(params['command'] for _, params, _
+                          in api.hot_requests())
+        assert commands == ['agencyList', 'routeConfig', 'routeConfig',
+                            'routeConfig', 'routeConfig', 'routeConfig',
+                            'routeList', 'schedule', 'schedule', 'schedule',
+                            'schedule', 'schedule']
+
+
+def test_hot_requests(monkeypatch, mock_get_request, app):
+    api = app.nextbus_api
+    upstream_get = api._upstream_get
+
+    def unknown_route(params):
+        if params.get('r') != 'XX':
+            return upstream_get(params)
+        return {'version': 'error', 'fetched': time.time(),
+                'text': '<body><Error shouldRetry="false">Could not get '
+                        'route for route tag "XX".</Error></body>'}
+    monkeypatch.setattr(api, '_upstream_get', unknown_route)
+    with app.test_request_context('/api/v1/routes/config'):
+        api.route_config('1')
+        with pytest.raises(NextbusApiFatalError):
+            api.route_config('XX')
+        api.stop_predictions('13909')
+        # only the documents the refresher keeps warm, and no errors
+        assert [(params['command'], params.get('r')) for _, params, _
+                in api.hot_requests()] == [('routeConfig', '1')]
+
+        # refreshes run on their own pool, the request one stays free
+        assert api._get_pool(background=True) is not api._get_pool()
+        pools = []
+        get_pool = api._get_pool
+
+        def recording_pool(background=False):
+            pools.append(background)
+            return get_pool(background)
+        monkeypatch.setattr(api, '_get_pool', recording_pool)
+        assert sorted(tag for tag, _, _ in api.fan_out(
+            lambda tag: tag, ['E', 'F'], background=True)) == ['E', 'F']
+    assert pools == [True]
+
+
+def test_single_flight(monkeypatch, mock_get_request, app):
+    api = app.nextbus_api
+    monkeypatch.setattr(api, 'lease_ttl', 0.5)
+    with app.test_request_context('/api/v1/routes'):
+        params = api._request_params(CMD_ROUTE_LIST)
+        key = api._cache_key(params)
+
+        # another worker holds the lease
+        app.redis.set(api._lease_key(key), 'other', px=500)
+        assert api._refresh(key, params, 60, wait=False) is None
+        app.stats.flush()
+        assert app.stats_redis.get('upstream_coalesced') == '1'
+
+        # the other worker's result is used
+        doc = {'version': 'other', 'fetched': time.time() + 1, 'text': ''}
+        api._store(key, doc, 60)
+        assert api._refresh(key, params, 60) == doc
+        assert app.stats_redis.get('upstream_fetches') is None
+
+        # lease expired without a result, fetch ourselves
+        app.cache.clear()
+        app.redis.set(api._lease_key(key), 'other', px=500)
+        assert api._refresh(key, params, 60)['version'] != 'other'
+        app.stats.flush()
+        assert app.stats_redis.get('upstream_fetches') == '1'
+
+        # a lease taken over by another worker is not released
+        app.redis.set(api._lease_key(key), 'other', px=500)
+        api._release_lease(key, 'expired')
+        assert app.redis.get(api._lease_key(key)) == 'other'
+        api._release_lease(key, 'other')
+        assert app.redis.get(api._lease_key(key)) is None
+
+        # the wait for another worker ends with the request deadline
+        app.redis.set(api._lease_key(key), 'other', px=500)
+        g.deadline = time.time() + 0.1
+        started = time.time()
+        assert api._wait_for_refresh(key, started) is None
+        assert time.time() - started < 0.3
+
+
+def test_retry_with_backoff(monkeypatch):
+    class Flaky(object):
+        def __init__(self, backoff, budget):
+            self.backoff = backoff
+            self.budget = budget
+            self.calls = 0
+
+        def deadline(self):
+            return time.time() + self.budget
+
+        @retry_with_backoff((IOError,))
+        def call(self):
+            self.calls += 1
+            raise IOError("flaky")
+
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+
+    flaky = Flaky(BackoffPolicy(tries=3, base_delay=0.1, max_delay=0.15), 10)
+    with pytest.raises(IOError):
+        flaky.call()
+    assert flaky.calls == 3
+    assert len(sleeps) == 2
+    assert all(0 <= s <= 0.15 for s in sleeps)
+
+    # no retries past the deadline
+    monkeypatch.setattr('random.uniform', lambda a, b: b)
+    flaky = Flaky(BackoffPolicy(tries=3, base_delay=5, max_delay=5), 1)
+    with pytest.raises(IOError):
+        flaky.call()
+    assert flaky.calls == 1
+
+
+def test_upstream_retriable_error(monkeypatch, mock_get_request, app):
+    monkeypatch.setattr(time, 'sleep', lambda s: None)
+    responses = ['<body><Error shouldRetry="true">busy</Error></body>',
+                 '<body><agency tag="x" title="X"/></body>']
+    monkeypatch.setattr(MockResponse, 'text',
+                        property(lambda self: responses.pop(0)))
+    with app.test_request_context('/api/v1/agency'):
+        agencies = app.nextbus_api.agency_list()
+        assert agencies.get('agency')[0].get('tag') == 'x'
+
+
+def test_predictions_for_multi_stops(monkeypatch, mock_get_request, app):
+    api = app.nextbus_api
+    calls = []
+    session_get = requests.Session.get
+
+    def counting_get(session, *args, **kwargs):
+        calls.append(kwargs['params'])
+        return session_get(session, *args, **kwargs)
+    monkeypatch.setattr(requests.Session, 'get', counting_get)
+
+    stops = [('N', '3909'), ('1', '3892'), ('N', '3909'), ('N', '9999')]
+    with app.test_request_context('/api/v1/predictions'):
+        results = {stop: (predictions, error) for stop, predictions, error
+                   in api.predictions_for_multi_stops(stops)}
+        assert len(calls) == 1
+        assert calls[0]['stops'] == ['N|3909', '1|3892', 'N|9999']
+
+        predictions, error = results[('N', '3909')]
+        assert error is None
+        assert isinstance(predictions, NextbusPredictions)
+        assert predictions.get('stopTitle') == 'Carl St & Cole St'
+        direction = predictions.get('direction')[0]
+        assert direction.get('title') == 'Outbound to Ocean Beach'
+        assert [p.minutes for p in direction.get('prediction')] == \
+            ['3', '10', '22']
+        assert predictions.get('message')[0].priority == 'Normal'
+        assert isinstance(results[('N', '9999')][1], NextbusApiFatalError)
+
+        # cached per stop, including stops returned but not asked for
+        assert api.predictions('N', '4447').get(
+            'dirTitleBecauseNoPredictions') == 'Outbound to Ocean Beach'
+        assert api.predictions('1', '3892') == results[('1', '3892')][0]
+        assert len(calls) == 1
+
+
+def test_stop_predictions(mock_get_request, app):
+    api = app.nextbus_api
+    with app.test_request_context('/api/v1/predictions'):
+        predictions = api.stop_predictions('13909')
+    assert [p.get('routeTag') for p in predictions] == ['N', 'N_OWL']
+    assert predictions[1].get('direction') == []
+
+
+def test_predictions_not_refreshed(monkeypatch, mock_get_request, app):
+    api = app.nextbus_api
+    upstream_get = api._upstream_get
+    fetched = []
+
+    def counting_get(params):
+        fetched.append(params['command'])
+        return upstream_get(params)
+    monkeypatch.setattr(api, '_upstream_get', counting_get)
+    with app.test_request_context('/api/v1/predictions'):
+        api.stop_predictions('13909')
+        assert fetched == ['predictions']
+        assert list(api.hot_requests()) == []
+        for _ in range(3):
+            assert api.refresh_expiring(15) == 0
+        # nor is anything cached for less than the refresh lead
+        params = api._request_params('predictions', {'stopId': '13909'})
+        api._mark_hot(api._cache_key(params), params, api.predictions_ttl)
+        assert api.refresh_expiring(15) == 0
+    assert fetched == ['predictions']
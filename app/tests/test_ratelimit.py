@@ -0,0 +1,79 @@
+import time
+
+import pytest
+from mockredis import mock_redis_client
+
+from conftest import lua_redis_client
+from nextbus.common.ratelimit import RateLimiter
+from nextbus.common.nextbusapi import NextbusApiRateLimited
+
+RATES = {'default': (1.0, 2), 'schedule': (0.5, 1)}
+REFRESH_RATES = {'default': (1.0, 2), 'schedule': (0.1, 1)}
+
+
+def test_acquire_queues_then_sheds(monkeypatch):
+    limiter = RateLimiter(mock_redis_client(), RATES, max_queue_wait=1.0)
+    takes = [(False, 0.4), (False, 0.4), (True, 0.0)]
+    monkeypatch.setattr(limiter, '_take', lambda command, background=False: takes.pop(0))
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+
+    assert limiter.acquire('schedule', time.time() + 10)
+    assert sleeps == [0.4, 0.4]
+
+    # queueing would pass the request deadline
+    monkeypatch.setattr(limiter, '_take', lambda command, background=False: (False, 5.0))
+    assert not limiter.acquire('schedule', time.time() + 10)
+    assert limiter.redis.hgetall('ratelimit:stats') == {'schedule:shed': '1'}
+
+
+def test_token_bucket_script():
+    redis = lua_redis_client()
+    clock = [1000000.0]
+    redis.time = lambda: (int(clock[0]), int(clock[0] % 1 * 1000000))
+    limiter = RateLimiter(redis, RATES, refresh_rates=REFRESH_RATES)
+    assert limiter._take('routeConfig') == (True, 0.0)
+    assert limiter._take('routeConfig')[0]
+    allowed, wait = limiter._take('routeConfig')
+    assert not allowed and wait == 1.0
+    assert limiter.utilization()['default']['utilization'] == 0
+
+    # refilled by the redis server time, whatever the client clock says
+    assert limiter._take('schedule') == (True, 0.0)
+    assert limiter._take('schedule') == (False, 2.0)
+    clock[0] += 1
+    assert limiter._take('schedule') == (False, 1.0)
+    clock[0] += 1
+    assert limiter._take('schedule') == (True, 0.0)
+
+    # background refreshes have their own budget, and don't queue
+    assert limiter.acquire('schedule', time.time() + 10, background=True)
+    assert not limiter.acquire('schedule', time.time() + 10, background=True)
+    utilization = limiter.utilization()
+    assert utilization['schedule']['allowed'] == 2
+    assert utilization['schedule']['utilization'] == 1
+    assert utilization['refresh:schedule']['allowed'] == 1
+    assert utilization['refresh:schedule']['shed'] == 1
+
+
+def test_client_sheds_upstream_request(monkeypatch, mock_get_request, app):
+    api = app.nextbus_api
+    limiter = RateLimiter(mock_redis_client(), RATES)
+    monkeypatch.setattr(limiter, 'acquire', lambda command, deadline, background=False: False)
+    monkeypatch.setattr(api, 'rate_limiter', limiter)
+
+    with app.test_request_context('/api/v1/routes'):
+        with pytest.raises(NextbusApiRateLimited):
+            api.route_list()
+
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+    with app.test_client() as c:
+        resp = c.get('/api/v1/routes')
+        assert resp.status_code == 503
+        assert resp.headers['Retry-After'] == '1'
+        # not a client error on the resources answering upstream errors
+        for path in ('/api/v1/routes/schedule/F',
+                     '/api/v1/routes/schedule/F/stops/3311/next'):
+            resp = c.get(path)
+            assert resp.status_code == 503
+            assert resp.headers['Retry-After'] == '1'
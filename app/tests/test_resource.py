@@ -1 +1,193 @@
+import json
+
 import pytest
+import requests
+
+from nextbus.common.serviceindex import time_in_window
+
+
+def test_route_config_etag(mock_get_request, app):
+    with app.test_client() as c:
+        resp = c.get('/api/v1/routes/config/1')
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/json'
+        etag, weak = resp.get_etag()
+        assert etag and not weak
+        data = json.loads(resp.data)
+        assert data['routeconfig'][0]['tag'] == '1'
+
+        resp = c.get('/api/v1/routes/config/1',
+                     headers={'If-None-Match': '"{}"'.format(etag)})
+        assert resp.status_code == 304
+        assert resp.data == b''
+
+
+def test_route_config_cached_body(monkeypatch, mock_get_request, app):
+    with app.test_client() as c:
+        first = c.get('/api/v1/routes/config/1')
+        # different query args are cached separately
+        other = c.get('/api/v1/routes/config/1?terse=1')
+        assert other.get_etag() != first.get_etag()
+
+        def no_get(*args, **kwargs):
+            raise AssertionError("upstream should not be called")
+        monkeypatch.setattr(requests.Session, 'get', no_get)
+
+        second = c.get('/api/v1/routes/config/1')
+        assert second.status_code == 200
+        assert second.data == first.data
+        assert second.get_etag() == first.get_etag()
+
+
+def test_route_config_etag_follows_upstream(monkeypatch, mock_get_request,
+                                            app):
+    with app.test_client() as c:
+        first = c.get('/api/v1/routes/config/1')
+        app.cache.clear()
+        # same upstream content after a refresh keeps the same ETag
+        second = c.get('/api/v1/routes/config/1')
+        assert second.get_etag() == first.get_etag()
+
+        monkeypatch.setattr(app.nextbus_api, 'content_version',
+                            lambda text: 'changed')
+        app.cache.clear()
+        third = c.get('/api/v1/routes/config/1')
+        assert third.get_etag() != first.get_etag()
+
+
+def test_route_config_stream(mock_get_request, app):
+    with app.test_client() as c:
+        resp = c.get('/api/v1/routes/config?stream=true')
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        assert resp.headers.get('Content-Length') is None
+        streamed = json.loads(resp.data)
+
+        resp = c.get('/api/v1/routes/config')
+        assert json.loads(resp.data) == streamed
+        assert len(streamed['routeconfig']) > 1
+
+
+def test_route_config_projection(mock_get_request, app):
+    with app.test_client() as c:
+        full = json.loads(c.get('/api/v1/routes/config/1').data)
+        full = full['routeconfig'][0]
+        resp = c.get('/api/v1/routes/config/1?exclude=paths')
+        route = json.loads(resp.data)['routeconfig'][0]
+        assert 'path' not in route
+        assert route == {k: v for k, v in full.items() if k != 'path'}
+
+        resp = c.get('/api/v1/routes/config/1?fields=tag,title&fields=stops')
+        route = json.loads(resp.data)['routeconfig'][0]
+        assert route == {k: full[k] for k in ('tag', 'title', 'stop')}
+
+        resp = c.get('/api/v1/routes/config/1?fields=tag,title&stream=1')
+        route = json.loads(resp.data)['routeconfig'][0]
+        assert route == {'tag': '1', 'title': '1-California'}
+
+        resp = c.get('/api/v1/routes/config/1?exclude=bogus')
+        assert resp.status_code == 400
+
+
+def test_route_schedule_stream(mock_get_request, app):
+    with app.test_client() as c:
+        resp = c.get('/api/v1/routes/schedule/F?stream=1')
+        assert resp.status_code == 200
+        streamed = json.loads(resp.data)
+
+        resp = c.get('/api/v1/routes/schedule/F')
+        assert json.loads(resp.data) == streamed
+
+
+def test_service_index(monkeypatch, mock_get_request, app):
+    assert time_in_window(3600, 7200, 3600)
+    assert not time_in_window(3600, 7200, 7201)
+    assert time_in_window(80000, 3600, 1800)
+    assert not time_in_window(18000, 82800, 1800)
+
+    with app.test_request_context('/api/v1/routes/notinservice'):
+        api = app.nextbus_api
+        windows = app.service_index.windows(api, 'E')
+        assert set(windows) <= set(['wkd', 'sat', 'sun'])
+        assert all(s <= e for w in windows.values() for s, e in w)
+
+        # known version is answered from memory, without the schedule
+        def no_schedule(*args, **kwargs):
+            raise AssertionError("schedule should not be parsed")
+        monkeypatch.setattr(api, 'route_schedule', no_schedule)
+        assert app.service_index.windows(api, 'E') == windows
+
+        # and from the shared cache in a fresh process
+        app.service_index._windows.clear()
+        assert app.service_index.windows(api, 'E') == windows
+
+
+def test_predictions(mock_get_request, app):
+    with app.test_client() as c:
+        resp = c.get('/api/v1/predictions?stops=N|3909&stops=1|3892'
+                     '&stops=N|9999')
+        assert resp.status_code == 200
+        data = json.loads(resp.data)
+        assert [(p['routeTag'], p['stopTag']) for p in data['predictions']] \
+            == [('N', '3909'), ('1', '3892')]
+        assert list(data['errors']) == ['N|9999']
+
+        resp = c.get('/api/v1/predictions?stopId=13909')
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)['predictions']) == 2
+
+        assert c.get('/api/v1/predictions').status_code == 400
+        assert c.get('/api/v1/predictions?stops=3909').status_code == 400
+
+
+def test_msgpack(mock_get_request, app):
+    msgpack = pytest.importorskip('msgpack')
+    headers = {'Accept': 'application/x-msgpack'}
+    with app.test_client() as c:
+        as_json = c.get('/api/v1/routes/config/1')
+        resp = c.get('/api/v1/routes/config/1', headers=headers)
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/x-msgpack'
+        assert 'Accept' in resp.headers['Vary']
+        # cached and revalidated separately from the JSON encoding
+        etag, _ = resp.get_etag()
+        assert etag != as_json.get_etag()[0]
+        assert msgpack.unpackb(resp.data, encoding='utf-8') == \
+            json.loads(as_json.data)
+        cached = c.get('/api/v1/routes/config/1', headers=headers)
+        assert cached.data == resp.data
+        assert c.get('/api/v1/routes/config/1', headers=dict(
+            headers, **{'If-None-Match': '"{}"'.format(etag)})
+                     ).status_code == 304
+
+        # and on the resources that aren't cached
+        resp = c.get('/api/v1/predictions?stops=N|3909', headers=headers)
+        assert resp.mimetype == 'application/x-msgpack'
+        assert msgpack.unpackb(resp.data, encoding='utf-8') == json.loads(
+            c.get('/api/v1/predictions?stops=N|3909').data)
+        resp = c.get('/api/v1/routes/config/1',
+                     headers={'Accept': 'application/json, */*'})
+        assert resp.mimetype == 'application/json'
+
+
+def test_malformed_schedule(monkeypatch, mock_get_request, app):
+    get = requests.Session.get
+
+    def malformed_get(session, *args, **kwargs):
+        resp = get(session, *args, **kwargs)
+        text = resp.text
+        # drop the first stop of the first block
+        start = text.index('<stop', text.index('<tr '))
+        text = text[:start] + text[text.index('</stop>', start) + 7:]
+        resp = type('MalformedResponse', (object,), {
+            'text': text, 'raise_for_status': lambda self: None})()
+        return resp
+    monkeypatch.setattr(requests.Session, 'get', malformed_get)
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+    with app.test_client() as c:
+        resp = c.get('/api/v1/routes/schedule/F')
+        assert resp.status_code == 400
+        assert 'do not match the schedule header' in \
+            json.loads(resp.data)['error']
+        resp = c.get('/api/v1/routes/schedule/F/stops/3311/next')
+        assert resp.status_code == 400
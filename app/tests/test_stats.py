@@ -0,0 +1,167 @@
+import json
+import time
+
+from mockredis import mock_redis_client
+
+from nextbus.common import latency
+from nextbus.common.stats import StatsBuffer
+from nextbus.common.metrics import Registry, METRICS_KEY
+
+
+def test_stats_buffer():
+    redis = mock_redis_client()
+    stats = StatsBuffer(redis, max_pending=1000, slowlog_size=2)
+    for _ in range(3):
+        stats.incr('routes_list')
+    stats.incr('stats', 2)
+    for i in range(3):
+        stats.slowlog(json.dumps({'path': str(i)}), 2.0 + i)
+    assert redis.get('routes_list') is None
+
+    stats.flush()
+    assert redis.get('routes_list') == '3'
+    assert redis.get('stats') == '2'
+    assert [json.loads(e)['path'] for e in redis.zrevrange('slowlog', 0, -1)] \
+        == ['2', '1']
+
+    stats.flush()
+    assert redis.get('routes_list') == '3'
+
+
+def test_stats_buffer_max_pending():
+    redis = mock_redis_client()
+    stats = StatsBuffer(redis, max_pending=2)
+    stats.incr('root')
+    assert redis.get('root') is None
+    stats.incr('root')
+    assert redis.get('root') == '2'
+
+
+def test_stats_endpoint(mock_get_request, app):
+    with app.test_client() as c:
+        c.get('/api/v1/routes')
+        c.get('/api/v1/routes')
+        resp = c.get('/api/v1/stats')
+        data = json.loads(resp.data)
+        assert data['stats']['routes_list'] == 2
+        assert data['stats']['stats'] == 1
+
+
+def test_latency_histograms():
+    redis = mock_redis_client()
+    stats = StatsBuffer(redis, max_pending=1000)
+    for _ in range(98):
+        stats.observe('routes_config', 0.010, latency.HIT)
+    stats.observe('routes_config', 0.5, latency.MISS)
+    stats.observe('routes_config', 3.0, latency.MISS)
+    stats.flush()
+
+    report = latency.LatencyStats(redis).report(window=60)
+    endpoint = report['routes_config']
+    assert endpoint['hit']['count'] == 98
+    assert endpoint['miss']['count'] == 2
+    assert endpoint['all']['count'] == 100
+    assert 10 <= endpoint['all']['p50'] <= 12
+    assert 500 <= endpoint['all']['p99'] <= 600
+    assert endpoint['miss']['p99'] >= 3000
+
+    # windows outside of the requested range are not included
+    assert latency.LatencyStats(redis).report(
+        window=60, now=time.time() + 120) == {}
+
+
+def test_latency_endpoint(mock_get_request, app):
+    with app.test_client() as c:
+        c.get('/api/v1/routes/config/1')
+        c.get('/api/v1/routes/config/1')
+        resp = c.get('/api/v1/stats/latency?window=120')
+        data = json.loads(resp.data)
+        assert data['window'] == 120
+        config = data['latency']['routes_config']
+        assert config['hit']['count'] == 1
+        assert config['miss']['count'] == 1
+
+
+def test_metrics_registry():
+    redis = mock_redis_client()
+    registry = Registry()
+    requests = registry.counter('requests', 'Requests.', ['resource'])
+    duration = registry.histogram('duration_seconds', 'Latency.',
+                                  buckets=(0.1, 1.0))
+    requests.inc('routes')
+    requests.inc('routes', amount=2)
+    duration.observe(0.05)
+    duration.observe(0.5)
+    # another worker's snapshot is summed in
+    redis.hset(METRICS_KEY, 'otherhost:1', json.dumps(
+        {'time': time.time(),
+         'metrics': {'requests': [[['routes'], 4], [['agency'], 1]]}}))
+    # and a dead worker's is dropped
+    redis.hset(METRICS_KEY, 'otherhost:2', json.dumps(
+        {'time': time.time() - 3600,
+         'metrics': {'requests': [[['routes'], 100]]}}))
+
+    lines = registry.render(redis).splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{resource="routes"} 7' in lines
+    assert 'requests_total{resource="agency"} 1' in lines
+    assert 'duration_seconds_bucket{le="0.1"} 1' in lines
+    assert 'duration_seconds_bucket{le="1.0"} 2' in lines
+    assert 'duration_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'duration_seconds_count 2' in lines
+    assert redis.hkeys(METRICS_KEY) == ['otherhost:1']
+
+
+def parse_exposition(text):
+    """ {family: (type, {sample name: [(labels, value), ...]})} of a text
+    exposition, checking that each sample follows the TYPE of its family.
+    """
+    families = {}
+    suffixes = {'counter': ('',), 'gauge': ('',),
+                'histogram': ('_bucket', '_sum', '_count')}
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            _, _, family, kind = line.split(' ')
+            assert family not in families
+            families[family] = (kind, {})
+            continue
+        sample, value = line.rsplit(' ', 1)
+        name, _, labels = sample.partition('{')
+        for family, (kind, samples) in families.items():
+            if any(name == family + suffix for suffix in suffixes[kind]):
+                samples.setdefault(name, []).append((labels.rstrip('}'),
+                                                     float(value)))
+                break
+        else:
+            raise AssertionError("{} has no TYPE line".format(name))
+    return families
+
+
+def test_metrics_endpoint(mock_get_request, app):
+    with app.test_client() as c:
+        c.get('/api/v1/routes')
+        c.get('/api/v1/routes')
+        app.stats.flush()
+        assert app.stats_redis.hkeys(METRICS_KEY) == [Registry.worker_id()]
+        resp = c.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    body = resp.get_data(as_text=True)
+    assert 'nextbus_requests_total{resource="routes_list"}' in body
+    assert 'nextbus_upstream_requests_total{command="routeList"}' in body
+    assert 'nextbus_upstream_cache_requests_total' \
+           '{command="routeList",result="miss"}' in body
+    assert 'nextbus_objects_built_total{type="NextbusRoute"}' in body
+
+    families = parse_exposition(body)
+    kind, samples = families['nextbus_requests_total']
+    assert kind == 'counter'
+    # the registry is shared with the other tests
+    assert dict(samples['nextbus_requests_total'])[
+        'resource="routes_list"'] >= 2
+    assert all(kind in ('counter', 'histogram')
+               for kind, _ in families.values())
+    assert all(family.endswith('_total') for family, (kind, _)
+               in families.items() if kind == 'counter')
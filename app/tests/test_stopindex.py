@@ -0,0 +1,100 @@
+import json
+import random
+
+import pytest
+
+from nextbus.common import stopindex
+from nextbus.common.stopindex import SpatialIndex, build_stops, haversine
+
+
+def brute_force(stops, lat, lon, radius, limit):
+    found = sorted((haversine(lat, lon, float(stop[3]), float(stop[4])), i)
+                   for i, stop in enumerate(stops))
+    return [(d, stops[i]) for d, i in found if d <= radius][:limit]
+
+
+@pytest.fixture(params=['python', 'numpy'])
+def spatial_index(request, monkeypatch, mock_get_request, app):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(stopindex, 'numpy', None)
+    with app.test_request_context():
+        return SpatialIndex(build_stops(app.nextbus_api.route_config()))
+
+
+def test_nearby_matches_brute_force(spatial_index):
+    rnd = random.Random(4)
+    for _ in range(20):
+        lat = rnd.uniform(37.70, 37.82)
+        lon = rnd.uniform(-122.52, -122.36)
+        radius = rnd.choice([100, 500, 2000])
+        expected = brute_force(spatial_index.stops, lat, lon, radius, 10)
+        found = spatial_index.nearby(lat, lon, radius, 10)
+        assert [stop for _, stop in found] == \
+            [stop for _, stop in expected]
+        assert [d for d, _ in found] == \
+            pytest.approx([d for d, _ in expected])
+
+
+def test_build_stops(mock_get_request, app):
+    with app.test_request_context():
+        route_configs = app.nextbus_api.route_config()
+    stops = build_stops(route_configs)
+    by_id = {stop[0]: stop for stop in stops}
+    assert len(by_id) == len(stops)
+    assert by_id['13323'][1:5] == ('3323', '18th St & Church St',
+                                   '37.76125', '-122.4281399')
+    assert [route['routeTag'] for route in by_id['13323'][5]] == ['33']
+    # served by many routes, indexed once
+    assert len(set(route['routeTag'] for route in by_id['15652'][5])) == 12
+
+
+def test_nearby_stops_resource(monkeypatch, mock_get_request, app):
+    with app.test_client() as c:
+        resp = c.get('/api/v1/stops/nearby?lat=37.8071299&lon=-122.41732'
+                     '&radius=300&limit=5')
+        assert resp.status_code == 200
+        stops = json.loads(resp.data)['stops']
+        assert 0 < len(stops) <= 5
+        assert stops[0]['tag'] == '5184' and stops[0]['distance'] == 0
+        assert stops[0]['routes']
+        distances = [stop['distance'] for stop in stops]
+        assert distances == sorted(distances) and distances[-1] <= 300
+
+        index = app.stop_index.index(app.nextbus_api)
+        c.get('/api/v1/stops/nearby?lat=37.8&lon=-122.4')
+        assert app.stop_index.index(app.nextbus_api) is index
+
+        # rebuilt for new route configs
+        monkeypatch.setattr(app.nextbus_api, 'route_config_version',
+                            lambda: 'new')
+        c.get('/api/v1/stops/nearby?lat=37.8&lon=-122.4')
+        assert app.stop_index.index(app.nextbus_api) is not index
+
+        assert c.get('/api/v1/stops/nearby?lat=37.8').status_code == 400
+        assert c.get('/api/v1/stops/nearby?lat=37.8&lon=-122.4'
+                     '&radius=50000').status_code == 400
+        assert c.get('/api/v1/stops/nearby?lat=97.8&lon=-122.4'
+                     ).status_code == 400
+
+
+def test_stop_resources(monkeypatch, mock_get_request, app):
+    monkeypatch.setitem(app.config, 'PROPAGATE_EXCEPTIONS', False)
+    with app.test_client() as c:
+        by_id = json.loads(c.get('/api/v1/stops/15652').data)['stop']
+        by_tag = json.loads(c.get('/api/v1/stops/5652').data)['stop']
+        assert by_id == by_tag
+        assert by_id['title'] == 'Market St & 9th St'
+        assert len(by_id['routes']) == 12
+
+        routes = json.loads(c.get('/api/v1/stops/15652/routes').data)
+        routes = routes['routes']
+        assert set(route['routeTag'] for route in routes) == \
+            set(by_id['routes'])
+        assert all(route['directionTag'] for route in routes)
+        assert len(set((route['routeTag'], route['directionTag'])
+                       for route in routes)) == len(routes)
+
+        assert c.get('/api/v1/stops/nope').status_code == 404
+        assert c.get('/api/v1/stops/nope/routes').status_code == 404
@@ -0,0 +1,82 @@
+import json
+import threading
+import time
+
+from nextbus.common.profiler import SamplingProfiler, RequestProfiler
+from nextbus.common.timing import server_timing, span, stages
+from nextbus.resources import resources
+
+
+def _server_timing(resp):
+    return dict(m.split(';dur=')
+                for m in resp.headers['Server-Timing'].split(', '))
+
+
+def test_server_timing_format():
+    assert server_timing({'cache': 0.0012, 'upstream': 0.25}, total=0.3) \
+        == 'cache;dur=1.2, upstream;dur=250.0, total;dur=300.0'
+
+
+def test_server_timing_header(mock_get_request, app):
+    with app.test_client() as c:
+        miss = _server_timing(c.get('/api/v1/routes'))
+        hit = _server_timing(c.get('/api/v1/routes'))
+    assert set(miss) == {'cache', 'upstream', 'parse', 'build', 'serialize',
+                         'total'}
+    # served from the response cache
+    assert set(hit) == {'cache', 'total'}
+
+
+def test_fan_out_stages(mock_get_request, app):
+    # stages timed on the client thread pool count for the request
+    def work(tag):
+        with span('upstream'):
+            time.sleep(0.01)
+
+    with app.test_request_context('/api/v1/routes/notinservice'):
+        list(app.nextbus_api.fan_out(work, ['E', 'F', 'J']))
+        assert stages()['upstream'] >= 0.03
+
+
+def test_slowlog_stages_and_profile(monkeypatch, mock_get_request, app):
+    monkeypatch.setattr(resources, 'SLOW_THRESH', 0)
+    app.profiler = RequestProfiler(sample_rate=1.0, interval=0.001)
+    real_get = app.nextbus_api.session.get
+
+    def slow_get(*args, **kwargs):
+        time.sleep(0.05)
+        return real_get(*args, **kwargs)
+    monkeypatch.setattr(app.nextbus_api.session, 'get', slow_get)
+
+    with app.test_client() as c:
+        c.get('/api/v1/routes')
+        app.stats.flush()
+        slowlog = c.get('/api/v1/stats/slowlog')
+    entry = json.loads(slowlog.data)['slowlog'][0]
+    assert entry['stages']['upstream'] >= 50
+    assert 'parse' in entry['stages']
+    assert any('slow_get' in stack for stack, _ in entry['profile'])
+
+
+def test_sampling_profiler():
+    done = threading.Event()
+
+    def busy():
+        while not done.is_set():
+            sum(range(100))
+    thread = threading.Thread(target=busy)
+    thread.start()
+    profiler = SamplingProfiler(thread.ident, interval=0.001).start()
+    time.sleep(0.05)
+    profiler.stop()
+    done.set()
+    thread.join()
+
+    profile = profiler.profile()
+    assert profiler.samples > 0
+    assert sum(samples for _, samples in profile) <= profiler.samples
+    assert all(':busy:' in stack for stack, _ in profile)
+
+
+def test_request_profiler_disabled():
+    assert RequestProfiler().start() is None
@@ -0,0 +1,77 @@
+import json
+
+import requests
+
+from conftest import MockResponse
+from nextbus.common.vehicles import VehicleTracker
+
+DELTA = """<?xml version="1.0" encoding="utf-8" ?>
+<body copyright="All data copyright San Francisco Muni 2016.">
+<vehicle id="1453" routeTag="N" dirTag="N____O_F00" lat="37.76581"
+ lon="-122.45402" secsSinceReport="3" predictable="true" heading="265"
+ speedKmHr="18"/>
+<vehicle id="1504" routeTag="NX" dirTag="NX___I_F00" lat="37.77702"
+ lon="-122.39311" secsSinceReport="5" predictable="true" heading="45"
+ speedKmHr="12"/>
+<lastTime time="1479850298379"/>
+</body>"""
+EMPTY = """<?xml version="1.0" encoding="utf-8" ?>
+<body copyright="All data copyright San Francisco Muni 2016.">
+<lastTime time="0"/>
+</body>"""
+
+
+class DeltaResponse(MockResponse):
+    text = None
+
+
+def test_vehicles_delta_polling(monkeypatch, mock_get_request, app):
+    calls = []
+
+    def mock_get(session, *args, **kwargs):
+        calls.append(kwargs['params'])
+        if kwargs['params']['t'] == 0 and kwargs['params']['r'] == 'N':
+            return MockResponse(*args, **kwargs)
+        response = DeltaResponse(*args, **kwargs)
+        response.text = DELTA if kwargs['params']['r'] == 'N' else EMPTY
+        return response
+    monkeypatch.setattr(requests.Session, 'get', mock_get)
+
+    def vehicles(c, path):
+        data = json.loads(c.get(path).data)
+        return data['lastTime'], {v['id']: v for v in data['vehicles']}
+
+    with app.test_client() as c:
+        last_time, n = vehicles(c, '/api/v1/vehicles/N')
+        assert last_time == 1479850268379
+        assert sorted(n) == ['1453', '1504', '1539']
+        assert n['1539']['speedKmHr'] == '22'
+        assert calls[0]['r'] == 'N' and calls[0]['t'] == 0
+
+        # polled at most once per poll interval
+        vehicles(c, '/api/v1/vehicles/N')
+        assert len(calls) == 1
+
+        # then only the changes since the last poll are fetched
+        app.redis.delete(app.vehicles._key('poll', 'N'))
+        last_time, n = vehicles(c, '/api/v1/vehicles/N')
+        assert calls[1]['t'] == 1479850268379
+        assert last_time == 1479850298379
+        assert n['1453']['lat'] == '37.76581'
+        assert n['1539']['lat'] == '37.76523'
+        # 1504 moved to the NX route
+        assert sorted(n) == ['1453', '1539']
+        _, nx = vehicles(c, '/api/v1/vehicles/NX')
+        assert list(nx) == ['1504']
+
+
+def test_vehicles_expire(mock_get_request, app):
+    with app.test_request_context('/api/v1/vehicles/N'):
+        tracker = VehicleTracker(app.redis, max_age=60)
+        vehicles, last_time = tracker.vehicles(app.nextbus_api, 'N')
+        # 1504 was last reported 61 seconds ago
+        assert [v.id for v in vehicles] == ['1453', '1539']
+        assert vehicles[0].secsSinceReport == '29'
+        assert last_time == 1479850268379
+        assert sorted(app.redis.hkeys(tracker._key('route', 'N'))) == \
+            ['1453', '1539']